@@ -1,9 +1,5 @@
-import os
 import streamlit as st
 
-import firebase_admin
-from firebase_admin import credentials
-
 from tsptw.init_app import init_app, init_pages
 
 
@@ -27,13 +23,6 @@ if not st.session_state.get("is_started", False):
     st.set_page_config(page_icon="🗺️", page_title="往診経路最適化さん", layout="wide")
     initialized_sesstion_state()
 
-    if firebase_admin._DEFAULT_APP_NAME not in firebase_admin._apps:
-        if os.environ.get("CLOUD_RUN") and os.environ.get("CLOUD_RUN").title() == "True":
-            cred = credentials.ApplicationDefault()
-        else:
-            cred = credentials.Certificate("./serviceAccount.json")
-        firebase_admin.initialize_app(cred)
-
 
 app = st.session_state.get("app", None)
 if app is not None:
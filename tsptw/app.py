@@ -2,10 +2,10 @@ import streamlit as st
 
 from tsptw.pages.base import BasePage
 
-from firebase_admin import firestore
 from streamlit_auth0 import login_button
-from tsptw.const import hash_client, AUTH0_CLIENT_ID, AUTH0_DOMAIN
-from google.cloud.firestore_v1.client import Client
+from tsptw.const import AUTH0_CLIENT_ID, AUTH0_DOMAIN
+from tsptw.clients import get_db
+from tsptw.metrics import metrics
 
 
 class MultiPageApp:
@@ -14,8 +14,7 @@ class MultiPageApp:
         self.nav_label = nav_label
 
     def connect_to_database(self, key: str):
-        db = firestore.client()
-        return db.collection(key).document("user_info")
+        return get_db().collection(key).document("user_info")
 
     def render(self) -> None:
         # ログインボタン
@@ -26,8 +25,11 @@ class MultiPageApp:
                     st.error("Email is not verified")
                     return
 
-                st.session_state["user_info"] = user_info
-                self.connect_to_database(user_info["email"]).set(user_info, merge=True)
+                # 探索中は画面を繰り返し描き直すので，ログイン情報が変わったときだけ書き込む
+                if st.session_state.get("user_info") != user_info:
+                    st.session_state["user_info"] = user_info
+                    self.connect_to_database(user_info["email"]).set(user_info, merge=True)
+                    metrics.count("firestore_writes")
             else:
                 if "user_info" in st.session_state and st.session_state["user_info"]["email"] is None:
                     del st.session_state["user_info"]["email"]
@@ -0,0 +1,87 @@
+"""問題ファイルをまとめて解くバッチ
+
+1ファイルに1件(1ユーザーの1日分)の問題をtsptw.solver.problem_from_dictの形式で書いておき，
+プロセスプールで並列に解いて，出力先に同じ名前のJSONで結果を書き出す．翌日の経路を夜間に
+全アカウント分まとめて求めておく用途を想定している
+
+    python -m tsptw.batch plans/ --output results/ --workers 8
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List
+
+from tsptw.const import BATCH_WORKERS
+from tsptw.solver import solve_problem
+from tsptw.decompose import use_inline_pool
+
+
+def expand(paths: List[str]) -> List[str]:
+    """ディレクトリはその直下の*.jsonに展開する"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob.glob(os.path.join(path, "*.json")))
+        else:
+            files.append(path)
+    return files
+
+
+def solve_file(path: str, output_dir: str, day: str = None) -> dict:
+    """ワーカープロセスで実行される．失敗しても他のファイルの求解は続けられるように結果に書く
+
+    dayは問題ファイルにdateが無い場合の計画の日付
+    """
+    started = time.perf_counter()
+    try:
+        with open(path, encoding="utf-8") as f:
+            problem = json.load(f)
+        if day and not problem.get("date"):
+            problem["date"] = day
+        result = solve_problem(problem)
+    except Exception as e:
+        result = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+    result["elapsed_sec"] = time.perf_counter() - started
+    out = os.path.join(output_dir, os.path.basename(path))
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    return {"input": path, "output": out, "status": result["status"], "elapsed_sec": result["elapsed_sec"]}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tsptw.batch", description="問題ファイルをまとめて解く")
+    parser.add_argument("inputs", nargs="+", help="問題のJSONファイル，もしくはそれを置いたディレクトリ")
+    parser.add_argument("--output", required=True, help="結果を書き出すディレクトリ")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--date", help="問題ファイルにdateが無い場合の計画の日付(YYYY-MM-DD)．省略時は実行した日")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    files = expand(args.inputs)
+    os.makedirs(args.output, exist_ok=True)
+    summary = []
+    # 問題ごとにプロセスを分けて並列に解くので，各プロセスの中ではクラスタ分割した部分問題を順に解く
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=use_inline_pool,
+    ) as pool:
+        futures = [pool.submit(solve_file, path, args.output, args.date) for path in files]
+        for future in as_completed(futures):
+            record = future.result()
+            print(f"{record['status']:>10} {record['elapsed_sec']:7.2f}s {record['input']}", file=sys.stderr)
+            summary.append(record)
+    failed = [r for r in summary if r["status"] == "error"]
+    print(f"{len(summary)}件中{len(summary) - len(failed)}件を解きました", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
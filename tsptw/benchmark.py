@@ -0,0 +1,371 @@
+"""求解性能のベンチマーク
+
+人工的に生成した問題と，TSPTWの標準ベンチマーク(Dumasら，López-Ibáñezらの形式)のファイルを，
+探索設定ごとに解いて求解時間・目的関数値・実行可能性・探索の統計をJSONに記録する．
+基準となる結果を与えると，閾値を超えて悪化した組み合わせを報告して終了コード1で終わる
+
+    python -m tsptw.benchmark --sizes 10 25 50 --output result.json
+    python -m tsptw.benchmark --files n20w20.001.txt --baseline result.json
+"""
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import datetime as dt
+from typing import List
+
+import numpy as np
+
+from tsptw.const import StepPoint, FIRST_SOLUTION_STRATEGIES, LOCAL_SEARCH_METAHEURISTICS, create_datetime
+from tsptw.decompose import route_feasible, solve_decomposed
+from tsptw.model import solve_model
+from tsptw.preprocess import InfeasibleError, preprocess
+from tsptw.exact import solve_exact, unsupported_reason
+from tsptw.portfolio import solve_portfolio
+from tsptw.providers import haversine_km
+
+# 人工的な問題の地点は，この中心から半径RADIUS_KMの範囲に置く
+CENTER = (35.68, 139.76)
+RADIUS_KM = 10.0
+SPEED_KMH = 25.0
+
+
+def make_step_points(lat, lng, staying_min, windows, start_time: dt.datetime) -> tuple:
+    return tuple(
+        StepPoint(
+            str(i),
+            0,
+            f"#{i}",
+            "",
+            float(lat[i]),
+            float(lng[i]),
+            int(staying_min[i]),
+            start_time + dt.timedelta(minutes=int(windows[i][0])),
+            start_time + dt.timedelta(minutes=int(windows[i][1]) + int(staying_min[i])),
+        )
+        for i in range(len(lat))
+    )
+
+
+def make_data(name: str, matrix, windows, step_points, horizon: int, vehicles: int = 1) -> dict:
+    """ノード0を出発地点・最終地点とする，tsptw.modelで解ける形式のデータ"""
+    n = len(matrix)
+    return {
+        "name": name,
+        "sp": step_points,
+        "start_time": step_points[0].start_time - dt.timedelta(minutes=int(windows[0][0])),
+        "depot_opening_time": int(horizon),
+        "vehicles": [
+            {"start": 0, "end": 0, "time_window": (int(windows[0][0]), int(horizon)), "capacity": n}
+            for _ in range(vehicles)
+        ],
+        "time_matrix": np.asarray(matrix, dtype=np.int64),
+        "time_windows": [(int(a), int(b)) for a, b in windows],
+        "depot": 0,
+        "depots": [0],
+    }
+
+
+def generate(
+    n: int,
+    kind: str = "random",
+    window_min: int = 60,
+    seed: int = 0,
+    staying_min: int = 15,
+    vehicles: int = 1,
+    clusters: int = 4,
+) -> dict:
+    """経由地点n箇所の問題を生成する
+
+    kindは"random"(一様)か"clustered"(clusters個の塊)．時間枠はランダムな巡回順で到着する時刻を中心とした
+    幅window_min分とするので，1台で回りきれる解が必ず存在する．幅が狭いほど難しい
+    """
+    rng = np.random.default_rng(seed)
+    if kind == "clustered":
+        centers = rng.uniform(-RADIUS_KM, RADIUS_KM, size=(clusters, 2))
+        xy = centers[rng.integers(clusters, size=n + 1)] + rng.normal(scale=RADIUS_KM / 10, size=(n + 1, 2))
+    elif kind == "random":
+        xy = rng.uniform(-RADIUS_KM, RADIUS_KM, size=(n + 1, 2))
+    else:
+        raise ValueError(f"Unknown kind: {kind}")
+    xy[0] = 0
+    lat = CENTER[0] + xy[:, 1] / 111.0
+    lng = CENTER[1] + xy[:, 0] / (111.0 * math.cos(math.radians(CENTER[0])))
+    km = haversine_km(lat[:, None], lng[:, None], lat[None, :], lng[None, :])
+    service = np.full(n + 1, staying_min)
+    service[0] = 0
+    matrix = service[:, None] + np.ceil(km / SPEED_KMH * 60).astype(np.int64)
+    np.fill_diagonal(matrix, 0)
+
+    # 車両ごとに巡回順を分け，その到着時刻を中心に時間枠を置く
+    order = rng.permutation(np.arange(1, n + 1))
+    windows = [(0, 0)] * (n + 1)
+    horizon = 0
+    for tour in np.array_split(order, vehicles):
+        t, prev = 0, 0
+        for node in tour:
+            t += matrix[prev, node]
+            offset = int(rng.integers(0, window_min + 1))
+            windows[node] = (max(0, t - offset), t - offset + window_min)
+            prev = node
+        horizon = max(horizon, t + matrix[prev, 0])
+    horizon = int(horizon + window_min)
+    windows[0] = (0, horizon)
+    name = f"{kind}-n{n}-w{window_min}-v{vehicles}-s{seed}"
+    step_points = make_step_points(lat, lng, service, windows, create_datetime(dt.time(0)))
+    return make_data(name, matrix, windows, step_points, horizon, vehicles)
+
+
+def load_instance(path: str, vehicles: int = 1) -> dict:
+    """TSPTWの標準ベンチマークを読み込む．次の2形式に対応する
+
+    - 行列形式(López-Ibáñezら): 1行目にノード数n，続くn行に距離行列，続くn行に各ノードの時間枠(ready due)
+    - 座標形式(Dumasら，Solomon形式): 各行が CUST_NO X Y DEMAND READY DUE SERVICE．CUST_NOが999の行で終わる．
+      距離はユークリッド距離の切り捨て
+    いずれもノード0を出発地点とし，移動時間には出発地点の作業時間を含める
+    """
+    with open(path) as f:
+        lines = [line.split() for line in f if line.strip()]
+    if len(lines[0]) == 1 and lines[0][0].isdigit():
+        n = int(lines[0][0])
+        matrix = np.array([[float(v) for v in row] for row in lines[1 : n + 1]])
+        windows = [(float(a), float(b)) for a, b in (row[:2] for row in lines[n + 1 : 2 * n + 1])]
+        service = np.zeros(n)
+        xy = np.zeros((n, 2))
+    else:
+        rows = []
+        for row in lines:
+            try:
+                values = [float(v) for v in row]
+            except ValueError:
+                continue  # 見出し行
+            if len(values) < 7 or values[0] == 999:
+                continue
+            rows.append(values)
+        rows = np.array(rows)
+        xy = rows[:, 1:3]
+        matrix = np.floor(np.linalg.norm(xy[:, None, :] - xy[None, :, :], axis=2))
+        windows = [(a, b) for a, b in rows[:, 4:6]]
+        service = rows[:, 6]
+        n = len(rows)
+    matrix = np.rint(service[:, None] + matrix).astype(np.int64)
+    np.fill_diagonal(matrix, 0)
+    windows = [(int(math.ceil(a)), int(math.floor(b))) for a, b in windows]
+    # 座標の単位は問わず，クラスタ分割で相対的な位置だけを使う
+    lat = CENTER[0] + xy[:, 1] / 111.0
+    lng = CENTER[1] + xy[:, 0] / (111.0 * math.cos(math.radians(CENTER[0])))
+    step_points = make_step_points(lat, lng, service, windows, create_datetime(dt.time(0)))
+    name = path.rsplit("/", 1)[-1]
+    return make_data(name, matrix, windows, step_points, windows[0][1], vehicles)
+
+
+def check_solution(data, result) -> bool:
+    """すべての経由地点をちょうど1回ずつ訪問し，時間枠・勤務時間帯を満たしているか"""
+    if result is None or result.get("dropped"):
+        return False
+    visited = [stop["node"] for route in result["routes"] for stop in route["stops"][1:]]
+    stops = [node for node in range(len(data["sp"])) if node not in data["depots"]]
+    if sorted(visited) != stops:
+        return False
+    windows = data.get("raw_time_windows", data["time_windows"])
+    checked = {**data, "time_windows": windows}
+    return all(
+        route_feasible(checked, data["vehicles"][route["vehicle_id"]], [s["node"] for s in route["stops"][1:]])
+        for route in result["routes"]
+    )
+
+
+def run(
+    data, config: dict, use_preprocess: bool = True, decompose: bool = False, engine: str = "ortools", portfolio: bool = False
+) -> dict:
+    """1つの問題を1つの探索設定で解き，結果を記録する．portfolioの場合はconfigを先頭とするポートフォリオで解く"""
+    record = {"instance": data["name"], "size": len(data["sp"]) - 1, "vehicles": len(data["vehicles"])}
+    record.update(config)
+    record.update({"preprocess": use_preprocess, "decompose": decompose, "engine": engine, "portfolio": portfolio})
+
+    started = time.time()
+    data = {**data, "raw_time_windows": data["time_windows"]}
+    if use_preprocess:
+        try:
+            reduced = preprocess(data)
+        except InfeasibleError as e:
+            # 車両が出発地点の時間帯に出発できない
+            reduced = {"pruned": np.zeros((len(data["sp"]),) * 2, dtype=bool), "conflicts": e.conflicts}
+        record["pruned_arcs"] = int(reduced["pruned"].sum())
+        if reduced["conflicts"]:
+            record.update(
+                {"time_sec": time.time() - started, "objective": None, "feasible": False, "infeasible_detected": True}
+            )
+            return record
+        data.update(time_windows=reduced["time_windows"], pruned=reduced["pruned"])
+
+    # 解が改善されるたびに時刻と目的関数値を記録する
+    improvements = []
+
+    def at_solution(manager, routing):
+        def callback():
+            cost = routing.CostVar().Value()
+            if not improvements or cost < improvements[-1][1]:
+                improvements.append((time.time() - started, cost))
+
+        return callback
+
+    if engine == "exact":
+        try:
+            result = solve_exact(data)
+            improvements.append((time.time() - started, result["objective"]))
+        except InfeasibleError:
+            result = None
+            record["infeasible_detected"] = True
+    elif decompose and len(data["vehicles"]) > 1:
+        result = solve_decomposed(data, config, at_solution=at_solution)
+    elif portfolio:
+        # 設定ごとの結果は別プロセスで求めるので，改善の経過は残らない
+        result, record["portfolio_configs"] = solve_portfolio(data, config)
+        if result is not None:
+            improvements.append((time.time() - started, result["objective"]))
+    else:
+        result = solve_model(data, config, at_solution=at_solution)
+    record.update(
+        {
+            "time_sec": time.time() - started,
+            "objective": result["objective"] if result is not None else None,
+            "feasible": check_solution(data, result),
+            "solutions": len(improvements),
+            "first_solution_sec": improvements[0][0] if improvements else None,
+            "best_solution_sec": improvements[-1][0] if improvements else None,
+        }
+    )
+    if result is not None and "stats" in result:
+        record["stats"] = result["stats"]
+    return record
+
+
+def record_key(record: dict) -> tuple:
+    return (
+        record["instance"],
+        record["first_solution_strategy"],
+        record["metaheuristic"],
+        record["time_limit_sec"],
+        record["preprocess"],
+        record["decompose"],
+        record.get("engine", "ortools"),
+        record.get("portfolio", False),
+    )
+
+
+def compare(records: List[dict], baseline: List[dict], max_time_regression: float, max_objective_regression: float):
+    """基準と比べて悪化した組み合わせを列挙する．時間は改善解が最後に見つかった時刻で比べる"""
+    base = {record_key(r): r for r in baseline}
+    regressions = []
+    for record in records:
+        old = base.get(record_key(record))
+        if old is None:
+            continue
+        name = "/".join(str(k) for k in record_key(record))
+        if old["feasible"] and not record["feasible"]:
+            regressions.append(f"{name}: 実行可能な解が得られなくなりました")
+            continue
+        if old["objective"] and record["objective"] is not None:
+            ratio = record["objective"] / old["objective"] - 1
+            if ratio > max_objective_regression:
+                regressions.append(f"{name}: 目的関数値 {old['objective']} -> {record['objective']} ({ratio:+.1%})")
+        if old.get("best_solution_sec") and record.get("best_solution_sec") is not None:
+            ratio = record["best_solution_sec"] / old["best_solution_sec"] - 1
+            if ratio > max_time_regression:
+                regressions.append(
+                    f"{name}: 最良解までの時間 {old['best_solution_sec']:.2f}秒 -> "
+                    f"{record['best_solution_sec']:.2f}秒 ({ratio:+.1%})"
+                )
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tsptw.benchmark", description="求解性能のベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10, 25, 50], help="人工的な問題の経由地点数")
+    parser.add_argument("--kinds", nargs="*", default=["random", "clustered"], choices=["random", "clustered"])
+    parser.add_argument("--windows", type=int, nargs="*", default=[30, 120], help="時間枠の幅[分]")
+    parser.add_argument("--seeds", type=int, nargs="*", default=[0])
+    parser.add_argument("--files", nargs="*", default=[], help="標準ベンチマークのファイル")
+    parser.add_argument("--vehicles", type=int, default=1)
+    parser.add_argument("--time-limit", type=float, nargs="*", default=[5])
+    parser.add_argument("--strategies", nargs="*", default=[FIRST_SOLUTION_STRATEGIES[0]])
+    parser.add_argument("--metaheuristics", nargs="*", default=[LOCAL_SEARCH_METAHEURISTICS[0]])
+    parser.add_argument("--no-preprocess", action="store_true", help="時間枠の前処理をしない")
+    parser.add_argument("--decompose", action="store_true", help="複数車両の場合にクラスタ分割して解く")
+    parser.add_argument("--portfolio", action="store_true", help="各探索設定を先頭とするポートフォリオで解く")
+    parser.add_argument(
+        "--engines", nargs="*", default=["ortools"], choices=["ortools", "exact"], help="exactは解ける問題だけで1回ずつ解く"
+    )
+    parser.add_argument("--output", help="結果を書き出すJSONファイル(省略時は標準出力)")
+    parser.add_argument("--baseline", help="比較の基準とする結果のJSONファイル")
+    parser.add_argument("--max-time-regression", type=float, default=0.2)
+    parser.add_argument("--max-objective-regression", type=float, default=0.02)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    instances = [
+        generate(n, kind, window, seed, vehicles=args.vehicles)
+        for n in args.sizes
+        for kind in args.kinds
+        for window in args.windows
+        for seed in args.seeds
+    ]
+    instances += [load_instance(path, vehicles=args.vehicles) for path in args.files]
+    configs = [
+        {"time_limit_sec": limit, "first_solution_strategy": strategy, "metaheuristic": metaheuristic}
+        for limit in args.time_limit
+        for strategy in args.strategies
+        for metaheuristic in args.metaheuristics
+    ]
+
+    records = []
+    for data in instances:
+        for engine in args.engines:
+            # 厳密解法は探索設定によらないので最初の設定で1回だけ解く
+            if engine == "exact" and unsupported_reason(data) is not None:
+                continue
+            for config in configs if engine == "ortools" else configs[:1]:
+                record = run(
+                    data,
+                    config,
+                    use_preprocess=not args.no_preprocess,
+                    decompose=args.decompose,
+                    engine=engine,
+                    portfolio=args.portfolio,
+                )
+                print(
+                    f"{record['instance']} {engine} {config['first_solution_strategy']}/{config['metaheuristic']}:"
+                    f" objective={record['objective']} feasible={record['feasible']} time={record['time_sec']:.2f}s",
+                    file=sys.stderr,
+                )
+                records.append(record)
+
+    output = {
+        "created_at": dt.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "records": records,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(output, sys.stdout, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["records"]
+        regressions = compare(records, baseline, args.max_time_regression, args.max_objective_regression)
+        for message in regressions:
+            print(message, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
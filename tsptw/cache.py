@@ -0,0 +1,187 @@
+import os
+import time
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+from tsptw.const import (
+    Location,
+    TRAVEL_TIME_CACHE_PATH,
+    TRAVEL_TIME_CACHE_TTL_SEC,
+    TRAVEL_TIME_CACHE_MAX_ENTRIES,
+    TRAVEL_TIME_BY_HOUR_CACHE_PATH,
+    TRAVEL_TIME_BY_HOUR_CACHE_TTL_SEC,
+    TRAVEL_TIME_BY_HOUR_CACHE_MAX_ENTRIES,
+    GEOCODE_CACHE_PATH,
+    GEOCODE_CACHE_TTL_SEC,
+    GEOCODE_CACHE_MAX_ENTRIES,
+    ROUTE_GEOMETRY_CACHE_PATH,
+    ROUTE_GEOMETRY_CACHE_TTL_SEC,
+    ROUTE_GEOMETRY_CACHE_MAX_ENTRIES,
+)
+
+
+def location_key(lat: float, lng: float) -> str:
+    # 小数点以下6桁(約10cm)で丸めて同一地点とみなす
+    return f"{lat:.6f},{lng:.6f}"
+
+
+def placeholders(values: list) -> str:
+    return ",".join("?" * len(values))
+
+
+class SQLiteCache:
+    """キーごとの値を取得時刻とともにSQLiteに永続化するキャッシュの共通部分
+
+    テーブル名tableと，キーの列key_columns・値の列value_columns(いずれも"列名 型")は派生クラスで定める．
+    TTLを過ぎた行は返さず，書き込みのたびに期限切れを削除したうえで上限件数を超えた分を古い順に削除する
+    """
+
+    table = ""
+    key_columns: Tuple[str, ...] = ()
+    value_columns: Tuple[str, ...] = ()
+
+    def __init__(self, path: str, ttl_sec: int, max_entries: int) -> None:
+        self.path = path
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            columns = [f"{column} NOT NULL" for column in self.key_columns + self.value_columns]
+            keys = ", ".join(column.split()[0] for column in self.key_columns)
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table}"
+                f" ({', '.join(columns)}, fetched_at REAL NOT NULL, PRIMARY KEY ({keys}))"
+            )
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_fetched_at ON {self.table} (fetched_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _select(self, where: str, params: list) -> List[tuple]:
+        """whereを満たす期限切れでない行の，キーの列と値の列を返す"""
+        names = ", ".join(column.split()[0] for column in self.key_columns + self.value_columns)
+        with self._lock:
+            cursor = self._connect().execute(
+                f"SELECT {names} FROM {self.table} WHERE {where} AND fetched_at >= ?",
+                list(params) + [time.time() - self.ttl_sec],
+            )
+            return cursor.fetchall()
+
+    def _put(self, rows: List[tuple]) -> None:
+        """キーの列と値の列を並べた行を書き込む"""
+        if not rows:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders(rows[0] + (now,))})",
+                [row + (now,) for row in rows],
+            )
+            conn.execute(f"DELETE FROM {self.table} WHERE fetched_at < ?", (now - self.ttl_sec,))
+            (count,) = conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    f"DELETE FROM {self.table} WHERE rowid IN"
+                    f" (SELECT rowid FROM {self.table} ORDER BY fetched_at ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            conn.commit()
+
+
+class TravelTimeCache(SQLiteCache):
+    """出発地-到着地の地点ペアごとの移動時間[秒]をSQLiteに永続化するキャッシュ"""
+
+    table = "travel_time"
+    key_columns = ("origin TEXT", "destination TEXT")
+    value_columns = ("duration_sec INTEGER",)
+
+    def get_many(self, keys: List[str]) -> Dict[Tuple[str, str], int]:
+        """keys同士の全ペアのうち，期限切れでないものを返す"""
+        uniq = sorted(set(keys))
+        if not uniq:
+            return {}
+        rows = self._select(
+            f"origin IN ({placeholders(uniq)}) AND destination IN ({placeholders(uniq)})", uniq + uniq
+        )
+        return {(o, d): sec for o, d, sec in rows}
+
+    def put_many(self, items: Iterable[Tuple[str, str, int]]) -> None:
+        self._put([(o, d, int(sec)) for o, d, sec in items])
+
+
+class TravelTimeByHourCache(SQLiteCache):
+    """出発地-到着地の地点ペアと出発時刻の曜日・時間帯[時]ごとの移動時間[秒]をSQLiteに永続化するキャッシュ"""
+
+    table = "travel_time_by_weekday_hour"
+    key_columns = ("origin TEXT", "destination TEXT", "weekday INTEGER", "hour INTEGER")
+    value_columns = ("duration_sec INTEGER",)
+
+    def get_many(self, keys: List[str], weekday: int, hours: List[int]) -> Dict[Tuple[str, str, int], int]:
+        """keys同士の全ペアとweekday(月曜が0)のhoursの組のうち，期限切れでないものを返す"""
+        uniq = sorted(set(keys))
+        if not uniq or not hours:
+            return {}
+        rows = self._select(
+            f"origin IN ({placeholders(uniq)}) AND destination IN ({placeholders(uniq)})"
+            f" AND weekday = ? AND hour IN ({placeholders(hours)})",
+            uniq + uniq + [weekday] + list(hours),
+        )
+        return {(o, d, h): sec for o, d, _, h, sec in rows}
+
+    def put_many(self, items: Iterable[Tuple[str, str, int, int, int]]) -> None:
+        self._put([(o, d, int(w), int(h), int(sec)) for o, d, w, h, sec in items])
+
+
+class GeocodeCache(SQLiteCache):
+    """正規化した住所(tsptw.const.normalize_address)ごとの緯度経度をSQLiteに永続化するキャッシュ"""
+
+    table = "geocode"
+    key_columns = ("address TEXT",)
+    value_columns = ("lat REAL", "lng REAL")
+
+    def get_many(self, addresses: List[str]) -> Dict[str, Location]:
+        uniq = sorted(set(addresses))
+        if not uniq:
+            return {}
+        rows = self._select(f"address IN ({placeholders(uniq)})", uniq)
+        return {address: Location(lat, lng) for address, lat, lng in rows}
+
+    def put_many(self, items: Iterable[Tuple[str, Location]]) -> None:
+        self._put([(address, loc.lat, loc.lng) for address, loc in items])
+
+
+class RouteGeometryCache(SQLiteCache):
+    """出発地-到着地の地点ペアごとの経路形状をエンコード済みポリラインでSQLiteに永続化するキャッシュ"""
+
+    table = "route_geometry"
+    key_columns = ("origin TEXT", "destination TEXT")
+    value_columns = ("polyline TEXT",)
+
+    def get_many(self, pairs: List[Tuple[str, str]]) -> Dict[Tuple[str, str], str]:
+        uniq = sorted(set(pairs))
+        if not uniq:
+            return {}
+        values = ",".join("(?, ?)" for _ in uniq)
+        rows = self._select(f"(origin, destination) IN (VALUES {values})", [k for pair in uniq for k in pair])
+        return {(o, d): polyline for o, d, polyline in rows}
+
+    def put_many(self, items: Iterable[Tuple[str, str, str]]) -> None:
+        self._put([(o, d, polyline) for o, d, polyline in items])
+
+
+travel_time_cache = TravelTimeCache(TRAVEL_TIME_CACHE_PATH, TRAVEL_TIME_CACHE_TTL_SEC, TRAVEL_TIME_CACHE_MAX_ENTRIES)
+travel_time_by_hour_cache = TravelTimeByHourCache(
+    TRAVEL_TIME_BY_HOUR_CACHE_PATH, TRAVEL_TIME_BY_HOUR_CACHE_TTL_SEC, TRAVEL_TIME_BY_HOUR_CACHE_MAX_ENTRIES
+)
+geocode_cache = GeocodeCache(GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL_SEC, GEOCODE_CACHE_MAX_ENTRIES)
+route_geometry_cache = RouteGeometryCache(
+    ROUTE_GEOMETRY_CACHE_PATH, ROUTE_GEOMETRY_CACHE_TTL_SEC, ROUTE_GEOMETRY_CACHE_MAX_ENTRIES
+)
@@ -0,0 +1,48 @@
+"""外部サービスのクライアント
+
+起動を速くするため，ライブラリの読み込みとクライアントの作成は初めて使うときまで遅らせ，作成したものは
+プロセス内の全セッションで使い回す
+"""
+import os
+import threading
+
+_gmaps = None
+_db = None
+_lock = threading.Lock()
+
+
+def get_gmaps():
+    """Google Maps APIのクライアント"""
+    global _gmaps
+    if _gmaps is None:
+        with _lock:
+            if _gmaps is None:
+                import googlemaps
+
+                _gmaps = googlemaps.Client(key=os.environ.get("GOOGLEMAP_API_KEY"))
+    return _gmaps
+
+
+def init_firebase() -> None:
+    import firebase_admin
+    from firebase_admin import credentials
+
+    if firebase_admin._DEFAULT_APP_NAME not in firebase_admin._apps:
+        if os.environ.get("CLOUD_RUN") and os.environ.get("CLOUD_RUN").title() == "True":
+            cred = credentials.ApplicationDefault()
+        else:
+            cred = credentials.Certificate("./serviceAccount.json")
+        firebase_admin.initialize_app(cred)
+
+
+def get_db():
+    """Firestoreのクライアント"""
+    global _db
+    if _db is None:
+        with _lock:
+            if _db is None:
+                from firebase_admin import firestore
+
+                init_firebase()
+                _db = firestore.client()
+    return _db
@@ -0,0 +1,109 @@
+"""起動時間の計測
+
+新しいPythonプロセスで起動の各段階を実行し，所要時間と読み込みに時間のかかったモジュールをJSONに記録する．
+startupはmain.pyがトップページを描画するまでに行う読み込みと初期化で，Cloud Runのコールドスタートで
+毎回かかる部分にあたる．他はページを初めて開いたときや最初の探索で追加でかかる部分
+
+    python -m tsptw.coldstart --repeat 5 --output coldstart.json
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from typing import Dict, List
+
+SCENARIOS = {
+    "startup": "import streamlit\nfrom tsptw.init_app import init_app, init_pages\ninit_app(init_pages())",
+    "edit_page": "import tsptw.pages.edit",
+    "findroute_page": "import tsptw.pages.findroute",
+    "solver": "import tsptw.solver",
+}
+
+# 子プロセスで実行する．前の段階を読み込んだ後の差分を測れるよう，setupを実行してから計測を始める
+CHILD = """
+import sys, time, json
+exec({setup!r})
+sys.stderr.write("{marker}\\n")
+started = time.perf_counter()
+exec({code!r})
+sys.stdout.write(json.dumps({{"sec": time.perf_counter() - started}}))
+"""
+
+MARKER = "-- measure --"
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def slowest_imports(stderr: str, top: int) -> List[dict]:
+    """-X importtimeの出力から，計測区間の読み込み時間をトップレベルのパッケージごとに合計して長い順に返す"""
+    packages = {}
+    for m in IMPORT_TIME.finditer(stderr.split(MARKER, 1)[-1]):
+        self_us, _, _, name = m.groups()
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    imports = [{"module": name, "sec": us / 1e6} for name, us in packages.items()]
+    return sorted(imports, key=lambda i: i["sec"], reverse=True)[:top]
+
+
+def measure(code: str, setup: str = "", top: int = 10) -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD.format(setup=setup, code=code, marker=MARKER)],
+        cwd=root,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1]}
+    return {"sec": json.loads(proc.stdout)["sec"], "imports": slowest_imports(proc.stderr, top)}
+
+
+def run(names: List[str], repeat: int, top: int) -> Dict[str, dict]:
+    results = {}
+    for name in names:
+        # ページは起動後に開くので，起動を済ませてからの差分を測る．solverはバッチからも使うので単体で測る
+        setup = SCENARIOS["startup"] if name.endswith("_page") else ""
+        runs = [measure(SCENARIOS[name], setup, top) for _ in range(repeat)]
+        errors = [r["error"] for r in runs if "error" in r]
+        if errors:
+            results[name] = {"error": errors[0]}
+            continue
+        # 所要時間は中央値，モジュールの内訳は最も中央値に近かった回のもの
+        secs = [r["sec"] for r in runs]
+        median = statistics.median(secs)
+        closest = min(runs, key=lambda r: abs(r["sec"] - median))
+        results[name] = {"median_sec": median, "min_sec": min(secs), "max_sec": max(secs), "imports": closest["imports"]}
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tsptw.coldstart", description="起動時間の計測")
+    parser.add_argument("--scenarios", nargs="*", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10, help="記録する読み込みの遅いモジュールの数")
+    parser.add_argument("--output", help="結果を書き出すJSONファイル(省略時は標準出力)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = run(args.scenarios, args.repeat, args.top)
+    for name, result in results.items():
+        if "error" in result:
+            print(f"{name:>16}: {result['error']}", file=sys.stderr)
+            continue
+        slowest = ", ".join(f"{i['module']} {i['sec']:.2f}s" for i in result["imports"][:3])
+        print(f"{name:>16}: {result['median_sec']:.3f}s ({slowest})", file=sys.stderr)
+    text = json.dumps({"python": sys.version.split()[0], "scenarios": results}, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
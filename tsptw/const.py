@@ -1,7 +1,6 @@
 import os
-import googlemaps
+import unicodedata
 import datetime as dt
-from typing import List
 from enum import Enum, IntEnum, auto
 from datetime import datetime, date
 from collections import namedtuple
@@ -10,33 +9,196 @@ from collections import namedtuple
 AUTH0_CLIENT_ID = "ciFCosdQaze8Vwz2CQRci6Xa4Or1GTuu"
 AUTH0_DOMAIN = "tk42.jp.auth0.com"
 
-gmaps = googlemaps.Client(key=os.environ.get("GOOGLEMAP_API_KEY"))
+# 地点ペアごとの移動時間キャッシュ
+TRAVEL_TIME_CACHE_PATH = os.environ.get("TRAVEL_TIME_CACHE_PATH", "./.cache/travel_time.sqlite3")
+TRAVEL_TIME_CACHE_TTL_SEC = int(os.environ.get("TRAVEL_TIME_CACHE_TTL_SEC", 60 * 60 * 24 * 30))
+TRAVEL_TIME_CACHE_MAX_ENTRIES = int(os.environ.get("TRAVEL_TIME_CACHE_MAX_ENTRIES", 100000))
+# 出発時刻の時間帯ごとの移動時間キャッシュ．渋滞の傾向は週ごとに繰り返すので日をまたいで使う
+TRAVEL_TIME_BY_HOUR_CACHE_PATH = os.environ.get("TRAVEL_TIME_BY_HOUR_CACHE_PATH", "./.cache/travel_time_by_hour.sqlite3")
+TRAVEL_TIME_BY_HOUR_CACHE_TTL_SEC = int(os.environ.get("TRAVEL_TIME_BY_HOUR_CACHE_TTL_SEC", 60 * 60 * 24 * 30))
+TRAVEL_TIME_BY_HOUR_CACHE_MAX_ENTRIES = int(os.environ.get("TRAVEL_TIME_BY_HOUR_CACHE_MAX_ENTRIES", 600000))
+
+# 正規化した住所ごとの緯度経度キャッシュ
+GEOCODE_CACHE_PATH = os.environ.get("GEOCODE_CACHE_PATH", "./.cache/geocode.sqlite3")
+GEOCODE_CACHE_TTL_SEC = int(os.environ.get("GEOCODE_CACHE_TTL_SEC", 60 * 60 * 24 * 90))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.environ.get("GEOCODE_CACHE_MAX_ENTRIES", 100000))
+
+# 隣り合う地点ペアごとの経路形状(エンコード済みポリライン)キャッシュ
+ROUTE_GEOMETRY_CACHE_PATH = os.environ.get("ROUTE_GEOMETRY_CACHE_PATH", "./.cache/route_geometry.sqlite3")
+ROUTE_GEOMETRY_CACHE_TTL_SEC = int(os.environ.get("ROUTE_GEOMETRY_CACHE_TTL_SEC", 60 * 60 * 24 * 30))
+ROUTE_GEOMETRY_CACHE_MAX_ENTRIES = int(os.environ.get("ROUTE_GEOMETRY_CACHE_MAX_ENTRIES", 100000))
+
+# Directions APIの並列数と毎秒のリクエスト数の上限，1リクエストで取得する区間数(経由地の上限は25)，再試行する回数
+DIRECTIONS_CONCURRENCY = int(os.environ.get("DIRECTIONS_CONCURRENCY", 4))
+DIRECTIONS_QPS = float(os.environ.get("DIRECTIONS_QPS", 10))
+DIRECTIONS_MAX_LEGS = 10
+DIRECTIONS_MAX_RETRIES = int(os.environ.get("DIRECTIONS_MAX_RETRIES", 3))
+
+# Distance Matrix APIの並列数とクライアント側のレート制限，再試行する回数
+DISTANCE_MATRIX_CONCURRENCY = int(os.environ.get("DISTANCE_MATRIX_CONCURRENCY", 4))
+DISTANCE_MATRIX_QPS = float(os.environ.get("DISTANCE_MATRIX_QPS", 10))
+DISTANCE_MATRIX_ELEMENTS_PER_SEC = float(os.environ.get("DISTANCE_MATRIX_ELEMENTS_PER_SEC", 500))
+DISTANCE_MATRIX_MAX_RETRIES = int(os.environ.get("DISTANCE_MATRIX_MAX_RETRIES", 3))
+# Google Maps APIの一時的な失敗を再試行する間隔の基準[秒]．再試行のたびに倍にし，ジッタを加える
+GOOGLE_API_RETRY_BASE_DELAY_SEC = float(os.environ.get("GOOGLE_API_RETRY_BASE_DELAY_SEC", 0.5))
+
+# Distance Matrix APIの1リクエストあたりの上限
+# See: https://developers.google.com/maps/documentation/distance-matrix/usage-and-billing
+DISTANCE_MATRIX_MAX_ORIGINS = 25
+DISTANCE_MATRIX_MAX_DESTINATIONS = 25
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
+# 1往復あたりのレイテンシを何要素分の課金とみなすか(リクエスト計画の重み)
+DISTANCE_MATRIX_CALL_COST_ELEMENTS = float(os.environ.get("DISTANCE_MATRIX_CALL_COST_ELEMENTS", 5))
+
+# 移動時間の取得元 (google / haversine / road_graph)
+TRAVEL_TIME_PROVIDER = os.environ.get("TRAVEL_TIME_PROVIDER", "google")
+PROVIDER_LABELS = {
+    "google": "Google Maps",
+    "haversine": "直線距離(概算)",
+    "road_graph": "道路グラフ",
+    "matrix": "与えられた行列",
+}
+# 渋滞を考慮する場合の出発時刻の時間帯の区切り[時]．各時間帯の移動時間はその時刻に出発した場合の値で代表する
+TRAVEL_TIME_HOURS = [int(h) for h in os.environ.get("TRAVEL_TIME_HOURS", "7,9,12,15,17,19").split(",") if h]
+# 各地点の出発時刻の見積りと時間帯を合わせるために解き直す最大回数
+TIME_DEPENDENT_MAX_ITERATIONS = int(os.environ.get("TIME_DEPENDENT_MAX_ITERATIONS", 4))
+# Google Maps APIが失敗した場合に直線距離による概算値で代替するか
+TRAVEL_TIME_FALLBACK = os.environ.get("TRAVEL_TIME_FALLBACK", "True").title() == "True"
+# 直線距離による概算: 迂回係数，距離帯[km]ごとの平均速度[km/h]，停車・発車にかかる固定時間[秒]
+HAVERSINE_DETOUR_FACTOR = 1.3
+HAVERSINE_SPEED_PROFILE = [(2.0, 15.0), (10.0, 25.0), (float("inf"), 40.0)]
+HAVERSINE_OVERHEAD_SEC = 120
+# ローカルの道路グラフ(JSON)のパスと，最寄りノードまでの移動速度[km/h]
+ROAD_GRAPH_PATH = os.environ.get("ROAD_GRAPH_PATH", "")
+ROAD_GRAPH_ACCESS_SPEED_KMH = 15.0
+
+# 探索の打ち切り時間[秒]と，選択可能な初期解構築方法・メタヒューリスティクス(先頭が既定値)
+# See: https://developers.google.com/optimization/routing/routing_options
+SOLVER_TIME_LIMIT_SEC = int(os.environ.get("SOLVER_TIME_LIMIT_SEC", 5))
+FIRST_SOLUTION_STRATEGIES = [
+    "PATH_CHEAPEST_ARC",
+    "AUTOMATIC",
+    "SAVINGS",
+    "PARALLEL_CHEAPEST_INSERTION",
+    "LOCAL_CHEAPEST_INSERTION",
+    "GLOBAL_CHEAPEST_ARC",
+    "CHRISTOFIDES",
+]
+LOCAL_SEARCH_METAHEURISTICS = [
+    "GUIDED_LOCAL_SEARCH",
+    "AUTOMATIC",
+    "GREEDY_DESCENT",
+    "SIMULATED_ANNEALING",
+    "TABU_SEARCH",
+]
+# 求解方法(auto: 1台で経由地点がEXACT_MAX_STOPS件以下なら動的計画法による厳密解法，それ以外はOR-Toolsの探索)
+SOLVER_ENGINES = ["auto", "exact", "ortools"]
+SOLVER_ENGINE_LABELS = {"auto": "経由地点数で選ぶ", "exact": "厳密解法(動的計画法)", "ortools": "OR-Toolsの探索"}
+EXACT_MAX_STOPS = int(os.environ.get("EXACT_MAX_STOPS", 12))
+# 前回の経路を初期解とする場合の探索時間[秒]
+WARM_START_TIME_LIMIT_SEC = int(os.environ.get("WARM_START_TIME_LIMIT_SEC", 1))
+# 現在地から再計画する場合の探索時間[秒]
+REPLAN_TIME_LIMIT_SEC = float(os.environ.get("REPLAN_TIME_LIMIT_SEC", 0.3))
+
+# 経由地点数の上限(1台 / 複数車両)と，複数車両の上限台数・経路の表示色
+MAX_STEP_POINTS = 25
+FLEET_MAX_STEP_POINTS = 300
+FLEET_MAX_VEHICLES = 10
+PATH_COLORS = ["#ed1c24", "#0072bc", "#00a651", "#f7941d", "#92278f", "#00aeef", "#8c6239", "#ec008c", "#39b54a", "#662d91"]
+# 経由地点がこの数以上の場合は大規模向けの探索設定を既定値とする
+LARGE_INSTANCE_STEP_POINTS = 50
+LARGE_INSTANCE_SEARCH_CONFIG = {
+    "time_limit_sec": 30,
+    "first_solution_strategy": "PARALLEL_CHEAPEST_INSERTION",
+    "metaheuristic": "GUIDED_LOCAL_SEARCH",
+}
+
+# クラスタ分割による求解: ワーカープロセス数，部分問題に充てる探索時間の割合，
+# 時間枠の中央1分を何kmとみなすか，出発地点からの距離の重み，k-meansの反復回数，
+# 1クラスタの件数の上限(平均に対する倍率)，部分問題で地点を落とす場合のペナルティ
+DECOMPOSE_WORKERS = int(os.environ.get("DECOMPOSE_WORKERS", os.cpu_count() or 1))
+DECOMPOSE_CLUSTER_BUDGET_RATIO = 0.7
+DECOMPOSE_TIME_WEIGHT_KM_PER_MIN = 0.01
+DECOMPOSE_DEPOT_WEIGHT = 0.5
+DECOMPOSE_KMEANS_ITERATIONS = 20
+DECOMPOSE_BALANCE_SLACK = 1.1
+DECOMPOSE_DROP_PENALTY = 100000
+
+# 探索設定のポートフォリオ: 複数の設定をプロセスプール(クラスタ分割と共用)で同時に解き，最も良い解を使う．
+# 設定の数と，利用者の設定の次に試す(初期解の構築方法, メタヒューリスティクス)の組．組を使い切ったら乱数の種を変えて繰り返す
+PORTFOLIO_SIZE = int(os.environ.get("PORTFOLIO_SIZE", os.cpu_count() or 1))
+PORTFOLIO_CANDIDATES = [
+    ("PATH_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH"),
+    ("PARALLEL_CHEAPEST_INSERTION", "GUIDED_LOCAL_SEARCH"),
+    ("SAVINGS", "TABU_SEARCH"),
+    ("LOCAL_CHEAPEST_INSERTION", "SIMULATED_ANNEALING"),
+    ("GLOBAL_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH"),
+    ("PATH_CHEAPEST_ARC", "TABU_SEARCH"),
+    ("CHRISTOFIDES", "GUIDED_LOCAL_SEARCH"),
+    ("AUTOMATIC", "SIMULATED_ANNEALING"),
+]
+# 設定ごとの結果を1求解1行のJSONで追記するファイル(空なら書かない)
+PORTFOLIO_LOG_PATH = os.environ.get("PORTFOLIO_LOG_PATH", "")
+
+# 時間帯を守れない訪問先があっても経路を求める場合の，遅刻1分あたりのペナルティと訪問を見送る場合のペナルティ
+SOFT_WINDOW_LATENESS_PENALTY = int(os.environ.get("SOFT_WINDOW_LATENESS_PENALTY", 100))
+SOFT_WINDOW_DROP_PENALTY = int(os.environ.get("SOFT_WINDOW_DROP_PENALTY", 10000))
+
+# 求解前の時間枠の引き締めを繰り返す上限回数
+PREPROCESS_MAX_ITERATIONS = 20
+
+# 求解結果キャッシュの最大件数(LRU)
+SOLUTION_CACHE_MAX_ENTRIES = int(os.environ.get("SOLUTION_CACHE_MAX_ENTRIES", 256))
+
+# 求解ジョブのワーカー数，保持するジョブ数，画面の進捗ポーリング間隔[秒]
+SOLVER_WORKERS = int(os.environ.get("SOLVER_WORKERS", os.cpu_count() or 1))
+SOLVER_MAX_JOBS = int(os.environ.get("SOLVER_MAX_JOBS", 100))
+SOLVER_POLL_INTERVAL_SEC = float(os.environ.get("SOLVER_POLL_INTERVAL_SEC", 0.5))
+# バッチ求解(python -m tsptw.batch)で同時に解く問題の数
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", os.cpu_count() or 1))
+
+# Geocoding APIの並列数と毎秒のリクエスト数の上限，一時的な失敗を再試行する回数
+GEOCODE_CONCURRENCY = int(os.environ.get("GEOCODE_CONCURRENCY", 4))
+GEOCODE_QPS = float(os.environ.get("GEOCODE_QPS", 10))
+GEOCODE_MAX_RETRIES = int(os.environ.get("GEOCODE_MAX_RETRIES", 3))
+# 一括登録で訪問可能時間帯が指定されていない場合の既定値
+IMPORT_DEFAULT_START_TIME = "08:45:00"
+IMPORT_DEFAULT_END_TIME = "19:00:00"
+
+# 計測: 有効にするか，Prometheusのテキスト形式の書き出し先とHTTPで公開するポート(0なら公開しない)，
+# 区間ごとのトレースを追記するファイル(空なら記録しない)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "False").title() == "True"
+METRICS_PATH = os.environ.get("METRICS_PATH", "./.cache/metrics.prom")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+TRACE_LOG_PATH = os.environ.get("TRACE_LOG_PATH", "")
+
+# 経由地点の同期: 初回スナップショットを待つ上限[秒]，一括書き込みの件数(Firestoreの上限は500)
+CONTACT_SNAPSHOT_TIMEOUT_SEC = float(os.environ.get("CONTACT_SNAPSHOT_TIMEOUT_SEC", 10))
+FIRESTORE_BATCH_SIZE = 500
 
 Location = namedtuple("Location", ["lat", "lng"])
+# 複数車両で計画する場合の各車両の出発地点・最終地点(StepPoint)，勤務時間帯(datetime)，最大訪問件数
+Vehicle = namedtuple("Vehicle", ["start", "end", "shift_start", "shift_end", "capacity"])
 baseCls = namedtuple(
     "StepPoint", 
     ["id", "timestamp", "name", "address", "lat", "lng", "staying_min", "start_time", "end_time"]
 )
 
-today = datetime.now().date()
-
-
 def hex_to_rgb(h):
     h = h.lstrip("#")
     return tuple(int(h[i : i + 2], 16) for i in (0, 2, 4))
 
 
-def create_datetime(t: dt.time or str, fromisoformat=False):
+def create_datetime(t: dt.time or str, fromisoformat=False, day: dt.date = None):
+    # 日付を省略した場合は呼び出した時点の日付(起動した日ではない)
     if fromisoformat:
         t = dt.time.fromisoformat(t)
-    return datetime.combine(today, t)
+    return datetime.combine(day or date.today(), t)
 
 
-def geocode(address: str) -> Location:
-    results = gmaps.geocode(address)
-    print(results)
-    location = results[0]["geometry"]["location"]
-    return Location(location["lat"], location["lng"])
+def normalize_address(address: str) -> str:
+    # 全角・半角，空白の有無，大文字・小文字の揺れを吸収して同じ住所を同一視する
+    return "".join(unicodedata.normalize("NFKC", address).split()).lower()
 
 
 class StepPoint(baseCls):
@@ -54,7 +216,8 @@ class StepPoint(baseCls):
         }
 
     @staticmethod
-    def from_dict(source: dict):
+    def from_dict(source: dict, day: dt.date = None):
+        day = day or date.today()
         return StepPoint(
             source["id"],
             source["timestamp"],
@@ -63,8 +226,8 @@ class StepPoint(baseCls):
             source["lat"],
             source["lng"],
             source["staying_min"],
-            datetime.fromisoformat(str(date.today()) + "T" + source["start_time"]),
-            datetime.fromisoformat(str(date.today()) + "T" + source["end_time"]),
+            datetime.fromisoformat(str(day) + "T" + source["start_time"]),
+            datetime.fromisoformat(str(day) + "T" + source["end_time"]),
         )
 
     def __repr__(self) -> str:
@@ -74,24 +237,6 @@ class StepPoint(baseCls):
         )
 
 
-def get_route(step_points: List[StepPoint]):
-    result = gmaps.directions(
-        step_points[0].address,
-        step_points[-1].address,
-        waypoints=[sp.address for sp in step_points[1:-1]],
-        avoid="highways",
-    )
-    print(result)
-    return [
-        [step["start_location"]["lng"], step["start_location"]["lat"]]
-        for step in result[0]["legs"][0]["steps"]
-    ]
-
-
-def hash_client(ref):
-    return hash(ref)
-
-
 class PageId(Enum):
     TOP = auto()
     EDIT = auto()
@@ -106,3 +251,20 @@ class ActorId(IntEnum):
 
     def __str__(self):
         return ["追加", "更新", "削除"][int(self) - 1]
+
+
+class JobStatus(Enum):
+    QUEUED = auto()
+    RUNNING = auto()
+    DONE = auto()
+    FAILED = auto()
+    CANCELLED = auto()
+
+    def __str__(self):
+        return {
+            JobStatus.QUEUED: "待機中",
+            JobStatus.RUNNING: "探索中",
+            JobStatus.DONE: "完了",
+            JobStatus.FAILED: "失敗",
+            JobStatus.CANCELLED: "中断",
+        }[self]
@@ -0,0 +1,148 @@
+import threading
+from typing import Dict, List, Optional
+
+from tsptw.clients import get_db
+from tsptw.const import CONTACT_SNAPSHOT_TIMEOUT_SEC, FIRESTORE_BATCH_SIZE
+from tsptw.solution_cache import solution_cache
+from tsptw.metrics import metrics
+
+
+def legacy_document(email: str):
+    # 旧形式: 1つのドキュメントのフィールドに全経由地点を持つ
+    return get_db().collection(email).document("contact")
+
+
+def contact_collection(email: str):
+    # 新形式: 経由地点ごとに1ドキュメント
+    return legacy_document(email).collection("items")
+
+
+def commit_in_batches(writes: List[tuple]) -> None:
+    """(DocumentReference, dict or None)の列を書き込む．Noneは削除"""
+    db = get_db()
+    for i in range(0, len(writes), FIRESTORE_BATCH_SIZE):
+        batch = db.batch()
+        for ref, value in writes[i : i + FIRESTORE_BATCH_SIZE]:
+            if value is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, value)
+        batch.commit()
+        metrics.count("firestore_writes", len(writes[i : i + FIRESTORE_BATCH_SIZE]))
+
+
+def migrate(email: str) -> int:
+    """旧形式のcontactドキュメントを経由地点ごとのドキュメントに移す．移した件数を返す
+
+    途中で失敗しても，もう一度実行すれば同じ内容で上書きしてから旧形式を削除する
+    """
+    legacy = legacy_document(email)
+    doc = legacy.get()
+    metrics.count("firestore_reads")
+    if not doc.exists:
+        return 0
+    contacts = {k: v for k, v in doc.to_dict().items() if isinstance(v, dict)}
+    collection = contact_collection(email)
+    commit_in_batches([(collection.document(sp_id), contact) for sp_id, contact in contacts.items()])
+    legacy.delete()
+    metrics.count("firestore_writes")
+    return len(contacts)
+
+
+class ContactStore:
+    """ユーザーごとの経由地点のメモリ上のキャッシュ．全セッションで共有する
+
+    ユーザーごとに最初の読み込みでon_snapshotのリスナーを登録し，以降は他のセッションや端末での変更も
+    リスナー経由で反映する．画面の再描画では読み込みが発生しない
+    """
+
+    def __init__(self, timeout_sec: float = CONTACT_SNAPSHOT_TIMEOUT_SEC) -> None:
+        self.timeout_sec = timeout_sec
+        self._contacts: Dict[str, Dict[str, dict]] = {}
+        self._ready: Dict[str, threading.Event] = {}
+        self._watches = {}
+        self._lock = threading.Lock()
+
+    def get(self, email: str) -> Optional[Dict[str, dict]]:
+        """登録順(timestamp順)に並べた{id: 経由地点}．1件も無ければNone"""
+        self._watch(email)
+        if not self._ready[email].wait(self.timeout_sec):
+            # リスナーの初回同期が遅れている場合は直接読む．読めたら以降の再描画では待たない(変更はリスナーが反映する)
+            docs = list(contact_collection(email).stream())
+            metrics.count("firestore_reads", len(docs))
+            self._apply(email, {doc.id: doc.to_dict() for doc in docs})
+            self._ready[email].set()
+        with self._lock:
+            contacts = [dict(v) for v in self._contacts.get(email, {}).values()]
+        if not contacts:
+            return None
+        return {c["id"]: c for c in sorted(contacts, key=lambda c: c["timestamp"])}
+
+    def put(self, email: str, contact: dict) -> None:
+        contact_collection(email).document(contact["id"]).set(contact)
+        metrics.count("firestore_writes")
+        # リスナーの通知を待たずに，直後の再描画へ反映する
+        self._apply(email, {contact["id"]: contact})
+
+    def put_many(self, email: str, contacts: List[dict]) -> None:
+        collection = contact_collection(email)
+        commit_in_batches([(collection.document(c["id"]), c) for c in contacts])
+        self._apply(email, {c["id"]: c for c in contacts})
+
+    def delete(self, email: str, sp_id: str) -> None:
+        contact_collection(email).document(sp_id).delete()
+        metrics.count("firestore_writes")
+        self._apply(email, {sp_id: None})
+
+    def close(self) -> None:
+        with self._lock:
+            watches, self._watches = self._watches, {}
+        for watch in watches.values():
+            watch.unsubscribe()
+
+    def _watch(self, email: str) -> None:
+        with self._lock:
+            if email in self._watches:
+                return
+            self._ready[email] = threading.Event()
+            self._contacts[email] = {}
+            # 登録中に他のスレッドが重ねて登録しないよう先に印を付ける
+            self._watches[email] = None
+        try:
+            migrate(email)
+            watch = contact_collection(email).on_snapshot(
+                lambda docs, changes, read_time: self._on_snapshot(email, changes)
+            )
+        except Exception:
+            with self._lock:
+                del self._watches[email]
+            raise
+        with self._lock:
+            self._watches[email] = watch
+
+    def _on_snapshot(self, email: str, changes) -> None:
+        # リスナーのスレッドで呼ばれる．変更のあったドキュメントごとに読み取りが課金される
+        metrics.count("firestore_reads", len(changes))
+        updates = {}
+        for change in changes:
+            sp_id = change.document.id
+            if change.type.name == "REMOVED":
+                updates[sp_id] = None
+            else:
+                updates[sp_id] = change.document.to_dict()
+            if change.type.name != "ADDED":
+                solution_cache.invalidate(sp_id)
+        self._apply(email, updates)
+        self._ready[email].set()
+
+    def _apply(self, email: str, updates: Dict[str, Optional[dict]]) -> None:
+        with self._lock:
+            contacts = self._contacts.setdefault(email, {})
+            for sp_id, contact in updates.items():
+                if contact is None:
+                    contacts.pop(sp_id, None)
+                else:
+                    contacts[sp_id] = contact
+
+
+contact_store = ContactStore()
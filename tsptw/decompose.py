@@ -0,0 +1,232 @@
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List
+
+import numpy as np
+
+from tsptw.const import (
+    DECOMPOSE_WORKERS,
+    DECOMPOSE_CLUSTER_BUDGET_RATIO,
+    DECOMPOSE_TIME_WEIGHT_KM_PER_MIN,
+    DECOMPOSE_DEPOT_WEIGHT,
+    DECOMPOSE_KMEANS_ITERATIONS,
+    DECOMPOSE_BALANCE_SLACK,
+    DECOMPOSE_DROP_PENALTY,
+)
+from tsptw.model import solve_model
+from tsptw.jobs import InlineExecutor
+
+_pool = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    # Streamlitのスレッドを抱えたままforkしないようにspawnで起動し，プロセスは使い回す
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=DECOMPOSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def use_inline_pool() -> None:
+    """部分問題を呼び出し元のプロセスで順に解く．バッチのように問題ごとに既にプロセスを分けている場合に使う"""
+    global _pool
+    _pool = InlineExecutor()
+
+
+def pool_size() -> int:
+    """get_pool()で同時に解ける問題の数"""
+    return 1 if isinstance(get_pool(), InlineExecutor) else DECOMPOSE_WORKERS
+
+
+def features(data, nodes: List[int]) -> np.ndarray:
+    """地点の緯度経度[km]と，時間枠の中央[分]を距離に換算した値を並べる"""
+    lat = np.array([data["sp"][n].lat for n in nodes])
+    lng = np.array([data["sp"][n].lng for n in nodes])
+    lat0 = np.radians(np.mean([sp.lat for sp in data["sp"]]))
+    mid = np.array([sum(data["time_windows"][n]) / 2 for n in nodes])
+    return np.column_stack([lat * 111.0, lng * 111.0 * np.cos(lat0), mid * DECOMPOSE_TIME_WEIGHT_KM_PER_MIN])
+
+
+def cluster_stops(data, iterations: int = DECOMPOSE_KMEANS_ITERATIONS, seed: int = 0):
+    """経由地点を車両数のクラスタに分ける．クラスタiは車両iが担当する
+
+    地理的な近さと時間枠の近さによる容量制約付きk-means．勤務時間帯と時間枠が重ならない車両には割り当てず，
+    車両の出発地点から遠いクラスタほど割り当てにくくする．戻り値はクラスタの列と，どこにも割り当てられなかった地点
+    """
+    vehicles = data["vehicles"]
+    k = len(vehicles)
+    stops = [n for n in range(len(data["sp"])) if n not in data["depots"]]
+    x = features(data, stops)
+    depot_xy = features(data, [v["start"] for v in vehicles])[:, :2]
+
+    # 勤務時間帯と時間枠が重ならない組は割り当て不可
+    tw = np.array([data["time_windows"][n] for n in stops])
+    shift = np.array([v["time_window"] for v in vehicles])
+    compatible = (tw[:, None, 0] <= shift[None, :, 1]) & (tw[:, None, 1] >= shift[None, :, 0])
+    depot_cost = DECOMPOSE_DEPOT_WEIGHT * np.linalg.norm(x[:, None, :2] - depot_xy[None, :, :], axis=2)
+
+    # k-means++で初期化
+    rng = np.random.default_rng(seed)
+    centroids = [x[rng.integers(len(x))]]
+    for _ in range(1, k):
+        d2 = np.min([np.sum((x - c) ** 2, axis=1) for c in centroids], axis=0)
+        centroids.append(x[rng.choice(len(x), p=d2 / d2.sum())] if d2.sum() > 0 else x[rng.integers(len(x))])
+    centroids = np.array(centroids)
+
+    labels = np.full(len(stops), -1)
+    for _ in range(iterations):
+        cost = np.linalg.norm(x[:, None, :] - centroids[None, :, :], axis=2) + depot_cost
+        cost = np.where(compatible, cost, np.inf)
+        # 次善との差(後悔)が大きい地点から順に，容量の残っている最も近いクラスタへ割り当てる
+        ordered = np.sort(cost, axis=1)
+        regret = ordered[:, 1] - ordered[:, 0] if k > 1 else np.zeros(len(stops))
+        # 特定の車両に偏らないよう，平均より少し多い件数で打ち切る
+        balanced = int(np.ceil(len(stops) / k * DECOMPOSE_BALANCE_SLACK))
+        remaining = np.array([min(v["capacity"], balanced) for v in vehicles])
+        new_labels = np.full(len(stops), -1)
+        for i in np.argsort(-np.nan_to_num(regret, posinf=1e9)):
+            for j in np.argsort(cost[i]):
+                if remaining[j] > 0 and np.isfinite(cost[i, j]):
+                    new_labels[i] = j
+                    remaining[j] -= 1
+                    break
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+        for j in range(k):
+            if (labels == j).any():
+                centroids[j] = x[labels == j].mean(axis=0)
+    clusters = [[stops[i] for i in np.flatnonzero(labels == j)] for j in range(k)]
+    return clusters, [stops[i] for i in np.flatnonzero(labels < 0)]
+
+
+def subproblem(data, vehicle_id: int, stops: List[int]):
+    """車両vehicle_idがstopsだけを巡回するTSPTWのデータ．nodesは部分問題のノード番号から元のノード番号への対応"""
+    vehicle = data["vehicles"][vehicle_id]
+    depots = sorted({vehicle["start"], vehicle["end"]})
+    nodes = depots + stops
+    local = {n: i for i, n in enumerate(nodes)}
+    sub = {
+        "sp": tuple(data["sp"][n] for n in nodes),
+        "start_time": data["start_time"],
+        "depot_opening_time": data["depot_opening_time"],
+        "time_matrix": data["time_matrix"][np.ix_(nodes, nodes)],
+        "time_windows": [data["time_windows"][n] for n in nodes],
+        "pruned": data["pruned"][np.ix_(nodes, nodes)] if data.get("pruned") is not None else None,
+        "vehicles": [{**vehicle, "start": local[vehicle["start"]], "end": local[vehicle["end"]]}],
+        "depot": local[vehicle["start"]],
+        "depots": [local[n] for n in depots],
+        # 部分問題では回りきれない地点を落として残りの経路を返し，落とした地点は連結時に他の車両へ回す
+        "drop_penalty": DECOMPOSE_DROP_PENALTY,
+        "lateness_penalty": data.get("lateness_penalty"),
+    }
+    return sub, nodes
+
+
+def solve_cluster(sub, search_config: dict):
+    # プロセスプールで実行される
+    return solve_model(sub, search_config)
+
+
+def route_feasible(data, vehicle, route: List[int]) -> bool:
+    """待ち時間を許して時間枠・勤務時間帯の中で回りきれるか"""
+    matrix, windows = data["time_matrix"], data["time_windows"]
+    t = vehicle["time_window"][0]
+    prev = vehicle["start"]
+    for node in route:
+        t = max(t + matrix[prev, node], windows[node][0])
+        if t > windows[node][1]:
+            return False
+        prev = node
+    return t + matrix[prev, vehicle["end"]] <= vehicle["time_window"][1]
+
+
+def insert_cheapest(data, routes: List[List[int]], nodes: List[int]) -> List[List[int]]:
+    """nodesを，時間枠を満たしたまま所要時間の増分が最小となる車両・位置に挿入する
+
+    どこにも挿入できない地点は残したままにする(全体の求解で改めて扱う)
+    """
+    matrix = data["time_matrix"]
+    routes = [list(r) for r in routes]
+    for node in nodes:
+        best = None
+        for vehicle_id, route in enumerate(routes):
+            vehicle = data["vehicles"][vehicle_id]
+            if len(route) >= vehicle["capacity"]:
+                continue
+            tour = np.array([vehicle["start"]] + route + [vehicle["end"]])
+            delta = matrix[tour[:-1], node] + matrix[node, tour[1:]] - matrix[tour[:-1], tour[1:]]
+            for k in np.argsort(delta, kind="stable"):
+                if best is not None and delta[k] >= best[0]:
+                    break
+                if route_feasible(data, vehicle, route[:k] + [node] + route[k:]):
+                    best = (delta[k], vehicle_id, int(k))
+                    break
+        if best is not None:
+            routes[best[1]].insert(best[2], node)
+    return routes
+
+
+def solve_decomposed(data, search_config: dict, compare: bool = False, at_solution: Callable = None) -> dict:
+    """クラスタ分割 → クラスタごとのTSPTWを並列に求解 → 連結して全体を短時間改善
+
+    search_config["time_limit_sec"]のうちDECOMPOSE_CLUSTER_BUDGET_RATIOを部分問題に，残りを全体の改善に使う．
+    compareがTrueの場合は分割しない求解も同じ時間で行い，目的関数値の差を報告する
+    """
+    phases = {}
+    budget = search_config["time_limit_sec"]
+    deadline = time.time() + budget
+
+    started = time.time()
+    clusters, unassigned = cluster_stops(data)
+    phases["cluster"] = time.time() - started
+
+    started = time.time()
+    # ワーカー数よりクラスタが多い場合は順番待ちになるので，その分だけ1クラスタの時間を短くする
+    rounds = -(-sum(1 for c in clusters if c) // pool_size())
+    cluster_config = {**search_config, "time_limit_sec": budget * DECOMPOSE_CLUSTER_BUDGET_RATIO / max(rounds, 1)}
+    subs = [subproblem(data, vehicle_id, stops) for vehicle_id, stops in enumerate(clusters)]
+    futures = [
+        get_pool().submit(solve_cluster, sub, cluster_config) if stops else None
+        for (sub, _), stops in zip(subs, clusters)
+    ]
+    routes, failed = [], list(unassigned)
+    for (sub, nodes), stops, future in zip(subs, clusters, futures):
+        result = future.result() if future is not None else None
+        if result is None:
+            routes.append([])
+            failed += stops
+        else:
+            routes.append([nodes[stop["node"]] for stop in result["routes"][0]["stops"][1:]])
+            failed += [nodes[node] for node in result["dropped"]]
+    phases["subsolve"] = time.time() - started
+
+    # 解けなかったクラスタの地点は他の車両に挿入してから，全体を改善する
+    started = time.time()
+    routes = insert_cheapest(data, routes, failed)
+    # 初期解が時間枠を満たさず通常の探索にフォールバックした場合も，残りの時間だけで解く
+    remaining = max(deadline - time.time(), 0.1)
+    result = solve_model(
+        data,
+        {**search_config, "time_limit_sec": remaining},
+        initial_routes=routes,
+        initial_time_limit_sec=remaining,
+        at_solution=at_solution,
+    )
+    phases["improve"] = time.time() - started
+
+    stats = {"phases": phases, "clusters": [len(c) for c in clusters], "failed": len(failed)}
+    if compare:
+        started = time.time()
+        monolithic = solve_model(data, search_config)
+        phases["monolithic"] = time.time() - started
+        if monolithic is not None:
+            stats["monolithic_objective"] = monolithic["objective"]
+            if result is not None:
+                # 目的関数値が0(訪問先が無いなど)なら比は定まらない
+                gap = result["objective"] - monolithic["objective"]
+                stats["gap"] = gap / monolithic["objective"] if monolithic["objective"] else None
+    if result is not None:
+        result["stats"] = stats
+    return result
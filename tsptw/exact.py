@@ -0,0 +1,151 @@
+"""部分集合上の動的計画法による厳密解法
+
+1台・時間枠を守る問題で経由地点が少ない場合に，OR-Toolsの探索の代わりに使う．訪問済みの集合と最後の地点の組ごとに
+(移動時間の合計, 到着時刻)が他に劣らないラベルだけを残し，訪問件数の少ない順に1件ずつ延ばす．目的関数はtsptw.modelと
+同じく移動時間の合計と経路の所要時間の和で，最適解を返すか，どの順序でも時間枠を守れないことを示す
+"""
+from typing import List, Optional
+
+import numpy as np
+
+from tsptw.const import EXACT_MAX_STOPS
+from tsptw.preprocess import InfeasibleError, clock, shortest_paths
+
+
+def unsupported_reason(data, max_stops: int = EXACT_MAX_STOPS) -> Optional[str]:
+    """厳密解法で解けない問題ならその理由，解けるならNone"""
+    if len(data["vehicles"]) != 1:
+        return "車両が1台ではありません"
+    if data.get("lateness_penalty") is not None or data.get("drop_penalty") is not None:
+        return "時間帯を守れない訪問先を許しています"
+    if "time_matrices" in data:
+        return "時間帯ごとの移動時間を使っています"
+    stops = len(data["sp"]) - len(data["depots"])
+    if stops > max_stops:
+        return f"経由地点が{stops}件で，上限の{max_stops}件を超えています"
+    return None
+
+
+def pareto(key: np.ndarray, cost: np.ndarray, time: np.ndarray) -> np.ndarray:
+    """同じkeyの中で，移動時間の合計・到着時刻のいずれも他以上となるラベルを除いた添字"""
+    order = np.lexsort((cost, time, key))
+    key, cost = key[order], cost[order]
+    group = np.concatenate([[0], np.cumsum(key[1:] != key[:-1])])
+    # 到着時刻の早い順に並べ，それまでの最小の移動時間の合計を下回るものだけ残す．
+    # グループが変わるたびに十分小さくなるようずらし，累積最小がグループをまたがないようにする
+    shifted = cost - group * (int(cost.max()) + 1)
+    best = np.minimum.accumulate(shifted)
+    keep = np.concatenate([[True], shifted[1:] < best[:-1]])
+    return order[keep]
+
+
+def infeasible(data, message: str, stops: List[int] = ()) -> InfeasibleError:
+    return InfeasibleError([{"stops": [data["sp"][k].id for k in stops], "message": message}])
+
+
+def solve_exact(data) -> dict:
+    """data["time_matrix"]と時間枠で1台の経路を厳密に解く．解が無ければInfeasibleErrorを送出する
+
+    戻り値はtsptw.model.solve_modelと同じ形式に，"engine"と残したラベルの数"labels"を加える
+    """
+    matrix = np.asarray(data["time_matrix"], dtype=np.int64)
+    vehicle = data["vehicles"][0]
+    start, end = vehicle["start"], vehicle["end"]
+    stops = np.array([node for node in range(len(matrix)) if node not in data["depots"]], dtype=np.int64)
+    m = len(stops)
+    windows = np.array(data["time_windows"], dtype=np.int64).reshape(-1, 2)
+    a, b = windows[stops, 0], windows[stops, 1]
+    # tsptw.modelと同じく出発時刻は勤務開始時刻で，出発地点の時間帯に収まっていなければならない
+    departure = vehicle["time_window"][0]
+    limit = min(vehicle["time_window"][1], data["depot_opening_time"])
+
+    if not windows[start, 0] <= departure <= windows[start, 1]:
+        raise infeasible(data, f"出発時刻{clock(data, departure)}が{data['sp'][start].name}の時間帯外です", [start])
+    if m > vehicle["capacity"]:
+        raise infeasible(data, f"経由地点{m}件が1台の訪問件数の上限{vehicle['capacity']}件を超えています")
+
+    inner = matrix[np.ix_(stops, stops)]
+    allowed = ~np.eye(m, dtype=bool)
+    if data.get("pruned") is not None:
+        allowed &= ~np.asarray(data["pruned"])[np.ix_(stops, stops)]
+    # 待ち時間を無視した最短の移動時間．これで間に合わない地点が残るラベルは延ばしても解にならない
+    dist = shortest_paths(matrix)
+    to_stops, to_end = dist[np.ix_(stops, stops)], dist[stops, end]
+
+    def alive(mask, last, time):
+        unvisited = ((mask[:, None] >> np.arange(m)) & 1) == 0
+        late = unvisited & (time[:, None] + to_stops[last] > b[None, :])
+        return ~late.any(axis=1) & (time + to_end[last] <= limit)
+
+    # 訪問件数ごとのラベル．parentは1件少ない層での添字
+    first = np.maximum(departure + matrix[start, stops], a)
+    node = np.arange(m)
+    ok = (first <= b) & alive(1 << node, node, first)
+    layers = [
+        {
+            "mask": (1 << node)[ok],
+            "last": node[ok],
+            "time": first[ok],
+            "cost": matrix[start, stops][ok],
+            "parent": np.full(int(ok.sum()), -1),
+        }
+    ]
+    reached = int(np.bitwise_or.reduce(layers[0]["mask"])) if ok.any() else 0
+    labels = int(ok.sum())
+    for _ in range(m - 1):
+        prev = layers[-1]
+        if len(prev["last"]) == 0:
+            break
+        # すべてのラベルを未訪問のすべての地点へ延ばす
+        label, nxt = np.nonzero((((prev["mask"][:, None] >> node) & 1) == 0) & allowed[prev["last"]])
+        last = prev["last"][label]
+        time = np.maximum(prev["time"][label] + inner[last, nxt], a[nxt])
+        mask = prev["mask"][label] | (1 << nxt)
+        cost = prev["cost"][label] + inner[last, nxt]
+        ok = (time <= b[nxt]) & alive(mask, nxt, time)
+        label, nxt, time, mask, cost = label[ok], nxt[ok], time[ok], mask[ok], cost[ok]
+        keep = pareto(mask * m + nxt, cost, time) if len(nxt) else np.array([], dtype=np.int64)
+        layers.append({"mask": mask[keep], "last": nxt[keep], "time": time[keep], "cost": cost[keep], "parent": label[keep]})
+        reached |= int(np.bitwise_or.reduce(mask)) if len(mask) else 0
+        labels += len(keep)
+
+    if m == 0:
+        arrival = departure + matrix[start, end]
+        if arrival > limit:
+            raise infeasible(data, f"{data['sp'][end].name}に{clock(data, limit)}までに戻れません", [end])
+        # OR-Toolsと同じく，訪問先の無い車両には費用をかけない
+        objective, path, times, end_time = 0, [], [], int(arrival)
+    else:
+        final = layers[-1] if len(layers) == m else {"last": np.array([], dtype=np.int64)}
+        if len(final["last"]) == 0:
+            missed = [int(stops[k]) for k in range(m) if not reached >> k & 1]
+            if missed:
+                names = "，".join(data["sp"][k].name for k in missed)
+                message = f"{names}: どの順序で回っても訪問可能時間帯に間に合いません"
+            else:
+                message = f"{m}件の訪問先をすべて訪問可能時間帯に回る順序はありません"
+            raise infeasible(data, message, missed)
+        arrival = final["time"] + matrix[stops[final["last"]], end]
+        if (arrival > limit).all():
+            raise infeasible(data, f"すべて訪問すると{data['sp'][end].name}に{clock(data, limit)}までに戻れません", [end])
+        total = final["cost"] + matrix[stops[final["last"]], end] + arrival - departure
+        best = int(np.where(arrival <= limit, total, np.iinfo(np.int64).max).argmin())
+        objective, end_time = int(total[best]), int(arrival[best])
+        path, times = [], []
+        for layer in reversed(layers):
+            path.append(int(stops[layer["last"][best]]))
+            times.append(int(layer["time"][best]))
+            best = layer["parent"][best]
+        path.reverse()
+        times.reverse()
+
+    stops_out = [{"node": start, "min": departure, "max": departure}]
+    stops_out += [{"node": k, "min": t, "max": t} for k, t in zip(path, times)]
+    return {
+        "objective": objective,
+        "routes": [{"vehicle_id": 0, "stops": stops_out, "end": {"min": end_time, "max": end_time}}],
+        "dropped": [],
+        "late": [],
+        "engine": "exact",
+        "labels": labels,
+    }
@@ -0,0 +1,204 @@
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Sequence, Tuple
+
+from tsptw.cache import geocode_cache
+from tsptw.clients import get_gmaps
+from tsptw.metrics import metrics
+
+from tsptw.const import (
+    Location,
+    GEOCODE_CONCURRENCY,
+    GEOCODE_QPS,
+    GEOCODE_MAX_RETRIES,
+    normalize_address,
+    DIRECTIONS_CONCURRENCY,
+    DIRECTIONS_QPS,
+    DIRECTIONS_MAX_RETRIES,
+    DISTANCE_MATRIX_CONCURRENCY,
+    DISTANCE_MATRIX_QPS,
+    DISTANCE_MATRIX_ELEMENTS_PER_SEC,
+    DISTANCE_MATRIX_MAX_RETRIES,
+    GOOGLE_API_RETRY_BASE_DELAY_SEC,
+)
+
+RETRYABLE_STATUSES = ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR")
+
+
+class RateLimiter:
+    """リクエスト数と要素数(origins x destinations)の双方を制限するトークンバケット"""
+
+    def __init__(self, qps: float, elements_per_sec: float) -> None:
+        self.qps = qps
+        self.elements_per_sec = elements_per_sec
+        self._requests = qps
+        self._elements = elements_per_sec
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.qps, self._requests + elapsed * self.qps)
+        self._elements = min(self.elements_per_sec, self._elements + elapsed * self.elements_per_sec)
+
+    def acquire(self, elements: int = 1) -> None:
+        # バケット容量を超える要素数でも待てば通るように上限で丸める
+        elements = min(elements, self.elements_per_sec)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._elements >= elements:
+                    self._requests -= 1
+                    self._elements -= elements
+                    return
+                wait = max(
+                    (1 - self._requests) / self.qps,
+                    (elements - self._elements) / self.elements_per_sec,
+                )
+            time.sleep(wait)
+
+
+def is_retryable(e: Exception) -> bool:
+    # googlemapsはクライアントを作るまで読み込まない．呼ばれるのはAPI呼び出しの失敗後なので読み込み済み
+    from googlemaps.exceptions import ApiError, HTTPError, Timeout, TransportError
+
+    if isinstance(e, ApiError):
+        return e.status in RETRYABLE_STATUSES
+    if isinstance(e, HTTPError):
+        return e.status_code >= 500
+    return isinstance(e, (Timeout, TransportError))
+
+
+def with_retry(func: Callable, max_retries: int, base_delay: float = GOOGLE_API_RETRY_BASE_DELAY_SEC):
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            metrics.count("google_api_retries")
+            # 指数バックオフ + ジッタ
+            time.sleep(base_delay * (2**attempt) * (1 + random.random()))
+
+
+def fetch_distance_blocks(
+    blocks: Sequence[Tuple[List[Any], List[Any]]],
+    concurrency: int = DISTANCE_MATRIX_CONCURRENCY,
+    limiter: RateLimiter = None,
+    max_retries: int = DISTANCE_MATRIX_MAX_RETRIES,
+    departure_times: Sequence[Any] = None,
+) -> List[dict]:
+    """(origins, destinations)のブロック群を並列に問い合わせ，blocksと同じ順序でレスポンスを返す
+
+    departure_timesを与えるとブロックごとにその出発時刻の交通状況を考慮した値(duration_in_traffic)も返る
+    """
+    limiter = limiter or distance_matrix_limiter
+    departure_times = departure_times or [None] * len(blocks)
+
+    def fetch(args):
+        (origins, destinations), departure_time = args
+
+        def call():
+            limiter.acquire(len(origins) * len(destinations))
+            metrics.count("google_api_requests", api="distance_matrix")
+            metrics.count("distance_matrix_elements", len(origins) * len(destinations))
+            if departure_time is None:
+                return get_gmaps().distance_matrix(origins, destinations)
+            return get_gmaps().distance_matrix(origins, destinations, departure_time=departure_time)
+
+        return with_retry(call, max_retries)
+
+    args = list(zip(blocks, departure_times))
+    if len(args) <= 1 or concurrency <= 1:
+        return [fetch(a) for a in args]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(args))) as executor:
+        return list(executor.map(fetch, args))
+
+
+def geocode_many(
+    addresses: Sequence[str],
+    concurrency: int = GEOCODE_CONCURRENCY,
+    limiter: RateLimiter = None,
+    max_retries: int = GEOCODE_MAX_RETRIES,
+) -> List[Any]:
+    """住所を並列に緯度経度へ変換し，addressesと同じ順序で返す．変換できなかった住所は例外を返す
+
+    正規化した住所が同じものは1回だけ問い合わせ，結果はgeocode_cacheで全ユーザー共有する
+    """
+    limiter = limiter or geocode_limiter
+    keys = [normalize_address(address) for address in addresses]
+    cached = geocode_cache.get_many(keys)
+    metrics.count("geocode_cache_lookups", sum(key in cached for key in keys), result="hit")
+    metrics.count("geocode_cache_lookups", sum(key not in cached for key in keys), result="miss")
+    # キャッシュに無い住所だけを，最初に現れた表記で問い合わせる
+    missing = {}
+    for key, address in zip(keys, addresses):
+        if key not in cached:
+            missing.setdefault(key, address)
+
+    def fetch(address):
+        def call():
+            limiter.acquire()
+            metrics.count("google_api_requests", api="geocode")
+            return get_gmaps().geocode(address)
+
+        try:
+            results = with_retry(call, max_retries)
+        except Exception as e:
+            return e
+        if not results:
+            return LookupError(f"住所が見つかりません: {address}")
+        location = results[0]["geometry"]["location"]
+        return Location(location["lat"], location["lng"])
+
+    if len(missing) <= 1 or concurrency <= 1:
+        fetched = [fetch(address) for address in missing.values()]
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(missing))) as executor:
+            fetched = list(executor.map(fetch, missing.values()))
+    fetched = dict(zip(missing, fetched))
+    geocode_cache.put_many((key, loc) for key, loc in fetched.items() if isinstance(loc, Location))
+    return [cached[key] if key in cached else fetched[key] for key in keys]
+
+
+def geocode(address: str) -> Location:
+    location = geocode_many([address])[0]
+    if isinstance(location, Exception):
+        raise location
+    return location
+
+
+def fetch_directions(
+    routes: Sequence[List[Tuple[float, float]]],
+    concurrency: int = DIRECTIONS_CONCURRENCY,
+    limiter: RateLimiter = None,
+    max_retries: int = DIRECTIONS_MAX_RETRIES,
+) -> List[Any]:
+    """(lat, lng)の列ごとに，先頭から末尾まで順に経由する経路を並列に問い合わせる．失敗した経路は例外を返す"""
+    limiter = limiter or directions_limiter
+
+    def fetch(route):
+        def call():
+            limiter.acquire()
+            metrics.count("google_api_requests", api="directions")
+            return get_gmaps().directions(route[0], route[-1], waypoints=route[1:-1], avoid="highways")
+
+        try:
+            return with_retry(call, max_retries)
+        except Exception as e:
+            return e
+
+    if len(routes) <= 1 or concurrency <= 1:
+        return [fetch(route) for route in routes]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(routes))) as executor:
+        return list(executor.map(fetch, routes))
+
+
+# 同一プロセス内の全セッションで共有する
+distance_matrix_limiter = RateLimiter(DISTANCE_MATRIX_QPS, DISTANCE_MATRIX_ELEMENTS_PER_SEC)
+geocode_limiter = RateLimiter(GEOCODE_QPS, GEOCODE_QPS)
+directions_limiter = RateLimiter(DIRECTIONS_QPS, DIRECTIONS_QPS)
@@ -0,0 +1,69 @@
+from typing import List, Sequence
+
+from googlemaps.convert import decode_polyline, encode_polyline
+
+from tsptw.const import StepPoint, DIRECTIONS_MAX_LEGS
+from tsptw.cache import route_geometry_cache, location_key
+from tsptw.fetcher import fetch_directions
+from tsptw.metrics import metrics
+
+
+def leg_polyline(leg: dict) -> str:
+    """Directions APIの1区間(leg)の全stepの形状をつなげて1本のポリラインにする"""
+    points = []
+    for step in leg["steps"]:
+        decoded = decode_polyline(step["polyline"]["points"])
+        # stepの始点は直前のstepの終点と同じ
+        points += decoded[1:] if points else decoded
+    return encode_polyline(points)
+
+
+def split_runs(legs: List[int], max_legs: int) -> List[List[int]]:
+    """区間番号の列を，連続していてmax_legs以下の塊に分ける"""
+    runs = []
+    for i in legs:
+        if runs and runs[-1][-1] == i - 1 and len(runs[-1]) < max_legs:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+    return runs
+
+
+def route_paths(routes: Sequence[Sequence[StepPoint]], max_legs: int = DIRECTIONS_MAX_LEGS) -> List[List[List[float]]]:
+    """経路ごとに，地点を順に結ぶ道なりの形状を[lng, lat]の列で返す
+
+    区間(隣り合う地点のペア)ごとにキャッシュし，キャッシュに無い区間だけを全経路分まとめて並列に問い合わせる．
+    取得できなかった区間は直線で結ぶ
+    """
+    pairs = [
+        [(location_key(a.lat, a.lng), location_key(b.lat, b.lng)) for a, b in zip(route[:-1], route[1:])]
+        for route in routes
+    ]
+    polylines = route_geometry_cache.get_many([pair for route in pairs for pair in route if pair[0] != pair[1]])
+
+    requests, targets = [], []
+    for route, route_pairs in zip(routes, pairs):
+        missing = [i for i, pair in enumerate(route_pairs) if pair[0] != pair[1] and pair not in polylines]
+        for run in split_runs(missing, max_legs):
+            requests.append([(sp.lat, sp.lng) for sp in route[run[0] : run[-1] + 2]])
+            targets.append([route_pairs[i] for i in run])
+    fetched = []
+    with metrics.span("route_geometry.fetch"):
+        resps = fetch_directions(requests)
+    for run_pairs, resp in zip(targets, resps):
+        if isinstance(resp, Exception) or not resp:
+            continue
+        fetched += [(o, d, leg_polyline(leg)) for (o, d), leg in zip(run_pairs, resp[0]["legs"])]
+    route_geometry_cache.put_many(fetched)
+    polylines.update({(o, d): polyline for o, d, polyline in fetched})
+
+    paths = []
+    for route, route_pairs in zip(routes, pairs):
+        path = [[route[0].lng, route[0].lat]] if route else []
+        for sp, pair in zip(route[1:], route_pairs):
+            if pair in polylines:
+                path += [[p["lng"], p["lat"]] for p in decode_polyline(polylines[pair])]
+            else:
+                path.append([sp.lng, sp.lat])
+        paths.append(path)
+    return paths
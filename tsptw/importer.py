@@ -0,0 +1,189 @@
+import csv
+import io
+import json
+import time
+import uuid
+import datetime as dt
+from collections import namedtuple
+from typing import List, Tuple
+
+from tsptw.const import StepPoint, IMPORT_DEFAULT_START_TIME, IMPORT_DEFAULT_END_TIME, normalize_address
+from tsptw.contacts import contact_store
+from tsptw.fetcher import geocode_many
+
+# CSVの列名．画面の項目名でも受け付ける
+CSV_COLUMNS = {
+    "name": ("name", "名称"),
+    "address": ("address", "住所"),
+    "staying_min": ("staying_min", "見積診察時間", "見積診察時間[分]"),
+    "start_time": ("start_time", "訪問可能時間帯(始)"),
+    "end_time": ("end_time", "訪問可能時間帯(終)"),
+    "lat": ("lat", "緯度"),
+    "lng": ("lng", "経度"),
+}
+
+# lat/lngがNoneの場合は住所から求める．noteは登録時に報告する補足
+ImportRow = namedtuple(
+    "ImportRow", ["line", "name", "address", "staying_min", "start_time", "end_time", "lat", "lng", "note"]
+)
+
+
+def report_row(line: int, name: str, status: str, message: str = "") -> dict:
+    return {"line": line, "name": name, "status": status, "message": message}
+
+
+def parse_time(value: str) -> dt.time:
+    value = value.strip()
+    for fmt in ("%H:%M:%S", "%H:%M"):
+        try:
+            return dt.datetime.strptime(value, fmt).time()
+        except ValueError:
+            pass
+    raise ValueError(f"時刻の形式が正しくありません: {value}")
+
+
+def to_min(t: dt.time) -> int:
+    return t.hour * 60 + t.minute
+
+
+def from_min(minutes: int) -> dt.time:
+    return dt.time(minutes // 60, minutes % 60)
+
+
+def choose_window(allowed: List[List[str]], prohibited: List[List[str]]) -> Tuple[dt.time, dt.time, str]:
+    """訪問可能な時間帯の列から禁止時間帯を除き，最も長い時間帯を選ぶ(経由地点には1つしか登録できない)"""
+    windows = [(to_min(parse_time(s)), to_min(parse_time(e))) for s, e in allowed] or [
+        (to_min(parse_time(IMPORT_DEFAULT_START_TIME)), to_min(parse_time(IMPORT_DEFAULT_END_TIME)))
+    ]
+    for s, e in prohibited:
+        s, e = to_min(parse_time(s)), to_min(parse_time(e))
+        windows = [w for a, b in windows for w in ((a, min(b, s)), (max(a, e), b)) if w[0] < w[1]]
+    if not windows:
+        raise ValueError("訪問可能な時間帯がありません")
+    start, end = max(windows, key=lambda w: w[1] - w[0])
+    note = ""
+    if len(windows) > 1:
+        note = f"訪問可能時間帯は1つしか登録できないため，最も長い{from_min(start):%H:%M}〜{from_min(end):%H:%M}を登録しました"
+    return from_min(start), from_min(end), note
+
+
+def parse_csv(text: str) -> Tuple[List[ImportRow], List[dict]]:
+    reader = csv.DictReader(io.StringIO(text))
+    header = {name.strip(): name for name in reader.fieldnames or []}
+    columns = {key: next((header[a] for a in aliases if a in header), None) for key, aliases in CSV_COLUMNS.items()}
+    if columns["name"] is None or (columns["address"] is None and columns["lat"] is None):
+        return [], [report_row(1, "", "エラー", "名称と住所(または緯度・経度)の列が必要です")]
+
+    def get(record, key, default=""):
+        value = record.get(columns[key]) if columns[key] is not None else None
+        return (value or "").strip() or default
+
+    rows, report = [], []
+    for record in reader:
+        line = reader.line_num
+        name = get(record, "name")
+        try:
+            if not name:
+                raise ValueError("名称が空です")
+            lat, lng = get(record, "lat"), get(record, "lng")
+            address = get(record, "address")
+            if not address and not (lat and lng):
+                raise ValueError("住所が空です")
+            rows.append(
+                ImportRow(
+                    line,
+                    name,
+                    address or f"{lat},{lng}",
+                    int(get(record, "staying_min", "0")),
+                    parse_time(get(record, "start_time", IMPORT_DEFAULT_START_TIME)),
+                    parse_time(get(record, "end_time", IMPORT_DEFAULT_END_TIME)),
+                    float(lat) if lat and lng else None,
+                    float(lng) if lat and lng else None,
+                    "",
+                )
+            )
+        except ValueError as e:
+            report.append(report_row(line, name, "エラー", str(e)))
+    return rows, report
+
+
+def parse_sample_json(text: str) -> Tuple[List[ImportRow], List[dict]]:
+    """solver/work/sample.jsonの形式．xを経度，yを緯度とみなす"""
+    rows, report = [], []
+    for line, record in enumerate(json.loads(text), start=1):
+        name = record.get("name", "")
+        try:
+            start, end, note = choose_window(record.get("allowed_datetime", []), record.get("prohibited_datetime", []))
+            lat, lng = float(record["y"]), float(record["x"])
+            rows.append(
+                ImportRow(
+                    line,
+                    name,
+                    record.get("address") or f"{lat},{lng}",
+                    int(record.get("assumed_consumed_min", 0)),
+                    start,
+                    end,
+                    lat,
+                    lng,
+                    note,
+                )
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            report.append(report_row(line, name, "エラー", f"{type(e).__name__}: {e}"))
+    return rows, report
+
+
+def parse_file(filename: str, content: bytes) -> Tuple[List[ImportRow], List[dict]]:
+    # Excelで保存したCSVはShift_JISのことが多い
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = content.decode("cp932")
+    if filename.lower().endswith(".json"):
+        return parse_sample_json(text)
+    return parse_csv(text)
+
+
+def import_contacts(email: str, rows: List[ImportRow]) -> List[dict]:
+    """rowsを経由地点として一括登録し，行ごとの結果を返す
+
+    名称と住所が同じ経由地点は登録済みのものもファイル内のものも重複として飛ばす．
+    住所はまとめて並列にジオコーディングし(同じ住所は1回だけ)，書き込みもまとめて行う
+    """
+    existing = contact_store.get(email) or {}
+    seen = {(c["name"], normalize_address(c["address"])) for c in existing.values()}
+    report, targets = [], []
+    for row in rows:
+        key = (row.name, normalize_address(row.address))
+        if key in seen:
+            report.append(report_row(row.line, row.name, "スキップ", "同じ名称・住所の経由地点が登録済みです"))
+            continue
+        seen.add(key)
+        targets.append(row)
+
+    unlocated = [row for row in targets if row.lat is None]
+    locations = dict(zip((row.line for row in unlocated), geocode_many([row.address for row in unlocated])))
+
+    timestamp = int(time.time())
+    contacts = []
+    for row in targets:
+        location = (row.lat, row.lng) if row.lat is not None else locations[row.line]
+        if isinstance(location, Exception):
+            report.append(report_row(row.line, row.name, "エラー", f"住所を変換できません: {location}"))
+            continue
+        sp = StepPoint(
+            uuid.uuid4().hex,
+            timestamp,
+            row.name,
+            row.address,
+            location[0],
+            location[1],
+            row.staying_min,
+            row.start_time,
+            row.end_time,
+        )
+        contacts.append(sp.to_dict())
+        report.append(report_row(row.line, row.name, "追加", row.note))
+
+    contact_store.put_many(email, contacts)
+    return sorted(report, key=lambda r: r["line"])
@@ -1,17 +1,15 @@
 from .app import MultiPageApp
 from .const import PageId
-from .pages.base import BasePage
+from .pages.base import BasePage, LazyPage
 
 from .pages.top import TopPage
-from .pages.edit import EditPage
-from .pages.findroute import FindRoutePage
 
 
 def init_pages() -> list[BasePage]:
     pages = [
         TopPage(page_id=PageId.TOP, title="トップ"),
-        EditPage(page_id=PageId.EDIT, title="経由地点"),
-        FindRoutePage(page_id=PageId.FIND_ROUTE, title="ルート探索"),
+        LazyPage(page_id=PageId.EDIT, title="経由地点", module="tsptw.pages.edit", name="EditPage"),
+        LazyPage(page_id=PageId.FIND_ROUTE, title="ルート探索", module="tsptw.pages.findroute", name="FindRoutePage"),
     ]
     return pages
 
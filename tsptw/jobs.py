@@ -0,0 +1,114 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from tsptw.const import JobStatus, SOLVER_WORKERS, SOLVER_MAX_JOBS
+
+
+class Job:
+    """バックグラウンドで実行する求解ジョブ．進捗とキャンセル要求をワーカーと画面で共有する"""
+
+    def __init__(self) -> None:
+        self.id = uuid.uuid4().hex
+        self.status = JobStatus.QUEUED
+        self.progress = {}
+        self.messages: List[str] = []
+        self.result = None
+        self.error: Optional[Exception] = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    def report(self, **progress) -> None:
+        with self._lock:
+            self.progress = {**self.progress, **progress}
+
+    def log(self, message: str) -> None:
+        with self._lock:
+            self.messages.append(message)
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED, JobStatus.CANCELLED)
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class InlineExecutor(Executor):
+    """submitした時点で同じスレッドで実行する．テストやネットワークの無い環境向けの代替"""
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class JobQueue:
+    def __init__(self, executor: Executor = None, max_jobs: int = SOLVER_MAX_JOBS) -> None:
+        # 求解はワーカースレッドで行い，画面のスクリプトは完了を待たずに進み具合を描画する．同時に解く数はSOLVER_WORKERSまで
+        self.executor = executor or ThreadPoolExecutor(max_workers=SOLVER_WORKERS, thread_name_prefix="solver")
+        self.max_jobs = max_jobs
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Job:
+        """fn(*args, job=job, **kwargs)をワーカーで実行する"""
+        job = Job()
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> None:
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    def _run(self, job: Job, fn: Callable, args, kwargs) -> None:
+        if job.cancelled:
+            job.status = JobStatus.CANCELLED
+            return
+        job.started_at = time.time()
+        job.status = JobStatus.RUNNING
+        try:
+            job.result = fn(*args, job=job, **kwargs)
+            job.status = JobStatus.CANCELLED if job.cancelled else JobStatus.DONE
+        except Exception as e:
+            job.error = e
+            job.status = JobStatus.FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self) -> None:
+        # 終了済みのジョブを古い順に捨てて件数を抑える
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished]:
+            if len(self._jobs) <= self.max_jobs:
+                break
+            del self._jobs[job_id]
+
+
+job_queue = JobQueue()
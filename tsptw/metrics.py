@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+import functools
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+from tsptw.const import METRICS_ENABLED, METRICS_PATH, METRICS_PORT, TRACE_LOG_PATH
+
+_NOOP = contextlib.nullcontext()
+
+
+class Span:
+    def __init__(self, metrics: "Metrics", name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        stack = self.metrics._stack()
+        self.parent = stack[-1] if stack else None
+        self.trace_id = self.parent.trace_id if self.parent else uuid.uuid4().hex
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        self.metrics._stack().pop()
+        self.metrics._finish(self, elapsed, exc_type)
+        return False
+
+
+class Metrics:
+    """処理区間ごとの所要時間と，外部APIやFirestoreの呼び出し回数を集計する．全セッションで共有する
+
+    無効な場合はspan()が何もしないコンテキストを返し，count()もすぐに戻るので計測の負荷はほぼ無い．
+    有効な場合は最上位の区間が終わるたびにPrometheusのテキスト形式をpathに書き出し，trace_pathがあれば
+    区間ごとに1行のJSON(trace_idで1回の操作にまとまる)を追記する．プロセスプールのワーカーは自分の分しか
+    集計していないので，pathに書き出すのは親プロセスだけとする
+    """
+
+    def __init__(self, enabled: bool, path: str = "", trace_path: str = "") -> None:
+        self.enabled = enabled
+        self.path = path
+        self.trace_path = trace_path
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._spans: Dict[str, list] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def span(self, name: str):
+        if not self.enabled:
+            return _NOOP
+        return Span(self, name)
+
+    def timed(self, name: str):
+        """関数全体を区間nameとして計測するデコレータ"""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with Span(self, name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _finish(self, span: Span, elapsed: float, exc_type) -> None:
+        with self._lock:
+            stat = self._spans.setdefault(span.name, [0, 0.0, 0])  # 回数，合計秒，失敗回数
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] += exc_type is not None
+            if self.trace_path:
+                with open(self.trace_path, "a") as f:
+                    record = {
+                        "trace_id": span.trace_id,
+                        "span": span.name,
+                        "parent": span.parent.name if span.parent else None,
+                        "started_at": span.started_at,
+                        "duration_sec": elapsed,
+                        "error": exc_type.__name__ if exc_type else None,
+                    }
+                    f.write(json.dumps(record) + "\n")
+        if span.parent is None and self.path and multiprocessing.parent_process() is None:
+            self.write(self.path)
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式"""
+        with self._lock:
+            counters = dict(self._counters)
+            spans = {name: list(stat) for name, stat in self._spans.items()}
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE tsptw_{name}_total counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"tsptw_{name}_total{format_labels(labels)} {value:g}")
+        if spans:
+            lines.append("# TYPE tsptw_span_seconds summary")
+            for name, (count, total, _) in sorted(spans.items()):
+                lines.append(f'tsptw_span_seconds_sum{{span="{name}"}} {total:.6f}')
+                lines.append(f'tsptw_span_seconds_count{{span="{name}"}} {count}')
+            lines.append("# TYPE tsptw_span_errors_total counter")
+            for name, (_, _, errors) in sorted(spans.items()):
+                lines.append(f'tsptw_span_errors_total{{span="{name}"}} {errors}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # 読み取り側が書きかけのファイルを見ないように置き換える
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        """/metricsでPrometheusのテキスト形式を返すHTTPサーバーをデーモンスレッドで起動する"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+metrics = Metrics(METRICS_ENABLED, METRICS_PATH, TRACE_LOG_PATH)
+if METRICS_ENABLED and METRICS_PORT:
+    try:
+        metrics.serve(METRICS_PORT)
+    except OSError:
+        # Streamlitのスクリプト再実行などで既にポートを使っている場合
+        pass
@@ -0,0 +1,169 @@
+from typing import Callable, List
+
+import numpy as np
+from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+
+from tsptw.metrics import metrics
+
+
+def search_parameters(time_limit_sec: float, first_solution_strategy: str, metaheuristic: str):
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution_strategy)
+    search_parameters.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, metaheuristic)
+    search_parameters.time_limit.FromMilliseconds(int(time_limit_sec * 1000))
+    return search_parameters
+
+
+def build_routing_model(data):
+    # Create the routing index manager.
+    manager = pywrapcp.RoutingIndexManager(
+        len(data["time_matrix"]),
+        len(data["vehicles"]),
+        [v["start"] for v in data["vehicles"]],
+        [v["end"] for v in data["vehicles"]],
+    )
+
+    # Create Routing Model.
+    routing = pywrapcp.RoutingModel(manager)
+
+    # Register the transit matrix natively so that the search never calls back into Python.
+    transit_callback_index = routing.RegisterTransitMatrix(data["time_matrix"].tolist())
+
+    # Define cost of each arc.
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+
+    # Add Time Windows constraint.
+    dimension_name = "Time"
+    routing.AddDimension(
+        transit_callback_index,
+        data["depot_opening_time"],  # allow waiting time [min]
+        data["depot_opening_time"],  # maximum time [min] per vehicle until return
+        False,  # Each vehicle starts at its own shift start.
+        dimension_name,
+    )
+    time_dimension = routing.GetDimensionOrDie(dimension_name)
+    # Add time window constraints for each location except depots.
+    for location_idx, time_window in enumerate(data["time_windows"]):
+        if location_idx in data["depots"]:
+            continue
+        index = manager.NodeToIndex(location_idx)
+        if data.get("lateness_penalty") is not None:
+            # Soft time windows: arriving late is allowed at a penalty per minute.
+            time_dimension.CumulVar(index).SetMin(time_window[0])
+            time_dimension.SetCumulVarSoftUpperBound(index, time_window[1], data["lateness_penalty"])
+        else:
+            time_dimension.CumulVar(index).SetRange(time_window[0], time_window[1])
+    # Add time window constraints for each vehicle start node and the shift of each vehicle.
+    for vehicle_id, vehicle in enumerate(data["vehicles"]):
+        shift_start, shift_end = vehicle["time_window"]
+        depot_window = data["time_windows"][vehicle["start"]]
+        index = routing.Start(vehicle_id)
+        # 勤務開始時刻に出発する．出発地点の時間帯の外にある場合はtsptw.preprocessが先に報告する
+        time_dimension.CumulVar(index).SetRange(
+            max(shift_start, depot_window[0]), min(shift_start, depot_window[1])
+        )
+        time_dimension.CumulVar(routing.End(vehicle_id)).SetMax(shift_end)
+
+    # Remove arcs that can never satisfy the time windows (see tsptw.preprocess).
+    if data.get("pruned") is not None:
+        for i, j in zip(*np.nonzero(data["pruned"])):
+            routing.NextVar(manager.NodeToIndex(int(i))).RemoveValue(manager.NodeToIndex(int(j)))
+
+    # Limit the number of visits per vehicle.
+    demand_callback_index = routing.RegisterUnaryTransitVector(
+        [0 if node in data["depots"] else 1 for node in range(len(data["sp"]))]
+    )
+    routing.AddDimensionWithVehicleCapacity(
+        demand_callback_index,
+        0,  # null capacity slack
+        [v["capacity"] for v in data["vehicles"]],
+        True,  # start cumul to zero
+        "Visits",
+    )
+
+    # Allow dropping visits at a penalty when the data asks for it.
+    if data.get("drop_penalty") is not None:
+        for node in range(len(data["sp"])):
+            if node not in data["depots"]:
+                routing.AddDisjunction([manager.NodeToIndex(node)], data["drop_penalty"])
+
+    # Instantiate route start and end times to produce feasible times.
+    for i in range(len(data["vehicles"])):
+        routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.Start(i)))
+        routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.End(i)))
+
+    # Add SpanCost to minimize total wait time. See https://stackoverflow.com/questions/62411546/google-or-tools-minimize-total-time
+    time_dimension.SetSpanCostCoefficientForAllVehicles(1)
+    return manager, routing
+
+
+def extract_solution(data, manager, routing, solution) -> dict:
+    """OR-Toolsの解を，モデルが破棄された後も使える辞書に変換する"""
+    time_dimension = routing.GetDimensionOrDie("Time")
+    routes = []
+    for vehicle_id in range(len(data["vehicles"])):
+        index = routing.Start(vehicle_id)
+        stops = []
+        while not routing.IsEnd(index):
+            time_var = time_dimension.CumulVar(index)
+            stops.append({"node": manager.IndexToNode(index), "min": solution.Min(time_var), "max": solution.Max(time_var)})
+            index = solution.Value(routing.NextVar(index))
+        time_var = time_dimension.CumulVar(index)
+        routes.append(
+            {
+                "vehicle_id": vehicle_id,
+                "stops": stops,
+                "end": {"min": solution.Min(time_var), "max": solution.Max(time_var)},
+            }
+        )
+    visited = {stop["node"] for route in routes for stop in route["stops"]}
+    dropped = [node for node in range(len(data["sp"])) if node not in visited and node not in data["depots"]]
+    late = [
+        {"node": stop["node"], "minutes": stop["min"] - data["time_windows"][stop["node"]][1]}
+        for route in routes
+        for stop in route["stops"]
+        if stop["node"] not in data["depots"] and stop["min"] > data["time_windows"][stop["node"]][1]
+    ]
+    return {"objective": solution.ObjectiveValue(), "routes": routes, "dropped": dropped, "late": late}
+
+
+def solve_model(
+    data,
+    search_config: dict,
+    initial_routes: List[List[int]] = None,
+    initial_time_limit_sec: float = None,
+    at_solution: Callable = None,
+):
+    """dataのモデルを解く．解が無ければNone
+
+    initial_routesに車両ごとのノード番号の列(出発地点・最終地点を除く)を与えると，それを初期解として
+    initial_time_limit_secの間だけ改善する．時間枠を満たさない場合は通常の探索にフォールバックする
+    """
+    with metrics.span("model.build"):
+        manager, routing = build_routing_model(data)
+
+    # Setting first solution heuristic and metaheuristic with a wall-clock budget.
+    parameters = search_parameters(**search_config)
+
+    if at_solution is not None:
+        routing.AddAtSolutionCallback(at_solution(manager, routing))
+
+    initial_solution = None
+    if initial_routes is not None:
+        routing.CloseModelWithParameters(parameters)
+        initial_solution = routing.ReadAssignmentFromRoutes(
+            [[manager.NodeToIndex(node) for node in route] for route in initial_routes], True
+        )
+
+    # Solve the problem.
+    with metrics.span("model.search"):
+        if initial_solution:
+            if initial_time_limit_sec is not None:
+                parameters.time_limit.FromMilliseconds(int(initial_time_limit_sec * 1000))
+            solution = routing.SolveFromAssignmentWithParameters(initial_solution, parameters)
+        else:
+            solution = routing.SolveWithParameters(parameters)
+
+    if not solution:
+        return None
+    return extract_solution(data, manager, routing, solution)
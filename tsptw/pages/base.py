@@ -1,3 +1,5 @@
+import importlib
+
 from tsptw.const import PageId
 
 
@@ -8,3 +10,19 @@ class BasePage:
 
     def render(self) -> None:
         pass
+
+
+class LazyPage(BasePage):
+    """初めて描画するときにページのモジュールを読み込む．起動時に使わないページの依存(OR-Tools等)を読み込まない"""
+
+    def __init__(self, page_id: PageId, title: str, module: str, name: str) -> None:
+        super().__init__(page_id, title)
+        self.module = module
+        self.name = name
+        self._page = None
+
+    def render(self) -> None:
+        if self._page is None:
+            page_class = getattr(importlib.import_module(self.module), self.name)
+            self._page = page_class(page_id=PageId[self.page_id], title=self.title)
+        self._page.render()
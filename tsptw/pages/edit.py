@@ -4,29 +4,30 @@ import datetime as dt
 import streamlit as st
 
 from .base import BasePage
-from firebase_admin import firestore
-from google.cloud.firestore import DELETE_FIELD
-from tsptw.const import StepPoint, ActorId, PageId, create_datetime, geocode
+from tsptw.const import StepPoint, ActorId, PageId, Location, create_datetime, normalize_address
+from tsptw.contacts import contact_store
+from tsptw.fetcher import geocode
+from tsptw.importer import import_contacts, parse_file
+from tsptw.solution_cache import solution_cache
+from tsptw.metrics import metrics
 
 
 class EditPage(BasePage):
     def __init__(self, page_id: PageId, title: str) -> None:
         super().__init__(page_id, title)
 
+    @metrics.timed("edit.submit")
     def submit(
         self,
         actor: ActorId = ActorId.NONE,
         sp_id: str = "",
         timestamp: int = 0,
-        last_delete: bool = False,
     ):
         email = st.session_state["user_info"]["email"]
-        cont_ref = self.connect_to_database(email)
+        if actor in (ActorId.UPDATE, ActorId.DELETE):
+            solution_cache.invalidate(sp_id)
         if actor == ActorId.DELETE:
-            if last_delete:
-                cont_ref.delete()
-            else:
-                cont_ref.update({sp_id: DELETE_FIELD})
+            contact_store.delete(email, sp_id)
             return
 
         step_name = st.session_state["step_name"]
@@ -34,7 +35,12 @@ class EditPage(BasePage):
         staying_min = st.session_state["staying_min"]
         start_time = st.session_state["start_time"]
         end_time = st.session_state["end_time"]
-        loc = geocode(step_address)
+        # 住所が変わっていなければ登録済みの緯度経度を使う
+        current = (contact_store.get(email) or {}).get(sp_id) if actor == ActorId.UPDATE else None
+        if current is not None and normalize_address(current["address"]) == normalize_address(step_address):
+            loc = Location(current["lat"], current["lng"])
+        else:
+            loc = geocode(step_address)
 
         if actor == ActorId.ADD:
             sp = StepPoint(
@@ -48,7 +54,7 @@ class EditPage(BasePage):
                 start_time,
                 end_time,
             )
-            cont_ref.set({sp.id: sp.to_dict()}, merge=True)
+            contact_store.put(email, sp.to_dict())
 
         if actor == ActorId.UPDATE:
             sp = StepPoint(
@@ -66,18 +72,7 @@ class EditPage(BasePage):
             # ValueError: {'start_time': ,,,, 'staying_min': 0} is not in iterable
             # See: https://github.com/streamlit/streamlit/issues/3598
             # st.session_state["selected"] = sp.to_dict()
-            cont_ref.update({sp.id: sp.to_dict()})
-
-    def connect_to_database(self, key: str):
-        db = firestore.client()
-        return db.collection(key).document("contact")
-
-    def sort_data(self, ref):
-        doc = ref.get()
-        if doc.exists:
-            return {k: v for k, v in sorted(doc.to_dict().items(), key=lambda x: x[1]["timestamp"])}
-        else:
-            return None
+            contact_store.put(email, sp.to_dict())
 
     def render(self):
         st.title("経由地点 登録画面")
@@ -97,6 +92,7 @@ class EditPage(BasePage):
         ### 使い方
         - 追加する場合：「名称」「住所」「見積診察時間」「訪問可能時間(始)」「訪問可能時間(終)」を入力し，「追加」ボタンを押してください
         - 編集/削除する場合：上段の「編集/削除対象」で対象の経由地点を選択し，下段で「更新」/「削除」ボタンを押してください
+        - まとめて追加する場合：ページ下部の「一括登録」からCSVファイル(列：名称，住所，見積診察時間，訪問可能時間帯(始)，訪問可能時間帯(終))を登録してください
         """
         )
 
@@ -104,7 +100,8 @@ class EditPage(BasePage):
             st.warning("Please login to continue")
             return
 
-        contacts = self.sort_data(self.connect_to_database(st.session_state["user_info"]["email"]))
+        with metrics.span("edit.contacts"):
+            contacts = contact_store.get(st.session_state["user_info"]["email"])
 
         if contacts:
             st.selectbox(
@@ -153,7 +150,6 @@ class EditPage(BasePage):
                     "actor": ActorId.ADD,
                     "sp_id": st.session_state["selected"]["id"],
                     "timestamp": st.session_state["selected"]["timestamp"],
-                    "last_delete": contacts is not None and len(contacts) == 1,
                 },
             )
             if add_button:
@@ -166,7 +162,6 @@ class EditPage(BasePage):
                     "actor": ActorId.UPDATE,
                     "sp_id": st.session_state["selected"]["id"],
                     "timestamp": st.session_state["selected"]["timestamp"],
-                    "last_delete": contacts is not None and len(contacts) == 1,
                 },
             )
             if update_button:
@@ -179,7 +174,6 @@ class EditPage(BasePage):
                     "actor": ActorId.DELETE,
                     "sp_id": st.session_state["selected"]["id"],
                     "timestamp": st.session_state["selected"]["timestamp"],
-                    "last_delete": contacts is not None and len(contacts) == 1,
                 },
             )
             if del_button:
@@ -187,3 +181,17 @@ class EditPage(BasePage):
 
         if create_datetime(st.session_state.end_time) < create_datetime(st.session_state.start_time):
             st.warning(f"訪問可能時間帯(始){st.session_state.start_time}と訪問可能時間帯(終){st.session_state.end_time}が逆転しています")
+
+        with st.expander("一括登録"):
+            uploaded = st.file_uploader("CSV / JSONファイル", type=["csv", "json"], key="import_file")
+            if uploaded is not None and st.button("一括登録"):
+                with st.spinner("登録中..."):
+                    rows, report = parse_file(uploaded.name, uploaded.getvalue())
+                    report = sorted(
+                        report + import_contacts(st.session_state["user_info"]["email"], rows), key=lambda r: r["line"]
+                    )
+                added = sum(1 for r in report if r["status"] == "追加")
+                st.success(f"{added}件を追加しました")
+                st.dataframe(
+                    [{"行": r["line"], "名称": r["name"], "結果": r["status"], "詳細": r["message"]} for r in report]
+                )
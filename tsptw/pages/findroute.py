@@ -1,16 +1,44 @@
-import numpy as np
-# import pandas as pd
-# import pydeck as pdk
+import time
+import pydeck as pdk
 import datetime as dt
 from datetime import timedelta
 
 import streamlit as st
 from typing import List
-from tsptw.const import StepPoint, gmaps, PageId, create_datetime  #, get_route, hex_to_rgb
+from tsptw.const import (
+    StepPoint,
+    PageId,
+    TRAVEL_TIME_PROVIDER,
+    PROVIDER_LABELS,
+    SOLVER_TIME_LIMIT_SEC,
+    FIRST_SOLUTION_STRATEGIES,
+    LOCAL_SEARCH_METAHEURISTICS,
+    WARM_START_TIME_LIMIT_SEC,
+    SOLVER_ENGINES,
+    SOLVER_ENGINE_LABELS,
+    EXACT_MAX_STOPS,
+    PORTFOLIO_SIZE,
+    SOLVER_POLL_INTERVAL_SEC,
+    MAX_STEP_POINTS,
+    FLEET_MAX_STEP_POINTS,
+    FLEET_MAX_VEHICLES,
+    LARGE_INSTANCE_STEP_POINTS,
+    LARGE_INSTANCE_SEARCH_CONFIG,
+    TRAVEL_TIME_HOURS,
+    Vehicle,
+    Location,
+    JobStatus,
+    create_datetime,
+    hex_to_rgb,
+)
+from tsptw.providers import available_providers
+from tsptw.jobs import Job, job_queue
+from tsptw.preprocess import InfeasibleError
+from tsptw.contacts import contact_store
+from tsptw.geometry import route_paths
+from tsptw.metrics import metrics
+from tsptw.clients import get_db
 from .base import BasePage
-from firebase_admin import firestore
-
-from ortools.constraint_solver import pywrapcp  #, routing_enums_pb2
 
 
 class FindRoutePage(BasePage):
@@ -18,221 +46,272 @@ class FindRoutePage(BasePage):
         super().__init__(page_id, title)
         self.step_points_id = []
 
-    def create_time_matrix(self, *step_points: List[StepPoint]):
-        n = len(step_points)
-        arr = np.zeros((n, n))
-        items = [sp.address for sp in step_points]
-        split_arrs = np.array_split(items, (n // 10) + 1)
-        split_arrs_len = [len(a) for a in split_arrs]
-        for i, a in enumerate(split_arrs):
-            for j, b in enumerate(split_arrs):
-                resp = gmaps.distance_matrix(
-                    list(a),
-                    list(b),
-                )
-                for k, r in enumerate(resp["rows"]):
-                    for l, c in enumerate(r["elements"]):
-                        p, q = (
-                            sum(split_arrs_len[:i]) + k,
-                            sum(split_arrs_len[:j]) + l,
-                        )
-                        if p == q:
-                            continue
-                        arr[p][q] = step_points[p].staying_min + int(c["duration"]["value"] / 60)  # sec -> min
-        return arr.astype(int)
-
-    def diff_min(self, end: dt.datetime, start: dt.datetime) -> int:
-        return int((end - start).total_seconds() / 60)
-
-    def create_time_windows(self, start_time: dt.time, *step_points: List[StepPoint]):
-        # 滞在先の見積診察時間を，滞在可能時間帯から予め引いておく
-        return [
-            (
-                self.diff_min(sp.start_time, start_time),
-                self.diff_min(sp.end_time - timedelta(minutes=sp.staying_min), start_time),
-            )
-            for sp in step_points
-        ]
-
-    # Stores the data for the problem.
-    def create_data_model(self, start_time: dt.datetime, end_time: dt.datetime, *step_points: List[StepPoint]):
-        data = {}
-        data["sp"] = step_points
-        data["start_time"] = start_time
-        data["depot_opening_time"] = self.diff_min(end_time, start_time)
-        data["time_matrix"] = self.create_time_matrix(*step_points)
-        # https://developers.google.com/optimization/reference/python/constraint_solver/pywrapcp#intvar
-        data["time_windows"] = self.create_time_windows(start_time, *step_points)
-        data["vehicles"] = [
-            {"path_color": "#ed1c24"}
-        ]
-        data["depot"] = 0
-        return data
-
-    def print_solution(self, data, manager, routing, solution):
-        time_dimension = routing.GetDimensionOrDie("Time")
+    def print_solution(self, data, result):
         total_time = 0
-        for vehicle_id in range(len(data["vehicles"])):
-            index = routing.Start(vehicle_id)
+        drawn = []
+        for route in result["routes"]:
+            vehicle_id = route["vehicle_id"]
+            vehicle = data["vehicles"][vehicle_id]
             step_points = []
-            # st.write("Route for vehicle", vehicle_id)
-            while not routing.IsEnd(index):
-                sp = data["sp"][manager.IndexToNode(index)]
+            if len(data["vehicles"]) > 1:
+                st.subheader(f"車両{vehicle_id + 1}")
+                if len(route["stops"]) == 1:
+                    st.write("この車両の訪問先はありません")
+                    continue
+            for stop in route["stops"]:
+                sp = data["sp"][stop["node"]]
                 step_points += [sp]
-                time_var = time_dimension.CumulVar(index)
-                if solution.Min(time_var) == solution.Max(time_var):
+                if stop["min"] == stop["max"]:
                     st.write(
                         sp.name,
                         "さん宅．最短で",
-                        data["start_time"] + timedelta(minutes=solution.Min(time_var)),
+                        data["start_time"] + timedelta(minutes=stop["min"]),
                         "に到着することができます",
                     )
                 else:
                     st.write(
                         sp.name,
                         "さん宅．最短で",
-                        data["start_time"] + timedelta(minutes=solution.Min(time_var)),
+                        data["start_time"] + timedelta(minutes=stop["min"]),
                         "に到着することができますが，遅くとも",
-                        data["start_time"] + timedelta(minutes=solution.Max(time_var)),
+                        data["start_time"] + timedelta(minutes=stop["max"]),
                         "までには到着しなければなりません"
                     )
-                index = solution.Value(routing.NextVar(index))
-            time_var = time_dimension.CumulVar(index)
             st.write(
-                "最終地点(=出発地点) ",
-                data["sp"][0].name,
+                "最終地点(=出発地点) " if vehicle["start"] == vehicle["end"] else "最終地点 ",
+                data["sp"][vehicle["end"]].name,
                 "．最短で",
-                data["start_time"] + timedelta(minutes=solution.Min(time_var)),
+                data["start_time"] + timedelta(minutes=route["end"]["min"]),
                 "に到着することができます",
             )
-            st.write("この経路の所要時間: ", solution.Min(time_var), "分")
-            total_time += solution.Min(time_var)
-
-            # chunk_num = (len(step_points) // 10) + 1
-            # per_chunk = len(step_points) // chunk_num
-            # path = []
-            # for chunk_index in range(chunk_num):
-            #     path += get_route(step_points[per_chunk*chunk_index: per_chunk*(chunk_index+1)])
-
-            # df = pd.DataFrame([{
-            #     "color": data["vehicles"][vehicle_id]["path_color"], 
-            #     "path": path
-            # }])
-            # df["color"] = df["color"].apply(hex_to_rgb)
-
-            # layer = pdk.Layer(
-            #     type="PathLayer",
-            #     data=df,
-            #     pickable=True,
-            #     get_color="color",
-            #     width_scale=20,
-            #     width_min_pixels=2,
-            #     get_path="path",
-            #     get_width=5,
-            # )
-
-            # view_state = pdk.ViewState(
-            #     latitude=data["sp"][0].lat,
-            #     longitude=data["sp"][0].lng,
-            #     zoom=12,
-            #     # pitch=50,
-            # )
-
-            # st.pydeck_chart(
-            #     pdk.Deck(
-            #         layers=[layer], 
-            #         initial_view_state=view_state, 
-            #     )
-            # )
-
-        # st.write("全経路の所要時間: ", total_time, "分")
-
-    # Solve the VRP with time windows.
-    def solve_vrp(self, *step_points: List[StepPoint]):
-        assert len(step_points) > 0, "There is no step point."
-
-        # Instantiate the data problem.
-        start_time = create_datetime(st.session_state.start_time)
-        end_time = create_datetime("23:59:59", fromisoformat=True)
-
-        data = self.create_data_model(start_time, end_time, *step_points)
-
-        # Create the routing index manager.
-        manager = pywrapcp.RoutingIndexManager(len(data["time_matrix"]), len(data["vehicles"]), data["depot"])
-
-        # Create Routing Model.
-        routing = pywrapcp.RoutingModel(manager)
-
-        # Create and register a transit callback.
-        def time_callback(from_index, to_index):
-            """Returns the travel time between the two nodes."""
-            # Convert from routing variable Index to time matrix NodeIndex.
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            return data["time_matrix"][from_node][to_node]
-
-        transit_callback_index = routing.RegisterTransitCallback(time_callback)
-
-        # Define cost of each arc.
-        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-
-        # Add Time Windows constraint.
-        dimension_name = "Time"
-        routing.AddDimension(
-            transit_callback_index,
-            data["depot_opening_time"],  # allow waiting time [min]
-            data["depot_opening_time"],  # maximum time [min] per vehicle until return
-            True,  # Force start cumul to zero.
-            dimension_name,
+            st.write("この経路の所要時間: ", route["end"]["min"] - route["stops"][0]["min"], "分")
+            total_time += route["end"]["min"] - route["stops"][0]["min"]
+
+            drawn.append((vehicle, step_points + [data["sp"][vehicle["end"]]]))
+
+        if len(data["vehicles"]) > 1:
+            st.write("全経路の所要時間: ", total_time, "分")
+
+        for late in result.get("late", []):
+            sp = data["sp"][late["node"]]
+            st.warning(f"{sp.name}さん宅には訪問可能時間帯(終)より{late['minutes']}分遅れて到着します")
+        for node in result["dropped"]:
+            st.warning(f"{data['sp'][node].name}さん宅は時間内に回りきれないため，訪問を見送ります")
+
+        # 地図は道なりの形状の取得を待つので，文字の案内を表示してから描画する
+        if drawn:
+            self.render_map(data, drawn)
+
+    def render_map(self, data, drawn):
+        placeholder = st.empty()
+        placeholder.caption("経路の地図を読み込み中...")
+        paths = route_paths([step_points for _, step_points in drawn])
+        layer = pdk.Layer(
+            type="PathLayer",
+            data=[
+                {"color": hex_to_rgb(vehicle["path_color"]), "path": path}
+                for (vehicle, _), path in zip(drawn, paths)
+            ],
+            pickable=True,
+            get_color="color",
+            width_scale=20,
+            width_min_pixels=2,
+            get_path="path",
+            get_width=5,
         )
-        time_dimension = routing.GetDimensionOrDie(dimension_name)
-        # Add time window constraints for each location except depot.
-        for location_idx, time_window in enumerate(data["time_windows"]):
-            if location_idx == data["depot"]:
-                continue
-            index = manager.NodeToIndex(location_idx)
-            time_dimension.CumulVar(index).SetRange(time_window[0], time_window[1])
-        # Add time window constraints for each vehicle start node.
-        depot_idx = data["depot"]
-        for vehicle_id in range(len(data["vehicles"])):
-            index = routing.Start(vehicle_id)
-            time_dimension.CumulVar(index).SetRange(
-                data["time_windows"][depot_idx][0], data["time_windows"][depot_idx][1]
-            )
+        view_state = pdk.ViewState(
+            latitude=data["sp"][data["depot"]].lat,
+            longitude=data["sp"][data["depot"]].lng,
+            zoom=12,
+        )
+        placeholder.pydeck_chart(pdk.Deck(layers=[layer], initial_view_state=view_state))
+
+    def search_config(self) -> dict:
+        if st.session_state.get("fleet_mode", False) and st.session_state.get("large_instance_preset", True):
+            if len(st.session_state.get("step_points", [])) >= LARGE_INSTANCE_STEP_POINTS:
+                return dict(LARGE_INSTANCE_SEARCH_CONFIG)
+        return {
+            "time_limit_sec": st.session_state.get("time_limit_sec", SOLVER_TIME_LIMIT_SEC),
+            "first_solution_strategy": st.session_state.get("first_solution_strategy", FIRST_SOLUTION_STRATEGIES[0]),
+            "metaheuristic": st.session_state.get("metaheuristic", LOCAL_SEARCH_METAHEURISTICS[0]),
+        }
+
+    def solve_options(self) -> dict:
+        return {
+            "provider_name": st.session_state.get("travel_time_provider", TRAVEL_TIME_PROVIDER),
+            "warm_start": st.session_state.get("warm_start", True),
+            "warm_start_time_limit_sec": st.session_state.get("warm_start_time_limit_sec", WARM_START_TIME_LIMIT_SEC),
+            "decompose": st.session_state.get("fleet_mode", False) and st.session_state.get("decompose", False),
+            "compare_monolithic": st.session_state.get("compare_monolithic", False),
+            "soft_windows": st.session_state.get("soft_windows", False),
+            "time_dependent": st.session_state.get("time_dependent", False),
+            "engine": st.session_state.get("engine", SOLVER_ENGINES[0]),
+            "portfolio": st.session_state.get("portfolio", False),
+        }
+
+    def load_route(self, email: str):
+        doc = self.connect_to_history(email).get()
+        metrics.count("firestore_reads")
+        return doc.to_dict() if doc.exists else None
+
+    def save_route(self, email: str, data, result):
+        self.connect_to_history(email).set(
+            {
+                "timestamp": int(time.time()),
+                "depot": data["sp"][data["depot"]].id,
+                "route": [data["sp"][stop["node"]].id for stop in result["routes"][0]["stops"][1:]],
+            }
+        )
+        metrics.count("firestore_writes")
 
-        # Instantiate route start and end times to produce feasible times.
-        for i in range(len(data["vehicles"])):
-            routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.Start(i)))
-            routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.End(i)))
+    def run_job(self, email: str, start_time: dt.datetime, *step_points: List[StepPoint], job: Job, **kwargs):
+        """ワーカーで実行される．Streamlitには触れず，結果はjobを通して画面に渡す"""
+        last_route = None
+        if kwargs.pop("warm_start"):
+            last_route = self.load_route(email)
+        # OR-Toolsの読み込みは最初の探索まで遅らせる
+        from tsptw.solver import solve_vrp
 
-        # Add SpanCost to minimize total wait time. See https://stackoverflow.com/questions/62411546/google-or-tools-minimize-total-time
-        time_dimension.SetGlobalSpanCostCoefficient(1)
-        
-        # Setting first solution heuristic.
-        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-        # search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.AUTOMATIC
+        data, result = solve_vrp(start_time, *step_points, last_route=last_route, job=job, **kwargs)
+        if result is not None and not job.cancelled and len(data["vehicles"]) == 1:
+            self.save_route(email, data, result)
+        return {"data": data, "result": result}
 
-        # Solve the problem.
-        solution = routing.SolveWithParameters(search_parameters)
+    def run_replan_job(self, *args, job: Job, **kwargs):
+        from tsptw.solver import replan
 
-        # Print solution on console.
-        if solution:
-            self.print_solution(data, manager, routing, solution)
-        else:
-            st.error("Not found the solution")
-            st.warning(data["time_matrix"])  # for debug
-        return solution
+        data, result = replan(*args, job=job, **kwargs)
+        return {"data": data, "result": result}
 
-    def connect_to_database(self, key: str):
-        db = firestore.client()
-        return db.collection(key).document("contact")
+    def render_job(self, job: Job):
+        for message in job.messages:
+            st.caption(message)
 
-    def sort_data(self, ref):
-        doc = ref.get()
-        if doc.exists:
-            return {k: v for k, v in sorted(doc.to_dict().items(), key=lambda x: x[1]["timestamp"])}
-        else:
-            return None
+        if not job.finished:
+            col1, col2 = st.columns([6, 1])
+            progress = job.progress
+            text = f"{progress.get('phase', str(job.status))}({job.elapsed:.1f}秒)"
+            if "objective" in progress:
+                routes = " / ".join(" → ".join(route) for route in progress["routes"])
+                text += f": 目的関数値 {progress['objective']} / {routes}"
+            col1.info(text)
+            col2.button("中断", on_click=job_queue.cancel, args=(job.id,))
+            time.sleep(SOLVER_POLL_INTERVAL_SEC)
+            st.experimental_rerun()
+
+        if job.status == JobStatus.FAILED:
+            if isinstance(job.error, InfeasibleError):
+                st.error("次の訪問先の時間帯の条件を満たす経路はありません．訪問可能時間帯や見積診察時間を見直してください")
+                for conflict in job.error.conflicts:
+                    st.write(conflict["message"])
+            else:
+                st.error(job.error)
+            return
+        if job.status == JobStatus.CANCELLED:
+            # 順番待ちの間に中断されたジョブには結果が無い
+            if job.result is None:
+                st.warning(f"探索を開始する前に{str(job.status)}しました")
+                return
+            st.warning(f"探索を{str(job.status)}しました．それまでに見つかった最良の経路を表示します")
+
+        data, result = job.result["data"], job.result["result"]
+        if result is None:
+            st.error("Not found the solution")
+            st.warning(data["time_matrix"])  # for debug
+            return
+        with metrics.span("findroute.print_solution"):
+            self.print_solution(data, result)
+        if "stats" in result:
+            self.print_stats(result["stats"])
+        if len(data["vehicles"]) == 1 and not st.session_state.get("fleet_mode", False):
+            self.render_replan(data, result)
+
+    def print_stats(self, stats: dict):
+        phases = stats["phases"]
+        st.caption(
+            f"クラスタ分割: {phases['cluster']:.2f}秒 / 部分問題の求解: {phases['subsolve']:.2f}秒"
+            f" / 全体の改善: {phases['improve']:.2f}秒 / クラスタの大きさ: {stats['clusters']}"
+            + (f" / 解けなかった地点: {stats['failed']}件" if stats["failed"] else "")
+        )
+        if "monolithic" in phases:
+            text = f"分割しない求解: {phases['monolithic']:.2f}秒"
+            if stats.get("gap") is not None:
+                text += f" / 目的関数値 {stats['monolithic_objective']}，分割した解との差 {stats['gap']:+.1%}"
+            st.caption(text)
+
+    def render_replan(self, data, result):
+        with st.expander("予定が変わった場合(現在地から再計画)"):
+            depot, step_points = st.session_state.depot, st.session_state.step_points
+            completed = st.multiselect(
+                "訪問済みの地点", step_points, format_func=lambda contact: contact["name"], key="replan_completed"
+            )
+            col1, col2 = st.columns([6, 1])
+            here = col1.selectbox(
+                "現在地",
+                [depot] + step_points,
+                index=step_points.index(completed[-1]) + 1 if completed else 0,
+                format_func=lambda contact: contact["name"],
+            )
+            now = col2.time_input(
+                "現在時刻", dt.datetime.now().time().replace(second=0, microsecond=0), key="replan_time"
+            )
+            if st.button("残りの経路を再計画"):
+                done = {contact["id"] for contact in completed}
+                job = job_queue.submit(
+                    self.run_replan_job,
+                    Location(here["lat"], here["lng"]),
+                    create_datetime(now),
+                    StepPoint.from_dict(depot),
+                    *[StepPoint.from_dict(p) for p in step_points if p["id"] not in done],
+                    planned=[data["sp"][stop["node"]].id for stop in result["routes"][0]["stops"][1:]],
+                    provider_name=self.solve_options()["provider_name"],
+                    soft_windows=self.solve_options()["soft_windows"],
+                )
+                st.session_state["job_id"] = job.id
+                st.experimental_rerun()
+
+    def connect_to_history(self, key: str):
+        return get_db().collection(key).document("last_route")
+
+    def render_vehicles(self, contacts: dict, depot: dict) -> List[Vehicle]:
+        depot_index = list(contacts).index(depot["id"])
+        n_vehicles = st.number_input("車両数", value=2, min_value=1, max_value=FLEET_MAX_VEHICLES, key="n_vehicles")
+        vehicles = []
+        for i in range(n_vehicles):
+            col1, col2, col3, col4, col5 = st.columns([3, 3, 1, 1, 1])
+            start = col1.selectbox(
+                f"車両{i + 1} 出発地点",
+                list(contacts.values()),
+                index=depot_index,
+                format_func=lambda contact: contact["name"],
+                key=f"vehicle_{i}_start",
+            )
+            end = col2.selectbox(
+                f"車両{i + 1} 最終地点",
+                list(contacts.values()),
+                index=depot_index,
+                format_func=lambda contact: contact["name"],
+                key=f"vehicle_{i}_end",
+            )
+            shift_start = col3.time_input("勤務開始", st.session_state.start_time, key=f"vehicle_{i}_shift_start")
+            shift_end = col4.time_input("勤務終了", dt.time.fromisoformat("19:00:00"), key=f"vehicle_{i}_shift_end")
+            capacity = col5.number_input(
+                "最大訪問件数",
+                value=MAX_STEP_POINTS,
+                min_value=1,
+                max_value=FLEET_MAX_STEP_POINTS,
+                key=f"vehicle_{i}_capacity",
+            )
+            vehicles.append(
+                Vehicle(
+                    StepPoint.from_dict(start),
+                    StepPoint.from_dict(end),
+                    create_datetime(shift_start),
+                    create_datetime(shift_end),
+                    capacity,
+                )
+            )
+        return vehicles
 
     def render(self):
         st.title("ルート探索")
@@ -243,11 +322,13 @@ class FindRoutePage(BasePage):
         ### 使い方
          1. 最初に「出発地点」および「出発時刻」を指定してください
          1. 経由地点（出発地点は除く）を複数追加してください（最大25箇所）
+         1. 複数の車両で分担する場合は「複数車両で計画する」を選び，車両ごとに出発地点・最終地点・勤務時間帯・最大訪問件数を指定してください（最大300箇所）
          1. 途中で出発地点を経由する場合は経由地点に新規追加してください
 
             例：出発地点で昼休みを取る場合「お昼休み」という経由地点を新規追加．滞在時間帯は昼休みを開始しても良い時間帯(例えば11:30-13:30)．見積診察時間はそのまま昼休憩の時間と読み替える
          1. 「ルート探索」ボタンを実行してください
-         1. ```CP Solver fail``` エラーが出た場合は見積診察時間の条件が厳しすぎることが考えられます．緩和して再度お試しください．
+         1. 途中で予定が変わった場合は，経路の下の「予定が変わった場合(現在地から再計画)」で訪問済みの地点・現在地・現在時刻を指定すると，残りの経路を求め直します
+         1. 経路が見つからない場合は訪問可能時間帯や見積診察時間の条件が厳しすぎることが考えられます．緩和して再度お試しいただくか，「探索の設定」の「時間帯を守れない訪問先があっても経路を求める」を選んでください．遅れて到着する訪問先や訪問を見送る訪問先とあわせて経路を表示します．
         """
         )
 
@@ -258,7 +339,8 @@ class FindRoutePage(BasePage):
         if "step_points" in st.session_state and st.session_state["step_points"]:
             self.step_points_id = [pt['id'] for pt in st.session_state["step_points"]]
 
-        contacts = self.sort_data(self.connect_to_database(st.session_state["user_info"]["email"]))
+        with metrics.span("findroute.contacts"):
+            contacts = contact_store.get(st.session_state["user_info"]["email"])
 
         if contacts:
             col1, col2 = st.columns([6, 1])
@@ -270,13 +352,69 @@ class FindRoutePage(BasePage):
             )
             col2.time_input("出発時刻", dt.time.fromisoformat("09:00:00"), key="start_time")
 
+            fleet_mode = st.checkbox("複数車両で計画する", key="fleet_mode")
+            vehicles = self.render_vehicles(contacts, depot) if fleet_mode else None
+
+            with st.expander("探索の設定"):
+                col3, col4, col5 = st.columns(3)
+                col3.number_input(
+                    "探索時間[秒]", value=SOLVER_TIME_LIMIT_SEC, min_value=1, max_value=600, key="time_limit_sec"
+                )
+                col4.selectbox("初期解の構築方法", FIRST_SOLUTION_STRATEGIES, key="first_solution_strategy")
+                col5.selectbox("改善方法(メタヒューリスティクス)", LOCAL_SEARCH_METAHEURISTICS, key="metaheuristic")
+                col6, col7, col10 = st.columns(3)
+                col6.checkbox("前回の経路を初期解として使う", value=True, key="warm_start")
+                col7.number_input(
+                    "前回の経路からの探索時間[秒]",
+                    value=WARM_START_TIME_LIMIT_SEC,
+                    min_value=1,
+                    max_value=60,
+                    key="warm_start_time_limit_sec",
+                )
+                col10.checkbox("時間帯を守れない訪問先があっても経路を求める", key="soft_windows")
+                st.selectbox(
+                    f"求解方法(1台で経由地点が{EXACT_MAX_STOPS}箇所以下なら厳密解法で最適解を求められます)",
+                    SOLVER_ENGINES,
+                    format_func=lambda name: SOLVER_ENGINE_LABELS[name],
+                    key="engine",
+                )
+                st.checkbox(
+                    f"初期解の構築方法や改善方法の異なる{PORTFOLIO_SIZE}通りの設定を並列に試し，最も良い経路を使う",
+                    key="portfolio",
+                )
+                if TRAVEL_TIME_HOURS:
+                    st.checkbox(
+                        "出発時刻の時間帯ごとの渋滞を考慮する(時間帯の区切り: "
+                        + "，".join(f"{h}時" for h in TRAVEL_TIME_HOURS)
+                        + ")",
+                        key="time_dependent",
+                    )
+                if fleet_mode:
+                    st.checkbox(
+                        f"経由地点が{LARGE_INSTANCE_STEP_POINTS}箇所以上の場合は大規模向けの設定を使う",
+                        value=True,
+                        key="large_instance_preset",
+                    )
+                    col8, col9, _ = st.columns(3)
+                    col8.checkbox("地域ごとに分割して並列に解く(大規模向け)", key="decompose")
+                    col9.checkbox("分割しない場合の解と比較する", key="compare_monolithic")
+
+            providers = available_providers()
+            st.selectbox(
+                "移動時間の取得元",
+                providers,
+                index=providers.index(TRAVEL_TIME_PROVIDER) if TRAVEL_TIME_PROVIDER in providers else 0,
+                format_func=lambda name: PROVIDER_LABELS[name],
+                key="travel_time_provider",
+            )
+
             step_points = st.multiselect(
                 "経由地点",
                 contacts.values(),
                 default=[contacts[id] for id in self.step_points_id],
                 format_func=lambda contact: contact["name"],
                 key="step_points",
-                disabled=len(self.step_points_id) > 25,
+                disabled=len(self.step_points_id) > (FLEET_MAX_STEP_POINTS if fleet_mode else MAX_STEP_POINTS),
             )
 
             if st.session_state.depot["id"] in [pt["id"] for pt in st.session_state.step_points]:
@@ -289,13 +427,29 @@ class FindRoutePage(BasePage):
                     f"出発地点の訪問可能時間帯(始){st.session_state.depot['start_time']}よりも出発時刻{st.session_state.start_time}が早いです．出発時刻を見直すか出発地点を見直してください．"
                 )
 
-            all_points = [StepPoint.from_dict(p) for p in [depot] + step_points]
+            if fleet_mode:
+                all_points = [StepPoint.from_dict(p) for p in step_points]
+                start_time = min(v.shift_start for v in vehicles)
+            else:
+                all_points = [StepPoint.from_dict(p) for p in [depot] + step_points]
+                start_time = create_datetime(st.session_state.start_time)
 
             if st.button("ルート探索 🔍"):
-                self.solve_vrp(*all_points)
-            # hist_ref.set(
-            #     {"timestamp": int(time.time()), "step_points": [sp.to_dict() for sp in step_points if sp is not None]}
-            # )
+                metrics.count("solve_requests")
+                job = job_queue.submit(
+                    self.run_job,
+                    st.session_state["user_info"]["email"],
+                    start_time,
+                    *all_points,
+                    search_config=self.search_config(),
+                    vehicles=vehicles,
+                    **self.solve_options(),
+                )
+                st.session_state["job_id"] = job.id
+
+            job = job_queue.get(st.session_state.get("job_id"))
+            if job is not None:
+                self.render_job(job)
 
         else:
             st.warning("1件も見つかりませんでした．「経由地点」ページにて経由地点の登録を先に実施してください")
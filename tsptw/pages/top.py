@@ -16,6 +16,7 @@ class TopPage(BasePage):
              - 患者宅での訪問可能時間帯（例：10時〜12時など）の指定が可能！
              - 診察予定時間の設定で精度アップ！
              - 最大25箇所の経由地点に対応！
+             - 複数車両での分担にも対応！
 
             ### 使い方
              1. 左メニューからGoogleアカウントでログイン
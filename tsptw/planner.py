@@ -0,0 +1,66 @@
+import math
+from typing import List, Set, Tuple
+
+import numpy as np
+
+from tsptw.const import (
+    DISTANCE_MATRIX_MAX_ORIGINS,
+    DISTANCE_MATRIX_MAX_DESTINATIONS,
+    DISTANCE_MATRIX_MAX_ELEMENTS,
+    DISTANCE_MATRIX_CALL_COST_ELEMENTS,
+)
+
+
+class RequestPlan:
+    """Distance Matrix APIへの問い合わせ計画．blocksは(origins, destinations)のインデックスの組"""
+
+    def __init__(self, blocks: List[Tuple[List[int], List[int]]]) -> None:
+        self.blocks = blocks
+
+    @property
+    def calls(self) -> int:
+        return len(self.blocks)
+
+    @property
+    def elements(self) -> int:
+        return sum(len(a) * len(b) for a, b in self.blocks)
+
+    def cost(self, call_cost: float = DISTANCE_MATRIX_CALL_COST_ELEMENTS) -> float:
+        return self.elements + call_cost * self.calls
+
+    def __repr__(self) -> str:
+        return f"RequestPlan(calls={self.calls}, elements={self.elements})"
+
+
+def tile(missing: np.ndarray, rows: int, cols: int) -> RequestPlan:
+    """origins をrows個ずつ，destinationsをcols個ずつに分割し，不要な行と列を除いたブロックを作る"""
+    n_orig, n_dest = missing.shape
+    blocks = []
+    for a in np.array_split(np.arange(n_orig), math.ceil(n_orig / rows)):
+        for b in np.array_split(np.arange(n_dest), math.ceil(n_dest / cols)):
+            sub = missing[np.ix_(a, b)]
+            used_rows = a[sub.any(axis=1)]
+            used_cols = b[sub.any(axis=0)]
+            if len(used_rows) > 0:
+                blocks.append((used_rows.tolist(), used_cols.tolist()))
+    return RequestPlan(blocks)
+
+
+def plan_requests(
+    missing: np.ndarray,
+    max_origins: int = DISTANCE_MATRIX_MAX_ORIGINS,
+    max_destinations: int = DISTANCE_MATRIX_MAX_DESTINATIONS,
+    max_elements: int = DISTANCE_MATRIX_MAX_ELEMENTS,
+    call_cost: float = DISTANCE_MATRIX_CALL_COST_ELEMENTS,
+) -> RequestPlan:
+    """missing[p][q]がTrueのペアを全て含み，課金要素数と往復回数の重み付き和が最小となるブロック形状を選ぶ"""
+    if not missing.any():
+        return RequestPlan([])
+    n_orig, n_dest = missing.shape
+    shapes: Set[Tuple[int, int]] = set()
+    for rows in range(1, min(max_origins, n_orig) + 1):
+        cols = min(max_destinations, max_elements // rows, n_dest)
+        if cols > 0:
+            shapes.add((rows, cols))
+    plans = [tile(missing, rows, cols) for rows, cols in sorted(shapes)]
+    return min(plans, key=lambda plan: (plan.cost(call_cost), plan.calls))
@@ -0,0 +1,182 @@
+"""探索設定のポートフォリオ
+
+初期解の構築方法・メタヒューリスティクス・乱数の種の異なる探索設定をプロセスプールで同時に解き，目的関数値の最も良い解を
+使う．OR-Toolsの経路探索には乱数の種が無いため，種は経由地点の番号の並べ替えとして与え，同点の扱いや近傍を調べる順序を変える．
+設定ごとの結果は解の"portfolio"に残し，勝った設定をメトリクスに数え，PORTFOLIO_LOG_PATHがあればJSONで追記する
+"""
+import json
+import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from tsptw.const import PORTFOLIO_SIZE, PORTFOLIO_CANDIDATES, PORTFOLIO_LOG_PATH, SOLVER_POLL_INTERVAL_SEC
+from tsptw.model import solve_model
+from tsptw.decompose import get_pool, pool_size
+from tsptw.jobs import Job
+from tsptw.metrics import metrics
+
+# ワーカーに渡すデータ．時間帯ごとの移動時間などモデルの構築に使わないものは送らない
+MODEL_KEYS = [
+    "sp",
+    "start_time",
+    "depot_opening_time",
+    "time_matrix",
+    "time_windows",
+    "pruned",
+    "vehicles",
+    "depot",
+    "depots",
+    "lateness_penalty",
+    "drop_penalty",
+]
+
+_log_lock = threading.Lock()
+
+
+def portfolio_configs(search_config: dict, size: int = PORTFOLIO_SIZE) -> List[dict]:
+    """search_configを先頭に，PORTFOLIO_CANDIDATESの組を順に並べる．組を使い切ったら乱数の種を変えて繰り返す"""
+    configs = [{**search_config, "seed": 0}]
+    i = 0
+    while len(configs) < size:
+        strategy, metaheuristic = PORTFOLIO_CANDIDATES[i % len(PORTFOLIO_CANDIDATES)]
+        config = {
+            **search_config,
+            "first_solution_strategy": strategy,
+            "metaheuristic": metaheuristic,
+            "seed": i // len(PORTFOLIO_CANDIDATES),
+        }
+        if config not in configs:
+            configs.append(config)
+        i += 1
+    return configs
+
+
+def label(config: dict) -> str:
+    return f"{config['first_solution_strategy']}/{config['metaheuristic']}(種{config['seed']})"
+
+
+def shuffled(data, seed: int):
+    """経由地点の番号を乱数の種で並べ替えたデータと，新しい番号から元の番号への対応．出発地点・最終地点は動かさない"""
+    nodes = np.arange(len(data["sp"]))
+    if seed:
+        stops = np.array([k for k in nodes if k not in data["depots"]], dtype=np.int64)
+        nodes[stops] = np.random.default_rng(seed).permutation(stops)
+    sub = {
+        **data,
+        "sp": tuple(data["sp"][k] for k in nodes),
+        "time_matrix": data["time_matrix"][np.ix_(nodes, nodes)],
+        "time_windows": [data["time_windows"][k] for k in nodes],
+    }
+    if data.get("pruned") is not None:
+        sub["pruned"] = data["pruned"][np.ix_(nodes, nodes)]
+    return sub, nodes
+
+
+def restore(result: dict, nodes: np.ndarray) -> dict:
+    """並べ替えたデータの解を元の番号に戻す"""
+    for route in result["routes"]:
+        for stop in route["stops"]:
+            stop["node"] = int(nodes[stop["node"]])
+    result["dropped"] = [int(nodes[node]) for node in result["dropped"]]
+    for late in result["late"]:
+        late["node"] = int(nodes[late["node"]])
+    return result
+
+
+def solve_config(data, config: dict, initial_routes: List[List[int]] = None, initial_time_limit_sec: float = None):
+    # プロセスプールで実行される．ワーカーの起動を待つ時間を含めないよう，探索時間はここから数える
+    started = time.time()
+    sub, nodes = shuffled(data, config["seed"])
+    search_config = {key: value for key, value in config.items() if key != "seed"}
+    if initial_time_limit_sec is not None:
+        initial_time_limit_sec = min(initial_time_limit_sec, search_config["time_limit_sec"])
+    result = solve_model(sub, search_config, initial_routes=initial_routes, initial_time_limit_sec=initial_time_limit_sec)
+    record = {"sec": time.time() - started}
+    if result is None:
+        return {**record, "status": "not_found"}, None
+    return {**record, "status": "ok", "objective": result["objective"]}, restore(result, nodes)
+
+
+def route_names(data, result: dict) -> List[List[str]]:
+    routes = []
+    for route in result["routes"]:
+        if len(route["stops"]) > 1:
+            end = data["vehicles"][route["vehicle_id"]]["end"]
+            routes.append([data["sp"][stop["node"]].name for stop in route["stops"]] + [data["sp"][end].name])
+    return routes
+
+
+def write_log(data, search_config: dict, records: List[dict]) -> None:
+    with _log_lock, open(PORTFOLIO_LOG_PATH, "a") as f:
+        record = {
+            "created_at": time.time(),
+            "stops": len(data["sp"]) - len(data["depots"]),
+            "vehicles": len(data["vehicles"]),
+            "time_limit_sec": search_config["time_limit_sec"],
+            "configs": records,
+        }
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def solve_portfolio(
+    data,
+    search_config: dict,
+    size: int = PORTFOLIO_SIZE,
+    initial_routes: List[List[int]] = None,
+    initial_time_limit_sec: float = None,
+    job: Job = None,
+) -> Tuple[Optional[dict], List[dict]]:
+    """portfolio_configsの各設定で同時に解き，最も目的関数値の小さい解と設定ごとの結果を返す．どの設定でも解が無ければ解はNone
+
+    設定がワーカー数より多い場合は，順番待ちの回数で割って全体がsearch_config["time_limit_sec"]に収まるようにする．
+    initial_routesは利用者の設定(先頭)だけに初期解として与え，initial_time_limit_secの間だけ改善する．
+    jobが中断された場合は，それまでに終わった設定の中の最良解を返す．順番待ちの設定は取り消し，実行中の設定は時間切れまで走る
+    """
+    job = job or Job()
+    configs = portfolio_configs(search_config, size)
+    budget = search_config["time_limit_sec"]
+    rounds = -(-len(configs) // pool_size())
+    payload = {key: data[key] for key in MODEL_KEYS if key in data}
+
+    futures = {}
+    for i, config in enumerate(configs):
+        warm = (initial_routes, initial_time_limit_sec) if i == 0 else (None, None)
+        future = get_pool().submit(solve_config, payload, {**config, "time_limit_sec": budget / rounds}, *warm)
+        futures[future] = i
+
+    records, best = [None] * len(configs), None
+    pending = set(futures)
+    while pending and not job.cancelled:
+        done, pending = wait(pending, timeout=SOLVER_POLL_INTERVAL_SEC, return_when=FIRST_COMPLETED)
+        for future in done:
+            i = futures[future]
+            try:
+                records[i], result = future.result()
+            except Exception as e:
+                records[i], result = {"status": "error", "error": f"{type(e).__name__}: {e}"}, None
+            # 同点なら先に並べた設定(利用者の設定)を優先する
+            if result is not None and (best is None or (result["objective"], i) < (best[1]["objective"], best[0])):
+                best = (i, result)
+                job.report(objective=result["objective"], routes=route_names(data, result))
+    for future in pending:
+        # 共有のプールで後のジョブを待たせないよう，まだ始まっていない設定は取り消す
+        future.cancel()
+        records[futures[future]] = {"status": "cancelled"}
+    for config, record in zip(configs, records):
+        record.update({key: config[key] for key in ("first_solution_strategy", "metaheuristic", "seed")})
+        record["best"] = best is not None and record is records[best[0]]
+        metrics.count("portfolio_runs", status=record["status"])
+        if record["best"]:
+            metrics.count("portfolio_wins", strategy=config["first_solution_strategy"], metaheuristic=config["metaheuristic"])
+        text = f"目的関数値 {record['objective']}" if record["status"] == "ok" else record["status"]
+        job.log(f"{label(config)}: {text}" + (" (採用)" if record["best"] else ""))
+    if PORTFOLIO_LOG_PATH:
+        write_log(data, search_config, records)
+    if best is None:
+        return None, records
+    result = best[1]
+    result["portfolio"] = records
+    return result, records
@@ -0,0 +1,126 @@
+from datetime import timedelta
+from typing import List
+
+import numpy as np
+
+from tsptw.const import PREPROCESS_MAX_ITERATIONS
+
+
+class InfeasibleError(ValueError):
+    """求解する前に実行不可能と判明した場合に送出する．conflictsは原因となった地点と時間枠の説明"""
+
+    def __init__(self, conflicts: List[dict]) -> None:
+        super().__init__("\n".join(c["message"] for c in conflicts))
+        self.conflicts = conflicts
+
+
+def clock(data, minutes) -> str:
+    return (data["start_time"] + timedelta(minutes=int(minutes))).strftime("%H:%M")
+
+
+def shortest_paths(matrix: np.ndarray) -> np.ndarray:
+    # Floyd-Warshall．移動時間行列は三角不等式を満たすとは限らない
+    dist = matrix.astype(np.int64)
+    for k in range(len(dist)):
+        dist = np.minimum(dist, dist[:, k, None] + dist[None, k, :])
+    return dist
+
+
+def preprocess(data, max_iterations: int = PREPROCESS_MAX_ITERATIONS) -> dict:
+    """求解の前に時間枠を使って問題を絞り込む
+
+    - 時間枠を伝播させて引き締める(到着の下限は直前に訪問しうる地点から，上限は直後に訪問しうる地点から)
+    - iの最早時刻に出発してもjの最遅時刻に間に合わない枝i→jを取り除く
+    - 回りきれない地点や，1台ではどちらを先に回っても間に合わない2地点を実行不可能として報告する
+    戻り値は引き締めた時間枠"time_windows"，取り除く枝"pruned"(n×nのbool)，原因"conflicts"．
+    車両は勤務開始時刻に出発するので，それが出発地点の時間帯の外にある場合は時間枠を緩めても解けず，
+    InfeasibleErrorを送出する
+    """
+    matrix = data["time_matrix"]
+    n = len(matrix)
+    stops = np.array([node not in data["depots"] for node in range(n)])
+    a = np.array([w[0] for w in data["time_windows"]], dtype=np.int64)
+    b = np.array([w[1] for w in data["time_windows"]], dtype=np.int64)
+    conflicts = []
+
+    for vehicle_id, v in enumerate(data["vehicles"]):
+        start, departure = v["start"], v["time_window"][0]
+        if not a[start] <= departure <= b[start]:
+            sp = data["sp"][start]
+            conflicts.append(
+                {
+                    "stops": [sp.id],
+                    "message": f"車両{vehicle_id + 1}: 勤務開始時刻{clock(data, departure)}が出発地点{sp.name}の"
+                    f"時間帯{clock(data, a[start])}〜{clock(data, b[start] + sp.staying_min)}の外です",
+                }
+            )
+    if conflicts:
+        raise InfeasibleError(conflicts)
+
+    for k in np.flatnonzero(stops & (a > b)):
+        sp = data["sp"][k]
+        conflicts.append(
+            {
+                "stops": [sp.id],
+                "message": f"{sp.name}: 訪問可能時間帯{clock(data, a[k])}〜{clock(data, b[k] + sp.staying_min)}"
+                f"に見積診察時間{sp.staying_min}分が収まりません",
+            }
+        )
+    if conflicts:
+        return {"time_windows": data["time_windows"], "pruned": np.zeros((n, n), dtype=bool), "conflicts": conflicts}
+
+    # 出発地点から直行した場合の最早到着と，最終地点に間に合う最遅出発
+    from_start = np.min([v["time_window"][0] + matrix[v["start"]] for v in data["vehicles"]], axis=0)
+    to_end = np.max([v["time_window"][1] - matrix[:, v["end"]] for v in data["vehicles"]], axis=0)
+    between = stops[:, None] & stops[None, :] & ~np.eye(n, dtype=bool)
+
+    # どの地点にも最も早い車両の出発より前には着かない(再計画では出発前に開いた時間枠が負になる)
+    departure = min(v["time_window"][0] for v in data["vehicles"])
+    lo, hi = np.where(stops, np.maximum(a, departure), a), b.copy()
+    for _ in range(max_iterations):
+        pruned = between & (lo[:, None] + matrix > hi[None, :])
+        usable = between & ~pruned
+        earliest = np.where(usable, lo[:, None] + matrix, np.iinfo(np.int64).max).min(axis=0)
+        latest = np.where(usable, hi[None, :] - matrix, np.iinfo(np.int64).min).max(axis=1)
+        new_lo = np.where(stops, np.maximum(lo, np.minimum(from_start, earliest)), lo)
+        new_hi = np.where(stops, np.minimum(hi, np.maximum(to_end, latest)), hi)
+        if (new_lo == lo).all() and (new_hi == hi).all():
+            break
+        lo, hi = new_lo, new_hi
+        if (lo > hi).any():
+            break
+    pruned = between & (lo[:, None] + matrix > hi[None, :])
+
+    for k in np.flatnonzero(stops & (lo > hi)):
+        sp = data["sp"][k]
+        if from_start[k] > b[k]:
+            reason = f"出発地点から直行しても{clock(data, from_start[k])}の到着となり"
+        elif a[k] + matrix[k].min() > to_end[k]:
+            reason = "診察後に最終地点まで戻る時間が足りず"
+        else:
+            reason = f"他の訪問先との兼ね合いで最も早くても{clock(data, lo[k])}の到着となり"
+        conflicts.append(
+            {
+                "stops": [sp.id],
+                "message": f"{sp.name}: {reason}，訪問可能時間帯{clock(data, a[k])}〜"
+                f"{clock(data, b[k] + sp.staying_min)}に間に合いません",
+            }
+        )
+
+    # 1台の場合はすべての地点を同じ経路で回るため，どちらの順でも間に合わない2地点は両立しない
+    if not conflicts and len(data["vehicles"]) == 1:
+        dist = shortest_paths(matrix)
+        late = lo[:, None] + dist > hi[None, :]
+        for i, j in zip(*np.nonzero(np.triu(between & late & late.T))):
+            si, sj = data["sp"][i], data["sp"][j]
+            conflicts.append(
+                {
+                    "stops": [si.id, sj.id],
+                    "message": f"{si.name}({clock(data, a[i])}〜{clock(data, b[i] + si.staying_min)})と"
+                    f"{sj.name}({clock(data, a[j])}〜{clock(data, b[j] + sj.staying_min)})は，"
+                    "どちらを先に訪問してももう一方に間に合いません",
+                }
+            )
+
+    windows = [(int(lo[k]), int(hi[k])) if stops[k] else data["time_windows"][k] for k in range(n)]
+    return {"time_windows": windows, "pruned": pruned, "conflicts": conflicts}
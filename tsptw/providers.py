@@ -0,0 +1,362 @@
+import json
+import heapq
+import datetime as dt
+from functools import lru_cache
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+
+from tsptw.const import (
+    StepPoint,
+    TRAVEL_TIME_PROVIDER,
+    TRAVEL_TIME_FALLBACK,
+    ROAD_GRAPH_PATH,
+    ROAD_GRAPH_ACCESS_SPEED_KMH,
+    HAVERSINE_DETOUR_FACTOR,
+    HAVERSINE_SPEED_PROFILE,
+    HAVERSINE_OVERHEAD_SEC,
+)
+from tsptw.cache import travel_time_cache, travel_time_by_hour_cache, location_key
+from tsptw.fetcher import fetch_distance_blocks
+from tsptw.planner import plan_requests, RequestPlan
+from tsptw.metrics import metrics
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class TravelTimeProvider:
+    """地点間の移動時間[秒]行列を返す．取得できなかったペアは-1"""
+
+    name = ""
+
+    def durations(self, step_points: Sequence[StepPoint]) -> np.ndarray:
+        raise NotImplementedError
+
+    def row(self, origin: StepPoint, step_points: Sequence[StepPoint]) -> np.ndarray:
+        """originからstep_pointsへの移動時間[秒]だけを返す"""
+        return self.durations([origin, *step_points])[0, 1:]
+
+    def durations_by_hour(
+        self, step_points: Sequence[StepPoint], day: dt.date, hours: List[int], needed: np.ndarray
+    ) -> np.ndarray:
+        """day(計画の日付)の出発時刻の時間帯hours[時]ごとの移動時間[秒]をhours×n×nで返す
+
+        needed[h][i]がTrueの行(時間帯hに地点iを出発しうる)だけを求めればよい．交通状況を考慮しない取得元は
+        全時間帯で同じ値を返す
+        """
+        return np.repeat(self.durations(step_points)[None], len(hours), axis=0)
+
+
+class GoogleMapsProvider(TravelTimeProvider):
+    name = "google"
+
+    def __init__(self, on_plan: Callable[[RequestPlan], None] = None) -> None:
+        self.on_plan = on_plan
+
+    def durations(self, step_points: Sequence[StepPoint]) -> np.ndarray:
+        return self.block(step_points, step_points)
+
+    def row(self, origin: StepPoint, step_points: Sequence[StepPoint]) -> np.ndarray:
+        # 行列全体ではなく1行分(経由地点数の要素)だけを問い合わせる
+        return self.block([origin], step_points)[0]
+
+    def block(self, origins: Sequence[StepPoint], destinations: Sequence[StepPoint]) -> np.ndarray:
+        okeys = [location_key(sp.lat, sp.lng) for sp in origins]
+        dkeys = [location_key(sp.lat, sp.lng) for sp in destinations]
+        with metrics.span("travel_time.cache"):
+            durations = travel_time_cache.get_many(okeys + dkeys)
+        sec = np.array([[durations.get((o, d), -1) for d in dkeys] for o in okeys], dtype=np.int64)
+        same = np.array(okeys)[:, None] == np.array(dkeys)[None, :]
+        sec[same] = 0
+        metrics.count("travel_time_cache_lookups", int(((sec >= 0) & ~same).sum()), result="hit")
+        metrics.count("travel_time_cache_lookups", int((sec < 0).sum()), result="miss")
+
+        # キャッシュに無い(もしくは期限切れの)ペアだけをAPIに問い合わせる
+        plan = plan_requests(sec < 0)
+        if plan.calls > 0 and self.on_plan is not None:
+            self.on_plan(plan)
+        ocoords = [(sp.lat, sp.lng) for sp in origins]
+        dcoords = [(sp.lat, sp.lng) for sp in destinations]
+        with metrics.span("travel_time.fetch"):
+            resps = fetch_distance_blocks([([ocoords[p] for p in a], [dcoords[q] for q in b]) for a, b in plan.blocks])
+        fetched = []
+        for (a, b), resp in zip(plan.blocks, resps):
+            block = np.array(
+                [[c["duration"]["value"] if c["status"] == "OK" else -1 for c in r["elements"]] for r in resp["rows"]],
+                dtype=np.int64,
+            )
+            sub = sec[np.ix_(a, b)]
+            update = (sub < 0) & (block >= 0)
+            sub[update] = block[update]
+            sec[np.ix_(a, b)] = sub
+            fetched += [(okeys[a[k]], dkeys[b[l]], int(block[k, l])) for k, l in zip(*np.nonzero(update))]
+        travel_time_cache.put_many(fetched)
+        return sec
+
+    def durations_by_hour(
+        self, step_points: Sequence[StepPoint], day: dt.date, hours: List[int], needed: np.ndarray
+    ) -> np.ndarray:
+        # 時間帯ごとにキャッシュに無い必要な行だけを問い合わせ，全時間帯のブロックを一度に並列に送る
+        # 交通状況は曜日ごとに異なるので，曜日と時間帯の組でキャッシュする
+        keys, weekday = [location_key(sp.lat, sp.lng) for sp in step_points], day.weekday()
+        with metrics.span("travel_time.cache"):
+            durations = travel_time_by_hour_cache.get_many(keys, weekday, hours)
+        sec = np.array([[[durations.get((o, d, h), -1) for d in keys] for o in keys] for h in hours], dtype=np.int64)
+        same = np.array(keys)[:, None] == np.array(keys)[None, :]
+        sec[:, same] = 0
+        missing = needed[:, :, None] & (sec < 0)
+        metrics.count("travel_time_cache_lookups", int((needed[:, :, None] & (sec >= 0) & ~same).sum()), result="hit")
+        metrics.count("travel_time_cache_lookups", int(missing.sum()), result="miss")
+
+        plans = [plan_requests(m) for m in missing]
+        plan = RequestPlan([block for p in plans for block in p.blocks])
+        if plan.calls > 0 and self.on_plan is not None:
+            self.on_plan(plan)
+        coords = [(sp.lat, sp.lng) for sp in step_points]
+        targets = [(k, a, b) for k, p in enumerate(plans) for a, b in p.blocks]
+        with metrics.span("travel_time.fetch"):
+            resps = fetch_distance_blocks(
+                [([coords[p] for p in a], [coords[q] for q in b]) for _, a, b in targets],
+                departure_times=[departure_at(day, hours[k]) for k, _, _ in targets],
+            )
+        fetched = []
+        for (k, a, b), resp in zip(targets, resps):
+            # 交通状況を考慮した値が無い区間(徒歩圏など)は通常の所要時間を使う
+            block = np.array(
+                [
+                    [(c.get("duration_in_traffic") or c["duration"])["value"] if c["status"] == "OK" else -1 for c in r["elements"]]
+                    for r in resp["rows"]
+                ],
+                dtype=np.int64,
+            )
+            sub = sec[k][np.ix_(a, b)]
+            update = (sub < 0) & (block >= 0)
+            sub[update] = block[update]
+            sec[k][np.ix_(a, b)] = sub
+            fetched += [(keys[a[i]], keys[b[j]], weekday, hours[k], int(block[i, j])) for i, j in zip(*np.nonzero(update))]
+        travel_time_by_hour_cache.put_many(fetched)
+        return sec
+
+
+def departure_at(day: dt.date, hour: int) -> dt.datetime:
+    # 過去の時刻は指定できないため，既に過ぎていれば翌週以降の同じ曜日・時刻の交通状況で代用する
+    departure = dt.datetime.combine(day, dt.time(hour))
+    while departure <= dt.datetime.now():
+        departure += dt.timedelta(days=7)
+    return departure
+
+
+class HaversineProvider(TravelTimeProvider):
+    """大圏距離に迂回係数を掛け，距離帯ごとの平均速度で割った概算値"""
+
+    name = "haversine"
+
+    def __init__(
+        self,
+        detour_factor: float = HAVERSINE_DETOUR_FACTOR,
+        speed_profile: List[Tuple[float, float]] = HAVERSINE_SPEED_PROFILE,
+        overhead_sec: int = HAVERSINE_OVERHEAD_SEC,
+    ) -> None:
+        self.detour_factor = detour_factor
+        # [(この距離[km]未満まで, 平均速度[km/h]), ...]
+        self.bounds = np.array([b for b, _ in speed_profile[:-1]])
+        self.speeds = np.array([s for _, s in speed_profile])
+        self.overhead_sec = overhead_sec
+
+    def durations(self, step_points: Sequence[StepPoint]) -> np.ndarray:
+        lat = np.array([sp.lat for sp in step_points])
+        lng = np.array([sp.lng for sp in step_points])
+        km = self.detour_factor * haversine_km(lat[:, None], lng[:, None], lat[None, :], lng[None, :])
+        speed = self.speeds[np.searchsorted(self.bounds, km, side="right")]
+        sec = np.rint(km / speed * 3600).astype(np.int64) + self.overhead_sec
+        np.fill_diagonal(sec, 0)
+        return sec
+
+
+@lru_cache(maxsize=4)
+def load_road_graph(path: str):
+    with open(path) as f:
+        graph = json.load(f)
+    nodes = np.array(graph["nodes"], dtype=float)
+    adj = [[] for _ in range(len(nodes))]
+    for u, v, sec in graph["edges"]:
+        adj[u].append((v, sec))
+        if not graph.get("directed", False):
+            adj[v].append((u, sec))
+    return nodes[:, 0], nodes[:, 1], adj
+
+
+class RoadGraphProvider(TravelTimeProvider):
+    """ローカルの道路グラフ上の最短所要時間
+
+    グラフファイルは次の形式のJSON．edgesの所要時間は秒．directedがfalseなら双方向とみなす
+        {"directed": false, "nodes": [[lat, lng], ...], "edges": [[from, to, sec], ...]}
+    各地点は最寄りのノードに吸着させ，吸着距離はaccess_speed_kmhで移動するものとして加える
+    """
+
+    name = "road_graph"
+
+    def __init__(self, path: str = ROAD_GRAPH_PATH, access_speed_kmh: float = ROAD_GRAPH_ACCESS_SPEED_KMH) -> None:
+        self.lat, self.lng, self.adj = load_road_graph(path)
+        self.access_speed_kmh = access_speed_kmh
+
+    def dijkstra(self, source: int, targets: set) -> dict:
+        dist = {source: 0}
+        found = {}
+        heap = [(0, source)]
+        while heap and len(found) < len(targets):
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            if u in targets:
+                found[u] = d
+            for v, w in self.adj[u]:
+                if d + w < dist.get(v, float("inf")):
+                    dist[v] = d + w
+                    heapq.heappush(heap, (d + w, v))
+        return found
+
+    def durations(self, step_points: Sequence[StepPoint]) -> np.ndarray:
+        lat = np.array([sp.lat for sp in step_points])
+        lng = np.array([sp.lng for sp in step_points])
+        km = haversine_km(lat[:, None], lng[:, None], self.lat[None, :], self.lng[None, :])
+        nearest = km.argmin(axis=1)
+        snap = np.rint(km[np.arange(len(nearest)), nearest] / self.access_speed_kmh * 3600).astype(np.int64)
+
+        # 吸着先ノード間の最短所要時間
+        targets = sorted(set(nearest.tolist()))
+        pos = {u: k for k, u in enumerate(targets)}
+        between = np.full((len(targets), len(targets)), -1, dtype=np.int64)
+        for u in targets:
+            for v, d in self.dijkstra(u, set(targets)).items():
+                between[pos[u], pos[v]] = d
+
+        idx = np.array([pos[u] for u in nearest.tolist()])
+        sec = between[np.ix_(idx, idx)]
+        sec = np.where(sec < 0, -1, snap[:, None] + sec + snap[None, :])
+        np.fill_diagonal(sec, 0)
+        return sec
+
+
+class FallbackProvider(TravelTimeProvider):
+    """primaryが失敗した(クォータ切れ等)場合や欠損ペアをfallbackで補う"""
+
+    def __init__(self, primary: TravelTimeProvider, fallback: TravelTimeProvider, on_fallback: Callable = None) -> None:
+        self.primary = primary
+        self.fallback = fallback
+        self.on_fallback = on_fallback
+        self.name = primary.name
+
+    def durations(self, step_points: Sequence[StepPoint]) -> np.ndarray:
+        try:
+            sec = self.primary.durations(step_points)
+        except Exception as e:
+            if self.on_fallback is not None:
+                self.on_fallback(self.fallback, e)
+            return self.fallback.durations(step_points)
+        if (sec < 0).any():
+            if self.on_fallback is not None:
+                self.on_fallback(self.fallback, None)
+            sec = np.where(sec < 0, self.fallback.durations(step_points), sec)
+        return sec
+
+    def row(self, origin: StepPoint, step_points: Sequence[StepPoint]) -> np.ndarray:
+        try:
+            sec = self.primary.row(origin, step_points)
+        except Exception as e:
+            if self.on_fallback is not None:
+                self.on_fallback(self.fallback, e)
+            return self.fallback.row(origin, step_points)
+        if (sec < 0).any():
+            if self.on_fallback is not None:
+                self.on_fallback(self.fallback, None)
+            sec = np.where(sec < 0, self.fallback.row(origin, step_points), sec)
+        return sec
+
+    def durations_by_hour(
+        self, step_points: Sequence[StepPoint], day: dt.date, hours: List[int], needed: np.ndarray
+    ) -> np.ndarray:
+        try:
+            sec = self.primary.durations_by_hour(step_points, day, hours, needed)
+        except Exception as e:
+            if self.on_fallback is not None:
+                self.on_fallback(self.fallback, e)
+            return self.fallback.durations_by_hour(step_points, day, hours, needed)
+        gap = needed[:, :, None] & (sec < 0)
+        if gap.any():
+            if self.on_fallback is not None:
+                self.on_fallback(self.fallback, None)
+            sec = np.where(gap, self.fallback.durations_by_hour(step_points, day, hours, needed), sec)
+        return sec
+
+
+class OriginRowProvider(TravelTimeProvider):
+    """先頭の地点(現在地)からの1行だけを新たに求め，経由地点間はbaseの行列(キャッシュ済み)を使う
+
+    現在地へ向かう区間は経路に現れないので，逆向きも同じ時間とみなす
+    """
+
+    def __init__(self, base: TravelTimeProvider) -> None:
+        self.base = base
+        self.name = base.name
+
+    def durations(self, step_points: Sequence[StepPoint]) -> np.ndarray:
+        origin, rest = step_points[0], step_points[1:]
+        sec = np.zeros((len(step_points), len(step_points)), dtype=np.int64)
+        sec[1:, 1:] = self.base.durations(rest)
+        sec[0, 1:] = self.base.row(origin, rest)
+        sec[1:, 0] = sec[0, 1:]
+        return sec
+
+
+class MatrixProvider(TravelTimeProvider):
+    """呼び出し側が与えた移動時間[秒]行列から，地点のidで引く．ids[i]がsec[i]行目・i列目に対応する"""
+
+    name = "matrix"
+
+    def __init__(self, ids: Sequence[str], sec) -> None:
+        self.index = {sp_id: i for i, sp_id in enumerate(ids)}
+        self.sec = np.asarray(sec, dtype=np.int64)
+
+    def durations(self, step_points: Sequence[StepPoint]) -> np.ndarray:
+        rows = [self.index[sp.id] for sp in step_points]
+        return self.sec[np.ix_(rows, rows)]
+
+    def with_row(self, sp_id: str, row) -> "MatrixProvider":
+        """sp_idから各地点への移動時間[秒]rowを加えた行列．逆向きも同じ時間とみなす"""
+        row = np.asarray(row, dtype=np.int64)
+        n = len(self.sec)
+        sec = np.zeros((n + 1, n + 1), dtype=np.int64)
+        sec[:n, :n] = self.sec
+        sec[n, :n] = sec[:n, n] = row
+        return MatrixProvider([*self.index, sp_id], sec)
+
+
+PROVIDERS = {
+    GoogleMapsProvider.name: GoogleMapsProvider,
+    HaversineProvider.name: HaversineProvider,
+    RoadGraphProvider.name: RoadGraphProvider,
+}
+
+
+def available_providers() -> List[str]:
+    return [name for name in PROVIDERS if name != RoadGraphProvider.name or ROAD_GRAPH_PATH]
+
+
+def create_provider(
+    name: str = TRAVEL_TIME_PROVIDER,
+    on_plan: Callable[[RequestPlan], None] = None,
+    on_fallback: Callable = None,
+) -> TravelTimeProvider:
+    if name == GoogleMapsProvider.name:
+        provider = GoogleMapsProvider(on_plan=on_plan)
+        if TRAVEL_TIME_FALLBACK:
+            provider = FallbackProvider(provider, HaversineProvider(), on_fallback=on_fallback)
+        return provider
+    return PROVIDERS[name]()
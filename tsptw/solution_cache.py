@@ -0,0 +1,69 @@
+import json
+import hashlib
+import threading
+import datetime as dt
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+from tsptw.const import SOLUTION_CACHE_MAX_ENTRIES
+
+
+class SolutionCache:
+    """問題の内容ハッシュをキーとした求解結果のLRUキャッシュ．全セッションで共有する"""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._keys_by_stop: Dict[str, Set[str]] = {}
+        self._stops_by_key: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(time_matrix, time_windows, start_time: dt.datetime, stop_ids: List[str], config: dict = None) -> str:
+        h = hashlib.sha256()
+        matrix = np.ascontiguousarray(time_matrix, dtype=np.int64)
+        h.update(repr(matrix.shape).encode())
+        h.update(matrix.tobytes())
+        h.update(np.asarray(time_windows, dtype=np.int64).tobytes())
+        h.update(start_time.isoformat().encode())
+        h.update("\0".join(stop_ids).encode())
+        h.update(json.dumps(config or {}, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key: str, stop_ids: List[str], result: dict) -> None:
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            self._stops_by_key[key] = list(stop_ids)
+            for sp_id in stop_ids:
+                self._keys_by_stop.setdefault(sp_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest, _ = self._entries.popitem(last=False)
+                self._forget(oldest)
+
+    def invalidate(self, sp_id: str) -> None:
+        """経由地点が編集・削除されたときに，それを含む結果をすべて破棄する"""
+        with self._lock:
+            for key in self._keys_by_stop.pop(sp_id, set()):
+                self._entries.pop(key, None)
+                self._forget(key)
+
+    def _forget(self, key: str) -> None:
+        for sp_id in self._stops_by_key.pop(key, []):
+            keys = self._keys_by_stop.get(sp_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_stop[sp_id]
+
+
+solution_cache = SolutionCache(SOLUTION_CACHE_MAX_ENTRIES)
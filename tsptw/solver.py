@@ -0,0 +1,506 @@
+"""Streamlitに依存しない求解処理
+
+画面(tsptw.pages.findroute)とバッチ(tsptw.batch)の両方から使う．solve_vrpはStepPointの列を受け取り
+(data, result)を返す．solve_problemはJSONに書ける辞書を受け取り，JSONに書ける辞書を返す
+"""
+import datetime as dt
+from datetime import timedelta
+from typing import List
+
+import numpy as np
+
+from tsptw.const import (
+    StepPoint,
+    Vehicle,
+    Location,
+    TRAVEL_TIME_PROVIDER,
+    PROVIDER_LABELS,
+    SOLVER_TIME_LIMIT_SEC,
+    FIRST_SOLUTION_STRATEGIES,
+    LOCAL_SEARCH_METAHEURISTICS,
+    WARM_START_TIME_LIMIT_SEC,
+    REPLAN_TIME_LIMIT_SEC,
+    TRAVEL_TIME_HOURS,
+    PATH_COLORS,
+    SOFT_WINDOW_LATENESS_PENALTY,
+    SOFT_WINDOW_DROP_PENALTY,
+    create_datetime,
+)
+from tsptw.providers import MatrixProvider, OriginRowProvider, TravelTimeProvider, create_provider
+from tsptw.warmstart import adapt_route
+from tsptw.solution_cache import solution_cache
+from tsptw.jobs import Job
+from tsptw.model import solve_model
+from tsptw.preprocess import InfeasibleError, preprocess
+from tsptw.decompose import solve_decomposed
+from tsptw.exact import solve_exact, unsupported_reason
+from tsptw.portfolio import solve_portfolio
+from tsptw.timedep import fill_rows, leg_matrix, needed_rows, solve_time_dependent
+from tsptw.metrics import metrics
+
+# 再計画で現在地を表す地点のid
+CURRENT_POSITION_ID = "current"
+
+
+def travel_time_provider(name: str, job: Job = None) -> TravelTimeProvider:
+    # jobが無ければ使い捨てのJobに記録する(バッチやベンチマークでは標準出力に出さない)
+    log = (job or Job()).log
+    return create_provider(
+        name,
+        on_plan=lambda plan: log(f"Distance Matrix API: {plan.calls}リクエスト / {plan.elements}要素"),
+        on_fallback=lambda provider, e: log(
+            f"移動時間を取得できなかった区間は{PROVIDER_LABELS[provider.name]}で代替します" + (f": {e}" if e else "")
+        ),
+    )
+
+
+def create_time_matrix(*step_points: List[StepPoint], provider: TravelTimeProvider = None):
+    provider = provider or travel_time_provider(TRAVEL_TIME_PROVIDER)
+    sec = provider.durations(step_points)
+    if (sec < 0).any():
+        p, q = np.argwhere(sec < 0)[0]
+        raise ValueError(f"{step_points[p].name}から{step_points[q].name}への経路が見つかりません")
+    # 移動時間[分]に出発地点の見積診察時間を加える
+    staying_min = np.array([sp.staying_min for sp in step_points], dtype=np.int64)
+    arr = staying_min[:, None] + sec // 60  # sec -> min
+    np.fill_diagonal(arr, 0)
+    return arr
+
+
+def create_time_matrices(data, provider: TravelTimeProvider) -> np.ndarray:
+    """出発時刻の時間帯ごとの移動時間[分]行列(hours×n×n)．出発しうる時間帯の行だけを取得する"""
+    sp = data["sp"]
+    staying_min = np.array([p.staying_min for p in sp], dtype=np.int64)
+    # 地点を出発しうる時刻: 滞在可能時間帯の中で診察を終えた時刻．出発地点は車両の勤務開始時刻
+    earliest = np.array([w[0] for w in data["time_windows"]], dtype=np.int64) + staying_min
+    latest = np.array([w[1] for w in data["time_windows"]], dtype=np.int64) + staying_min
+    for v in data["vehicles"]:
+        earliest[v["start"]] = latest[v["start"]] = max(v["time_window"][0], data["time_windows"][v["start"]][0])
+    # 時間帯が見積診察時間より短い地点も，最も早く出発しうる時刻の時間帯は求める(時間帯の矛盾は前処理で扱う)
+    latest = np.maximum(latest, earliest)
+    needed = needed_rows(data["buckets"], earliest, latest)
+    sec = provider.durations_by_hour(sp, data["start_time"].date(), data["hours"], needed)
+    if (needed[:, :, None] & (sec < 0)).any():
+        _, p, q = np.argwhere(needed[:, :, None] & (sec < 0))[0]
+        raise ValueError(f"{sp[p].name}から{sp[q].name}への経路が見つかりません")
+    arr = staying_min[None, :, None] + fill_rows(sec, needed) // 60  # sec -> min
+    arr[:, np.arange(len(sp)), np.arange(len(sp))] = 0
+    data["departure"] = earliest
+    return arr.astype(np.int32)
+
+
+def diff_min(end: dt.datetime, start: dt.datetime) -> int:
+    return int((end - start).total_seconds() / 60)
+
+
+def create_time_windows(start_time: dt.time, *step_points: List[StepPoint]):
+    # 滞在先の見積診察時間を，滞在可能時間帯から予め引いておく
+    return [
+        (
+            diff_min(sp.start_time, start_time),
+            diff_min(sp.end_time - timedelta(minutes=sp.staying_min), start_time),
+        )
+        for sp in step_points
+    ]
+
+
+# Stores the data for the problem.
+def create_data_model(
+    start_time: dt.datetime,
+    end_time: dt.datetime,
+    *step_points: List[StepPoint],
+    provider: TravelTimeProvider = None,
+    vehicles: List[Vehicle] = None,
+    time_dependent: bool = False,
+):
+    data = {}
+    data["start_time"] = start_time
+    data["depot_opening_time"] = diff_min(end_time, start_time)
+    if vehicles is None:
+        # 1台の場合は先頭の地点を出発地点とし，出発時刻から当日中に戻ってくる
+        data["sp"] = step_points
+        data["vehicles"] = [
+            {
+                "path_color": PATH_COLORS[0],
+                "start": 0,
+                "end": 0,
+                "time_window": (0, data["depot_opening_time"]),
+                "capacity": len(step_points),
+            }
+        ]
+    else:
+        # 複数車両の場合は各車両の出発地点・最終地点を先頭に並べ，その後に経由地点を並べる
+        depots = list({sp.id: sp for v in vehicles for sp in (v.start, v.end)}.values())
+        data["sp"] = tuple(depots) + tuple(sp for sp in step_points if sp.id not in {d.id for d in depots})
+        node = {sp.id: i for i, sp in enumerate(data["sp"])}
+        data["vehicles"] = [
+            {
+                "path_color": PATH_COLORS[i % len(PATH_COLORS)],
+                "start": node[v.start.id],
+                "end": node[v.end.id],
+                "time_window": (diff_min(v.shift_start, start_time), diff_min(v.shift_end, start_time)),
+                "capacity": v.capacity,
+            }
+            for i, v in enumerate(vehicles)
+        ]
+    # https://developers.google.com/optimization/reference/python/constraint_solver/pywrapcp#intvar
+    data["time_windows"] = create_time_windows(start_time, *data["sp"])
+    if time_dependent and TRAVEL_TIME_HOURS:
+        # 時間帯ごとの移動時間を持ち，最初は各地点を最も早く出発する場合の時間帯の行列で解く
+        data["hours"] = TRAVEL_TIME_HOURS
+        data["buckets"] = np.array(
+            [diff_min(create_datetime(dt.time(h), day=start_time.date()), start_time) for h in TRAVEL_TIME_HOURS]
+        )
+        data["time_matrices"] = create_time_matrices(data, provider or travel_time_provider(TRAVEL_TIME_PROVIDER))
+        data["time_matrix"] = leg_matrix(data["time_matrices"], data["buckets"], data["departure"])
+    else:
+        data["time_matrix"] = create_time_matrix(*data["sp"], provider=provider)
+    data["depot"] = data["vehicles"][0]["start"]
+    data["depots"] = sorted({n for v in data["vehicles"] for n in (v["start"], v["end"])})
+    return data
+
+
+def progress_callback(data, manager, routing, job: Job):
+    best = {"cost": None}
+
+    def callback():
+        # 解が見つかるたびに呼ばれる．この時点で各変数は束縛されている
+        if job.cancelled:
+            routing.solver().FinishCurrentSearch()
+        # メタヒューリスティクスは改悪解も受理するため，最良解が更新されたときだけ報告する
+        cost = routing.CostVar().Value()
+        if best["cost"] is not None and cost >= best["cost"]:
+            return
+        best["cost"] = cost
+        routes = []
+        for vehicle_id in range(len(data["vehicles"])):
+            index = routing.Start(vehicle_id)
+            names = []
+            while not routing.IsEnd(index):
+                names.append(data["sp"][manager.IndexToNode(index)].name)
+                index = routing.NextVar(index).Value()
+            if len(names) > 1:
+                routes.append(names + [data["sp"][manager.IndexToNode(index)].name])
+        job.report(objective=cost, routes=routes)
+
+    return callback
+
+
+# Solve the VRP with time windows.
+@metrics.timed("solve_vrp")
+def solve_vrp(
+    start_time: dt.datetime,
+    *step_points: List[StepPoint],
+    search_config: dict,
+    provider_name: str = TRAVEL_TIME_PROVIDER,
+    provider: TravelTimeProvider = None,
+    last_route: dict = None,
+    warm_start_time_limit_sec: float = WARM_START_TIME_LIMIT_SEC,
+    vehicles: List[Vehicle] = None,
+    decompose: bool = False,
+    compare_monolithic: bool = False,
+    soft_windows: bool = False,
+    time_dependent: bool = False,
+    engine: str = "auto",
+    portfolio: bool = False,
+    job: Job = None,
+):
+    assert len(step_points) > 0, "There is no step point."
+    job = job or Job()
+
+    # Instantiate the data problem.
+    end_time = create_datetime("23:59:59", fromisoformat=True, day=start_time.date())
+
+    job.report(phase="移動時間を取得中")
+    with metrics.span("solve_vrp.travel_time"):
+        data = create_data_model(
+            start_time,
+            end_time,
+            *step_points,
+            provider=provider or travel_time_provider(provider_name, job),
+            vehicles=vehicles,
+            time_dependent=time_dependent,
+        )
+    stop_ids = [sp.id for sp in data["sp"]]
+
+    # Tighten the time windows and prune impossible arcs, and give up early if the windows conflict.
+    with metrics.span("solve_vrp.preprocess"):
+        if "time_matrices" in data:
+            # どの時間帯に出発しても下回らない移動時間で絞り込む
+            reduced = preprocess({**data, "time_matrix": data["time_matrices"].min(axis=0)})
+        else:
+            reduced = preprocess(data)
+    if soft_windows:
+        # Late arrivals and dropped visits are penalized instead, so the windows are left as they are.
+        data["lateness_penalty"] = SOFT_WINDOW_LATENESS_PENALTY
+        data["drop_penalty"] = SOFT_WINDOW_DROP_PENALTY
+        for conflict in reduced["conflicts"]:
+            job.log(f"時間帯を守れない可能性があります: {conflict['message']}")
+    elif reduced["conflicts"]:
+        raise InfeasibleError(reduced["conflicts"])
+    else:
+        data["time_windows"] = reduced["time_windows"]
+        data["pruned"] = reduced["pruned"]
+        job.log(f"時間枠から通れない区間を{int(reduced['pruned'].sum())}件除外しました")
+
+    # 1台で経由地点が少なければ，探索の代わりに動的計画法で最適解を求める
+    reason = unsupported_reason(data)
+    if engine == "exact" and reason is not None:
+        raise ValueError(f"厳密解法では解けない問題です: {reason}")
+    exact = engine == "exact" or (engine == "auto" and reason is None)
+
+    # Reuse the result if the same problem has already been solved in any session.
+    cache_key = solution_cache.make_key(
+        data.get("time_matrices", data["time_matrix"]),
+        data["time_windows"],
+        start_time,
+        stop_ids,
+        {
+            **search_config,
+            "vehicles": data["vehicles"],
+            "decompose": decompose,
+            "soft_windows": soft_windows,
+            "time_dependent": "time_matrices" in data,
+            "engine": "exact" if exact else "ortools",
+            "portfolio": portfolio,
+        },
+    )
+    result = solution_cache.get(cache_key)
+    metrics.count("solution_cache_lookups", result="hit" if result is not None else "miss")
+    if result is not None:
+        return data, result
+
+    job.report(phase="探索中")
+
+    # Seed the search with the previous route and run a short improvement-only search.
+    initial_routes = None
+    if last_route is not None and len(data["vehicles"]) == 1:
+        if last_route["depot"] == data["sp"][data["depot"]].id:
+            end = data["vehicles"][0]["end"]
+            initial_routes = [adapt_route(last_route["route"], stop_ids, data["time_matrix"], data["depot"], end)]
+
+    # Solve the problem while reporting the current best route.
+    def at_solution(manager, routing):
+        return progress_callback(data, manager, routing, job)
+
+    def solve(initial_routes):
+        if decompose and len(data["vehicles"]) > 1:
+            return solve_decomposed(data, search_config, compare=compare_monolithic, at_solution=at_solution)
+        if portfolio:
+            # 解が無くても設定ごとの結果を返せるよう，dataに残す
+            result, data["portfolio"] = solve_portfolio(
+                data,
+                search_config,
+                initial_routes=initial_routes,
+                initial_time_limit_sec=warm_start_time_limit_sec,
+                job=job,
+            )
+            return result
+        return solve_model(
+            data,
+            search_config,
+            initial_routes=initial_routes,
+            initial_time_limit_sec=warm_start_time_limit_sec,
+            at_solution=at_solution,
+        )
+
+    with metrics.span("solve_vrp.search"):
+        if exact:
+            result = solve_exact(data)
+            job.log(f"経由地点が少ないため厳密解法で最適解を求めました(調べた状態: {result['labels']}件)")
+        elif "time_matrices" in data:
+            result = solve_time_dependent(data, solve, initial_routes)
+        else:
+            result = solve(initial_routes)
+    if result is None:
+        return data, None
+    if not job.cancelled:
+        solution_cache.put(cache_key, stop_ids, result)
+    return data, result
+
+
+@metrics.timed("replan")
+def replan(
+    location: Location,
+    now: dt.datetime,
+    depot: StepPoint,
+    *remaining: List[StepPoint],
+    planned: List[str] = None,
+    provider_name: str = TRAVEL_TIME_PROVIDER,
+    provider: TravelTimeProvider = None,
+    time_limit_sec: float = REPLAN_TIME_LIMIT_SEC,
+    soft_windows: bool = False,
+    job: Job = None,
+):
+    """現在地locationと現在時刻nowから，まだ訪問していないremainingを回ってdepotに戻る経路を求め直す
+
+    訪問済みの地点は呼び出し側で除いておく．plannedに当初の経路(idの列)を与えると，その順序を初期解として
+    改善する．経由地点間の移動時間はキャッシュ済みのものを使い，現在地からの1行だけを新たに求める．
+    providerを与える場合は，現在地(CURRENT_POSITION_ID)からの移動時間も引けなければならない
+    """
+    current = StepPoint(CURRENT_POSITION_ID, 0, "現在地", "", location.lat, location.lng, 0, now, now)
+    end_time = create_datetime("23:59:59", fromisoformat=True, day=now.date())
+    vehicle = Vehicle(current, depot, now, end_time, len(remaining))
+    search_config = {
+        "time_limit_sec": time_limit_sec,
+        "first_solution_strategy": FIRST_SOLUTION_STRATEGIES[0],
+        "metaheuristic": LOCAL_SEARCH_METAHEURISTICS[0],
+    }
+    # 残りが無くてもdepotへ戻る経路を求められるよう，車両の最終地点でもあるdepotを渡す
+    return solve_vrp(
+        now,
+        depot,
+        *remaining,
+        search_config=search_config,
+        provider=OriginRowProvider(provider or travel_time_provider(provider_name, job)),
+        last_route={"depot": CURRENT_POSITION_ID, "route": planned} if planned else None,
+        warm_start_time_limit_sec=time_limit_sec,
+        vehicles=[vehicle],
+        soft_windows=soft_windows,
+        job=job,
+    )
+
+
+def format_min(start_time: dt.datetime, minutes: int) -> str:
+    return (start_time + timedelta(minutes=minutes)).time().isoformat()
+
+
+def problem_from_dict(problem: dict):
+    """JSONの問題を，solve_vrpの引数(start_time, step_points, kwargs)に変換する
+
+    step_pointsはStepPoint.to_dict()の形式で，vehiclesを省略した場合は先頭を出発地点とする．
+    vehiclesのstart・endにはstep_pointsのidを指定する．durations_secを与えた場合は
+    step_pointsの順に並べた移動時間[秒]行列として使い，外部APIには問い合わせない．dateに計画の日付
+    ("YYYY-MM-DD")を与えると時刻はその日のものとし(渋滞を考慮する場合の曜日もこれで決まる)，省略時は呼び出した日とする
+    """
+    day = dt.date.fromisoformat(problem["date"]) if problem.get("date") else dt.date.today()
+    step_points = [StepPoint.from_dict(sp, day) for sp in problem["step_points"]]
+    by_id = {sp.id: sp for sp in step_points}
+    vehicles = None
+    if problem.get("vehicles"):
+        vehicles = [
+            Vehicle(
+                by_id[v["start"]],
+                by_id[v["end"]],
+                create_datetime(v["shift_start"], fromisoformat=True, day=day),
+                create_datetime(v["shift_end"], fromisoformat=True, day=day),
+                v.get("capacity", len(step_points)),
+            )
+            for v in problem["vehicles"]
+        ]
+    provider = None
+    if problem.get("durations_sec") is not None:
+        provider = MatrixProvider([sp.id for sp in step_points], problem["durations_sec"])
+    search_config = {
+        "time_limit_sec": SOLVER_TIME_LIMIT_SEC,
+        "first_solution_strategy": FIRST_SOLUTION_STRATEGIES[0],
+        "metaheuristic": LOCAL_SEARCH_METAHEURISTICS[0],
+        **problem.get("search_config", {}),
+    }
+    kwargs = {
+        "search_config": search_config,
+        "provider_name": problem.get("provider", TRAVEL_TIME_PROVIDER),
+        "provider": provider,
+        "last_route": problem.get("last_route"),
+        "vehicles": vehicles,
+        "decompose": problem.get("decompose", False),
+        "soft_windows": problem.get("soft_windows", False),
+        "time_dependent": problem.get("time_dependent", False),
+        "engine": problem.get("engine", "auto"),
+        "portfolio": problem.get("portfolio", False),
+    }
+    return create_datetime(problem["start_time"], fromisoformat=True, day=day), step_points, kwargs
+
+
+def result_to_dict(data, result) -> dict:
+    """solve_vrpの結果を，ノード番号ではなく地点のidと時刻で表したJSONに書ける辞書にする"""
+    if result is None:
+        out = {"status": "not_found"}
+        if "portfolio" in data:
+            out["portfolio"] = data["portfolio"]
+        return out
+    start_time = data["start_time"]
+    sp = data["sp"]
+    routes = []
+    for route in result["routes"]:
+        vehicle = data["vehicles"][route["vehicle_id"]]
+        routes.append(
+            {
+                "vehicle_id": route["vehicle_id"],
+                "stops": [
+                    {
+                        "id": sp[stop["node"]].id,
+                        "name": sp[stop["node"]].name,
+                        "earliest": format_min(start_time, stop["min"]),
+                        "latest": format_min(start_time, stop["max"]),
+                    }
+                    for stop in route["stops"]
+                ],
+                "end": {
+                    "id": sp[vehicle["end"]].id,
+                    "name": sp[vehicle["end"]].name,
+                    "earliest": format_min(start_time, route["end"]["min"]),
+                    "latest": format_min(start_time, route["end"]["max"]),
+                },
+                "duration_min": route["end"]["min"] - route["stops"][0]["min"],
+            }
+        )
+    out = {
+        "status": "ok",
+        "objective": result["objective"],
+        "routes": routes,
+        "late": [{"id": sp[late["node"]].id, "minutes": late["minutes"]} for late in result.get("late", [])],
+        "dropped": [sp[node].id for node in result["dropped"]],
+        "engine": result.get("engine", "ortools"),
+    }
+    if "stats" in result:
+        out["stats"] = result["stats"]
+    if "portfolio" in result:
+        out["portfolio"] = result["portfolio"]
+    return out
+
+
+def respond(solve, *args, job: Job, **kwargs) -> dict:
+    """solve(*args, job=job, **kwargs)の結果をresult_to_dictの形式にする．時間帯の条件を満たせない場合は
+    status=infeasibleとその理由を返す
+    """
+    try:
+        data, result = solve(*args, job=job, **kwargs)
+    except InfeasibleError as e:
+        return {"status": "infeasible", "conflicts": e.conflicts, "messages": job.messages}
+    return {**result_to_dict(data, result), "messages": job.messages}
+
+
+def solve_problem(problem: dict, job: Job = None) -> dict:
+    """JSONの問題(problem_from_dict)を解く"""
+    start_time, step_points, kwargs = problem_from_dict(problem)
+    return respond(solve_vrp, start_time, *step_points, job=job or Job(), **kwargs)
+
+
+def replan_problem(request: dict, job: Job = None) -> dict:
+    """JSONの再計画の要求を解く．1台の問題(problem_from_dict)に次を加えたもの
+
+    current: 現在地と現在時刻 {"lat", "lng", "time": "HH:MM:SS"}，completed: 訪問済みの地点のid，
+    planned: 当初の経路の地点のid(省略可)．durations_secを与えた場合は，現在地からstep_pointsの順に
+    各地点への移動時間[秒]をcurrentの"durations_sec"に与える
+    """
+    start_time, step_points, kwargs = problem_from_dict(request)
+    depot, completed = step_points[0], set(request.get("completed", []))
+    current = request["current"]
+    provider = kwargs["provider"]
+    if provider is not None:
+        if current.get("durations_sec") is None:
+            raise ValueError("durations_secを与えた場合は，現在地からの移動時間current.durations_secも必要です")
+        provider = provider.with_row(CURRENT_POSITION_ID, current["durations_sec"])
+    return respond(
+        replan,
+        Location(current["lat"], current["lng"]),
+        create_datetime(current["time"], fromisoformat=True, day=start_time.date()),
+        depot,
+        *[sp for sp in step_points[1:] if sp.id not in completed],
+        planned=request.get("planned"),
+        provider_name=kwargs["provider_name"],
+        provider=provider,
+        soft_windows=kwargs["soft_windows"],
+        job=job or Job(),
+    )
@@ -0,0 +1,74 @@
+"""出発時刻の時間帯ごとの移動時間を使った求解
+
+移動時間は時間帯×出発地×到着地の行列(hours×n×n)で持ち，区間ごとに出発地を発つ時刻の時間帯の値を使う．
+OR-Toolsの移動時間は時刻によらない行列なので，各地点の出発時刻を見積もって行ごとに時間帯を選んだ行列で解き，
+解の出発時刻で選び直して解き直すことを時間帯が変わらなくなるまで繰り返す
+"""
+from typing import Callable, List
+
+import numpy as np
+
+from tsptw.const import TIME_DEPENDENT_MAX_ITERATIONS
+
+
+def bucket_of(buckets: np.ndarray, minutes) -> np.ndarray:
+    """時刻minutes[分]が属する時間帯の番号．最初の区切りより前は最初の時間帯とみなす"""
+    return np.clip(np.searchsorted(buckets, minutes, side="right") - 1, 0, len(buckets) - 1)
+
+
+def needed_rows(buckets: np.ndarray, earliest: np.ndarray, latest: np.ndarray) -> np.ndarray:
+    """地点iを出発しうる時刻[earliest[i], latest[i]]と重なる時間帯hについてTrueとなるhours×nの配列"""
+    first, last = bucket_of(buckets, earliest), bucket_of(buckets, latest)
+    hours = np.arange(len(buckets))[:, None]
+    return (hours >= first[None, :]) & (hours <= last[None, :])
+
+
+def fill_rows(stack: np.ndarray, needed: np.ndarray) -> np.ndarray:
+    """求めなかった行を，同じ地点の最も近い時間帯の行で埋める
+
+    求める行が無い地点は，取得済み(負の値を含まない)の行のうち最も近い時間帯の行で埋め，それも無ければそのままにする
+    """
+    stack = stack.copy()
+    hours = np.arange(len(stack))
+    for i in range(stack.shape[1]):
+        known = np.flatnonzero(needed[:, i])
+        if len(known) == 0:
+            known = np.flatnonzero((stack[:, i, :] >= 0).all(axis=1))
+            if len(known) == 0:
+                continue
+        nearest = known[np.abs(hours[:, None] - known[None, :]).argmin(axis=1)]
+        stack[:, i, :] = stack[nearest, i, :]
+    return stack
+
+
+def leg_matrix(stack: np.ndarray, buckets: np.ndarray, departure: np.ndarray) -> np.ndarray:
+    """地点iをdeparture[i]に出発する場合の移動時間行列．行ごとにその時間帯の値を選ぶ"""
+    n = stack.shape[1]
+    return stack[bucket_of(buckets, departure), np.arange(n)].astype(np.int64)
+
+
+def solve_time_dependent(
+    data, solve: Callable, initial_routes: List[List[int]] = None, max_iterations: int = TIME_DEPENDENT_MAX_ITERATIONS
+):
+    """solve(initial_routes)を，解の出発時刻に合わせた移動時間行列で解き直す
+
+    data["time_matrix"]は最初の見積り(data["departure"])で選んだ行列とし，解き直すたびに更新する．
+    2回目以降は前回の経路を初期解とする．max_iterations回で収まらない場合は最後の解を返す
+    """
+    staying = np.array([sp.staying_min for sp in data["sp"]], dtype=np.int64)
+    departure = np.array(data["departure"], dtype=np.int64)
+    result = solve(initial_routes)
+    for _ in range(max_iterations):
+        if result is None:
+            return None
+        # 出発時刻 = 到着(診察開始)時刻 + 見積診察時間．訪問しなかった地点は前回の見積りのまま
+        for route in result["routes"]:
+            for stop in route["stops"]:
+                departure[stop["node"]] = stop["min"] + staying[stop["node"]]
+        matrix = leg_matrix(data["time_matrices"], data["buckets"], departure)
+        if (matrix == data["time_matrix"]).all():
+            break
+        data["time_matrix"] = matrix
+        data["departure"] = departure.copy()
+        result = solve([[stop["node"] for stop in route["stops"][1:]] for route in result["routes"]])
+    return result
@@ -0,0 +1,31 @@
+from typing import List
+
+import numpy as np
+
+
+def adapt_route(
+    last_route: List[str], stop_ids: List[str], time_matrix: np.ndarray, depot: int = 0, end: int = None
+) -> List[int]:
+    """前回の経路(経由地点idの列)を今回の経由地点に合わせる
+
+    削除された経由地点は取り除き，追加された経由地点は所要時間の増分が最小となる位置に挿入する．
+    戻り値は出発地点(と最終地点end．省略時は出発地点に戻る)を除くノード番号の列
+    """
+    end = depot if end is None else end
+    pos = {sp_id: node for node, sp_id in enumerate(stop_ids)}
+    route = []
+    for sp_id in last_route:
+        node = pos.get(sp_id)
+        if node is not None and node not in (depot, end) and node not in route:
+            route.append(node)
+
+    visited = set(route)
+    for node in range(len(stop_ids)):
+        if node in (depot, end) or node in visited:
+            continue
+        tour = np.array([depot] + route + [end])
+        prev, nxt = tour[:-1], tour[1:]
+        delta = time_matrix[prev, node] + time_matrix[node, nxt] - time_matrix[prev, nxt]
+        route.insert(int(delta.argmin()), node)
+        visited.add(node)
+    return route